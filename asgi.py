@@ -0,0 +1,20 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+
+Serve with: uvicorn asgi:app --host 0.0.0.0 --port 8080
+"""
+import os
+from a2wsgi import WSGIMiddleware
+from service import create_app
+from service.async_app import AsyncPromotionApp
+
+PORT = int(os.getenv("PORT", "8000"))
+
+flask_app = create_app()
+# Requests the async handlers do not serve run on the Flask app in a thread pool
+app = AsyncPromotionApp(flask_app.config, fallback=WSGIMiddleware(flask_app))
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
@@ -0,0 +1,6 @@
+"""
+Package: benchmarks
+Micro-benchmarks for the model and route hot paths
+
+Run with ``python -m benchmarks --help`` (or ``make benchmark``)
+"""
@@ -0,0 +1,87 @@
+"""
+ASGI vs. WSGI Benchmarks
+
+Serves a burst of concurrent requests through one ASGI worker (asgi.py with
+the async engine) and the same burst through one sync WSGI worker, which has
+to handle them one after another
+"""
+import asyncio
+import random
+
+from service.async_app import AsyncPromotionApp
+from service.models import Promotion
+from .data import promotion_row
+from .harness import benchmark
+
+CONCURRENCY = 50
+LIST_URL = "/api/promotions"
+LIST_QUERY = "datetime=2025-06-01&promotion_type=percentage&promotion_scope=product_id,entire_store"
+
+
+async def call(asgi_app, path, query=""):
+    """Sends a GET request to an ASGI app and returns the status code"""
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(), "headers": []}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+    return sent[0]["status"]
+
+
+def asgi_burst(context, path, query=""):
+    """Returns a callable that runs CONCURRENCY concurrent requests on one event loop"""
+    if "asgi" not in context:
+        context["asgi"] = AsyncPromotionApp(context["app"].config)
+        context["loop"] = asyncio.new_event_loop()
+    asgi_app, loop = context["asgi"], context["loop"]
+
+    async def burst():
+        return await asyncio.gather(*(call(asgi_app, path, query) for _ in range(CONCURRENCY)))
+
+    return lambda: loop.run_until_complete(burst())
+
+
+def wsgi_burst(context, path, query=""):
+    """Returns a callable that runs CONCURRENCY requests through one sync WSGI worker"""
+    client = context["client"]
+    url = f"{path}?{query}" if query else path
+
+    def burst():
+        return [client.get(url).status_code for _ in range(CONCURRENCY)]
+
+    return burst
+
+
+def _existing_promotion_path():
+    promotion = Promotion(**promotion_row(random.Random(6)))
+    promotion.create()
+    return f"/api/promotions/{promotion.promotion_id}"
+
+
+@benchmark(f"asgi.get_promotion.x{CONCURRENCY}")
+def asgi_get_promotion(context):
+    """Concurrent GET /api/promotions/<id> through the ASGI app"""
+    return asgi_burst(context, _existing_promotion_path())
+
+
+@benchmark(f"wsgi.get_promotion.x{CONCURRENCY}")
+def wsgi_get_promotion(context):
+    """The same GET /api/promotions/<id> burst through the WSGI app"""
+    return wsgi_burst(context, _existing_promotion_path())
+
+
+@benchmark(f"asgi.list_promotions.x{CONCURRENCY}", sized=True)
+def asgi_list_promotions(context, _):
+    """Concurrent filtered GET /api/promotions through the ASGI app"""
+    return asgi_burst(context, LIST_URL, LIST_QUERY)
+
+
+@benchmark(f"wsgi.list_promotions.x{CONCURRENCY}", sized=True)
+def wsgi_list_promotions(context, _):
+    """The same filtered GET /api/promotions burst through the WSGI app"""
+    return wsgi_burst(context, LIST_URL, LIST_QUERY)
@@ -0,0 +1,39 @@
+"""
+Compression Benchmarks
+
+The filtered GET /api/promotions listing with each Accept-Encoding the service
+negotiates, to weigh the CPU cost of each encoding and level against identity
+"""
+from .harness import benchmark
+
+LIST_URL = "/api/promotions?datetime=2025-06-01&promotion_type=percentage&promotion_scope=product_id,entire_store"
+
+
+def _list_with(context, accept_encoding):
+    client = context["client"]
+    headers = {"Accept-Encoding": accept_encoding}
+    return lambda: client.get(LIST_URL, headers=headers)
+
+
+@benchmark("compression.list_promotions.identity", sized=True)
+def list_identity(context, _):
+    """GET /api/promotions without compression"""
+    return _list_with(context, "identity")
+
+
+@benchmark("compression.list_promotions.gzip", sized=True)
+def list_gzip(context, _):
+    """GET /api/promotions compressed with gzip"""
+    return _list_with(context, "gzip")
+
+
+@benchmark("compression.list_promotions.br", sized=True)
+def list_brotli(context, _):
+    """GET /api/promotions compressed with brotli"""
+    return _list_with(context, "br")
+
+
+@benchmark("compression.list_promotions.zstd", sized=True)
+def list_zstd(context, _):
+    """GET /api/promotions compressed with zstd"""
+    return _list_with(context, "zstd")
@@ -0,0 +1,40 @@
+"""
+JSON Encoding Benchmarks
+
+Encodes a marshalled page of promotions with the flask-restx default
+representation (stdlib json) and with service.common.json_representation
+(orjson when installed)
+"""
+import random
+
+from flask_restx import marshal
+from flask_restx.representations import output_json as restx_output_json
+
+from service.models import Promotion
+from service.common.json_representation import output_json
+from .data import promotion_row
+from .harness import benchmark
+
+PAGE_SIZE = 1000
+
+
+def _page():
+    from service.routes import promotion_model  # pylint: disable=import-outside-toplevel
+
+    rng = random.Random(7)
+    promotions = [Promotion(promotion_id=index, **promotion_row(rng)) for index in range(PAGE_SIZE)]
+    return marshal([promotion.serialize() for promotion in promotions], promotion_model)
+
+
+@benchmark(f"json.restx_default.x{PAGE_SIZE}")
+def restx_default(_):
+    """flask-restx output_json of a page of promotions"""
+    data = _page()
+    return lambda: restx_output_json(data, 200)
+
+
+@benchmark(f"json.output_json.x{PAGE_SIZE}")
+def json_representation(_):
+    """json_representation.output_json of the same page of promotions"""
+    data = _page()
+    return lambda: output_json(data, 200)
@@ -0,0 +1,72 @@
+"""
+Model Benchmarks
+
+Hot paths in service.models and service.common.datetime_utils
+"""
+import random
+
+from service.models import Promotion, PromotionData
+from service.common.datetime_utils import datetime_from_str
+from .data import promotion_json, promotion_row
+from .harness import benchmark
+
+
+@benchmark("models.serialize")
+def serialize(_):
+    """Promotion.serialize on a fully populated instance"""
+    promotion = Promotion(**promotion_row(random.Random(1)))
+    return promotion.serialize
+
+
+@benchmark("models.deserialize")
+def deserialize(_):
+    """Promotion.deserialize of a complete request body into a new instance"""
+    data = promotion_json(random.Random(2))
+    return lambda: Promotion().deserialize(data)
+
+
+@benchmark("models.deserialize_update")
+def deserialize_update(_):
+    """Promotion.deserialize of a partial update onto an existing instance"""
+    promotion = Promotion(**promotion_row(random.Random(3)))
+    data = {"promotion_name": "renamed", "end_date": "2030-01-01T00:00:00"}
+    return lambda: promotion.deserialize(data)
+
+
+@benchmark("models.parse_promotion_data")
+def parse_promotion_data(_):
+    """PromotionData.parse of a complete request body without an ORM instance"""
+    data = promotion_json(random.Random(2))
+    return lambda: PromotionData.parse(data)
+
+
+@benchmark("models.deserialize_with_default")
+def deserialize_with_default(_):
+    """Promotion.deserialize_with_default with a deserializer"""
+    data = {"start_date": "2025-01-01T00:00:00"}
+    return lambda: Promotion.deserialize_with_default(
+        "start_date", data, None, Promotion.deserialize_datetime
+    )
+
+
+@benchmark("datetime_utils.datetime_from_str")
+def parse_datetime(_):
+    """datetime_from_str on a full ISO 8601 timestamp"""
+    return lambda: datetime_from_str("2025-06-01T12:30:45.123456")
+
+
+@benchmark("models.find_with_filters", sized=True)
+def find_with_filters(_, __):
+    """Promotion.find_with_filters with datetime, type and scope filters"""
+    filters = {
+        "datetime": "2025-06-01",
+        "promotion_type": ["percentage"],
+        "promotion_scope": ["product_id", "entire_store"],
+    }
+    return lambda: Promotion.find_with_filters(filters).all()
+
+
+@benchmark("models.find_with_filters.unfiltered", sized=True)
+def find_all(_, __):
+    """Promotion.find_with_filters without any filters (a full listing)"""
+    return lambda: Promotion.find_with_filters({}).all()
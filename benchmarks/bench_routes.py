@@ -0,0 +1,49 @@
+"""
+Route Benchmarks
+
+The full request path (routing, parsing, model, marshalling and JSON encoding)
+through the Flask test client
+"""
+import random
+
+from service.models import Promotion
+from .data import promotion_json, promotion_row
+from .harness import benchmark
+
+
+def _existing_promotion_id():
+    promotion = Promotion(**promotion_row(random.Random(4)))
+    promotion.create()
+    return promotion.promotion_id
+
+
+@benchmark("routes.get_promotion")
+def get_promotion(context):
+    """GET /api/promotions/<id>"""
+    client = context["client"]
+    url = f"/api/promotions/{_existing_promotion_id()}"
+    return lambda: client.get(url)
+
+
+@benchmark("routes.create_promotion")
+def create_promotion(context):
+    """POST /api/promotions"""
+    client = context["client"]
+    data = promotion_json(random.Random(5))
+    return lambda: client.post("/api/promotions", json=data)
+
+
+@benchmark("routes.update_promotion")
+def update_promotion(context):
+    """PUT /api/promotions/<id>"""
+    client = context["client"]
+    url = f"/api/promotions/{_existing_promotion_id()}"
+    return lambda: client.put(url, json={"promotion_name": "renamed"})
+
+
+@benchmark("routes.list_promotions", sized=True)
+def list_promotions(context, _):
+    """GET /api/promotions with datetime, type and scope filters"""
+    client = context["client"]
+    url = "/api/promotions?datetime=2025-06-01&promotion_type=percentage&promotion_scope=product_id,entire_store"
+    return lambda: client.get(url)
@@ -0,0 +1,70 @@
+"""
+Benchmark Data
+
+Deterministic generation and bulk loading of Promotion rows so that
+benchmarks can grow the table to each requested size
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert
+from service.models import db, Promotion, PromotionType, PromotionScope
+
+EPOCH = datetime(2020, 1, 1)
+CHUNK_SIZE = 10_000
+
+
+def promotion_row(rng):
+    """Returns a dict of column values for a random promotion"""
+    start_date = EPOCH + timedelta(days=rng.randrange(0, 3650))
+    return {
+        "promotion_name": f"promotion-{rng.randrange(1_000_000)}",
+        "promotion_description": "a generated promotion used for benchmarking",
+        "promotion_type": rng.choice(list(PromotionType)),
+        "promotion_scope": rng.choice(list(PromotionScope)),
+        "start_date": start_date,
+        "end_date": start_date + timedelta(days=rng.randrange(1, 60)),
+        "promotion_value": round(rng.uniform(1, 90), 2),
+        "promotion_code": f"CODE{rng.randrange(100_000)}",
+        "created_by": uuid.UUID(int=rng.getrandbits(128)),
+        "modified_by": None,
+        "created_when": start_date,
+        "modified_when": start_date,
+        "active": rng.random() < 0.5,
+    }
+
+
+def promotion_json(rng):
+    """Returns a request body for a random promotion"""
+    row = promotion_row(rng)
+    return {
+        "promotion_name": row["promotion_name"],
+        "promotion_description": row["promotion_description"],
+        "promotion_type": row["promotion_type"].name,
+        "promotion_scope": row["promotion_scope"].name,
+        "start_date": row["start_date"].isoformat(),
+        "end_date": row["end_date"].isoformat(),
+        "promotion_value": row["promotion_value"],
+        "promotion_code": row["promotion_code"],
+        "created_by": str(row["created_by"]),
+        "active": row["active"],
+    }
+
+
+def clear_table():
+    """Removes every promotion"""
+    db.session.query(Promotion).delete()
+    db.session.commit()
+
+
+def fill_table(rows, seed=2820):
+    """Grows the promotion table to the requested number of rows"""
+    rng = random.Random(seed + rows)
+    existing = db.session.query(func.count(Promotion.promotion_id)).scalar()
+    remaining = rows - existing
+    while remaining > 0:
+        chunk = min(CHUNK_SIZE, remaining)
+        db.session.execute(insert(Promotion), [promotion_row(rng) for _ in range(chunk)])
+        db.session.commit()
+        remaining -= chunk
@@ -0,0 +1,122 @@
+"""
+Benchmark Harness
+
+A small timeit based harness. Benchmarks register a setup function with the
+``benchmark`` decorator which receives a context (and the table size for sized
+benchmarks) and returns the zero argument callable that is actually timed.
+Results can be saved as a baseline and later compared against it.
+"""
+import json
+import platform
+import statistics
+import timeit
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable
+
+BENCHMARKS = []
+
+# Default slowdown (as a fraction) before a benchmark is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+@dataclass
+class Benchmark:
+    """A registered benchmark"""
+
+    name: str
+    setup: Callable
+    sized: bool = False
+
+
+@dataclass
+class Result:
+    """Timing of a single benchmark run"""
+
+    name: str
+    calls: int
+    timings: list = field(default_factory=list)
+
+    @property
+    def median(self):
+        """Median seconds per call"""
+        return statistics.median(self.timings)
+
+    @property
+    def best(self):
+        """Fastest seconds per call"""
+        return min(self.timings)
+
+    def to_dict(self):
+        """Converts the result into a JSON friendly dict"""
+        return {"calls": self.calls, "median": self.median, "best": self.best}
+
+
+def benchmark(name=None, sized=False):
+    """Registers a benchmark setup function
+
+    Args:
+        name (str, optional): name of the benchmark. Defaults to the function name
+        sized (bool, optional): run once per table size. Defaults to False
+    """
+
+    def decorator(setup):
+        BENCHMARKS.append(Benchmark(name or setup.__name__, setup, sized))
+        return setup
+
+    return decorator
+
+
+def measure(name, func, repeat=5, min_time=0.2):
+    """Times a callable, calibrating the number of calls per repeat like timeit does"""
+    timer = timeit.Timer(func)
+    calls, _ = timer.autorange()
+    calls = max(1, int(calls * min_time / 0.2))
+    timings = [elapsed / calls for elapsed in timer.repeat(repeat=repeat, number=calls)]
+    return Result(name, calls, timings)
+
+
+def save_results(results, path):
+    """Writes results to a JSON baseline file"""
+    document = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": {result.name: result.to_dict() for result in results},
+    }
+    with open(path, "w", encoding="utf-8") as baseline_file:
+        json.dump(document, baseline_file, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    """Reads the results from a JSON baseline file"""
+    with open(path, encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)["results"]
+
+
+def format_time(seconds):
+    """Formats seconds using a readable unit"""
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def report(results, baseline=None, threshold=REGRESSION_THRESHOLD):
+    """Prints a comparison table and returns the names of regressed benchmarks"""
+    baseline = baseline or {}
+    regressions = []
+    print(f"{'benchmark':<48} {'median':>10} {'best':>10} {'baseline':>10} {'change':>9}")
+    print("-" * 91)
+    for result in results:
+        line = f"{result.name:<48} {format_time(result.median):>10} {format_time(result.best):>10}"
+        previous = baseline.get(result.name)
+        if previous:
+            change = result.median / previous["median"] - 1
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions.append(result.name)
+            line += f" {format_time(previous['median']):>10} {change:>+8.1%}{flag}"
+        print(line)
+    return regressions
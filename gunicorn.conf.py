@@ -0,0 +1,51 @@
+"""
+Gunicorn configuration
+
+Sizes the workers from the CPU quota and memory limit of the container
+(see k8s/deployment.yaml) instead of gunicorn's single sync worker default.
+"""
+import os
+from service.common import container_limits, entity_cache
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+
+_cpus = container_limits.cpu_limit()
+_memory = container_limits.memory_limit()
+_settings = container_limits.worker_settings(_cpus, _memory)
+workers = _settings["workers"]
+threads = _settings["threads"]
+worker_class = _settings["worker_class"]
+
+# Load the app once in the master so workers share its memory copy-on-write
+preload_app = True
+
+# Keep connections from the ingress / load balancer open between requests
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+# Recycle workers periodically, with jitter so they do not all restart together
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "100"))
+
+
+def when_ready(server):
+    """Logs the derived settings once the master is ready"""
+    server.log.info(
+        "Container limits: %.2f CPUs, %s memory -> %s %s workers x %s threads",
+        _cpus,
+        f"{_memory // container_limits.MB}Mi" if _memory else "unlimited",
+        workers,
+        worker_class,
+        threads,
+    )
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops the database connections inherited from the preloaded master"""
+    container_limits.dispose_engines(server.app.wsgi())
+
+
+def on_exit(server):
+    """Writes the entity cache snapshot for the workers of the next deploy"""
+    entity_cache.save_snapshot_on_exit(server.app.wsgi())
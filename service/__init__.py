@@ -22,7 +22,9 @@ import sys
 from flask import Flask
 from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import (
+    cache, compression, entity_cache, json_representation, log_handlers, profiler, rate_limit, replicas, shards
+)
 
 
 api = None  # pylint: disable=invalid-name
@@ -51,6 +53,8 @@ def create_app():
         doc="/apidocs",
         prefix="/api"
     )
+    # Encode responses with orjson when it is installed
+    json_representation.init_json(api)
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
@@ -64,7 +68,12 @@ def create_app():
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
 
         try:
-            db.create_all()
+            # Only the primary, the replicas get their schema through replication
+            db.create_all(bind_key=None)
+            # The promotion table of each shard if promotions are sharded
+            shards.init_shards(app)
+            # Search with ILIKE until flask create-search-index adds the search_vector columns
+            models.init_search(app)
         except Exception as error:  # pylint: disable=broad-except
             app.logger.critical("%s: Cannot continue", error)
             # gunicorn requires exit code 4 to stop spawning workers when they die
@@ -73,6 +82,27 @@ def create_app():
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
 
+        # The response caches of this worker
+        cache.init_caches(app)
+
+        # Identify the clients behind the ingress by X-Forwarded-For
+        rate_limit.init_proxies(app)
+
+        # Turn away clients over their request budget before they use a connection
+        rate_limit.init_rate_limits(app)
+
+        # Send the reads of GET requests to read replicas if any are configured
+        replicas.init_replicas(app)
+
+        # Compress large responses (installed first so it runs after the profiler)
+        compression.init_compression(app)
+
+        # Opt-in per-request profiling (no hooks are installed unless configured)
+        profiler.init_profiling(app)
+
+        # Per-worker cache of single promotions, warm from the last snapshot
+        entity_cache.init_entity_cache(app)
+
         app.logger.info(70 * "*")
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
@@ -0,0 +1,347 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Async Promotion Service
+
+An ASGI application that serves the core of the promotion REST API of
+service.routes (CRUD, activation and filtered lists) using an async SQLAlchemy
+engine, so a single worker can hold many requests in flight while they wait on
+Postgres. Validation, deserialization and marshalling reuse the Promotion
+model and the flask-restx schemas of the WSGI service, which must have been
+initialized by create_app() first.
+
+Everything else, like HEAD, counts, stats, suggestions, lookups, batches,
+Idempotency-Key, X-Profile, compression, rate limiting, read replicas, the
+entity cache and sharding, only exists in the Flask app,
+so those requests are passed to the fallback app, normally the Flask app
+behind a WSGI adapter. Writes are passed to it too: the session hooks of the
+Flask app keep the active promotion summary and the entity caches in step
+with them, so the async write handlers only serve when there is no fallback.
+"""
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+from flask_restx import marshal
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+
+from service.models import Promotion, PromotionArchive, DataValidationError, merge_by_rank
+from service.common import replicas, shards, status
+from service.common.json_representation import dumps
+from service.common.singleflight import AsyncSingleFlight, flight_key
+
+logger = logging.getLogger("flask.app")
+
+# Async drivers to use for each database backend
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+PROMOTION_ID = r"(?P<promotion_id>\d+)"
+ROUTES = [
+    ("GET", r"/api/health", "health"),
+    ("GET", r"/api/promotions", "list_promotions"),
+    ("POST", r"/api/promotions", "create_promotion"),
+    ("GET", rf"/api/promotions/{PROMOTION_ID}", "get_promotion"),
+    ("PUT", rf"/api/promotions/{PROMOTION_ID}", "update_promotion"),
+    ("DELETE", rf"/api/promotions/{PROMOTION_ID}", "delete_promotion"),
+    ("PUT", rf"/api/promotions/activate/{PROMOTION_ID}", "activate_promotion"),
+    ("PUT", rf"/api/promotions/deactivate/{PROMOTION_ID}", "deactivate_promotion"),
+]
+FILTER_ARGS = ("datetime", "promotion_scope", "promotion_type", "q")
+# Query arguments of the list that the async handlers understand
+LIST_ARGS = FILTER_ARGS + ("active", "include_archived")
+# Headers that ask for behavior only the Flask app has
+WSGI_HEADERS = (b"idempotency-key", b"x-profile")
+
+
+def async_database_uri(database_uri):
+    """Returns the database URI with the async driver for its backend"""
+    url = make_url(database_uri)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    return url.set(drivername=driver) if driver else url
+
+
+class Request:
+    """The parts of an ASGI HTTP request the handlers need"""
+
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        self.query = {key: values[0] for key, values in parse_qs(scope.get("query_string", b"").decode()).items()}
+        self.body = body
+        self.scheme = scope.get("scheme", "http")
+
+    def json(self):
+        """Returns the JSON body, aborting with 415 if it is not JSON"""
+        if not self.headers.get("content-type", "").startswith("application/json"):
+            raise AsyncAbort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/json")
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError as error:
+            raise AsyncAbort(status.HTTP_400_BAD_REQUEST, "The browser sent a request with invalid JSON") from error
+
+    def url_for(self, path):
+        """Returns an external URL for a path on this server"""
+        return f"{self.scheme}://{self.headers.get('host', 'localhost')}{path}"
+
+
+class AsyncAbort(Exception):
+    """Aborts a request with a status code and message"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class AsyncPromotionApp:  # pylint: disable=too-many-instance-attributes
+    """ASGI application for the promotion REST API
+
+    Args:
+        config (dict): the Flask configuration, normally app.config from create_app()
+        fallback (ASGI app): serves the requests the async handlers do not, or None to answer 404/405
+    """
+
+    def __init__(self, config, fallback=None):
+        # pylint: disable=import-outside-toplevel
+        from service.routes import create_model, update_model, promotion_model
+
+        self.create_model = create_model
+        self.update_model = update_model
+        self.promotion_model = promotion_model
+        url = async_database_uri(config["SQLALCHEMY_DATABASE_URI"])
+        # aiosqlite does not pool connections so the pool sizing does not apply
+        options = {} if url.get_backend_name() == "sqlite" else config.get("ASYNC_ENGINE_OPTIONS", {})
+        self.engine = create_async_engine(url, **options)
+        self.session = async_sessionmaker(self.engine, expire_on_commit=False, autoflush=False)
+        self.flights = AsyncSingleFlight() if config.get("SINGLE_FLIGHT_ENABLED") else None
+        self.routes = [(method, re.compile(rf"{pattern}/?$"), name) for method, pattern, name in ROUTES]
+        self.fallback = fallback
+        # The rate limits are enforced by the hooks of the Flask app, so it has to see every
+        # request, and only the Flask app knows which shard holds a promotion
+        binds = config.get("SQLALCHEMY_BINDS") or {}
+        self.fallback_all = any(rate > 0 for rate, _ in (config.get("RATE_LIMITS") or {}).values()) or any(
+            key.startswith(shards.BIND_PREFIX) for key in binds
+        )
+        # The reads that only the Flask app spreads over the replicas or answers from the entity cache
+        self.fallback_reads = set()
+        if any(key.startswith(replicas.BIND_PREFIX) for key in binds):
+            self.fallback_reads = {"list_promotions", "get_promotion"}
+        elif config.get("ENTITY_CACHE_ENABLED"):
+            self.fallback_reads = {"get_promotion"}
+        # Only the Flask app compresses the responses
+        self.fallback_headers = WSGI_HEADERS + ((b"accept-encoding",) if config.get("COMPRESSION_ENCODINGS") else ())
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if self.fallback and not self.handles(scope):
+            await self.fallback(scope, receive, send)
+            return
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+        code, payload, headers = await self.dispatch(Request(scope, body))
+        content = b"" if code == status.HTTP_204_NO_CONTENT else dumps(payload)
+        raw_headers = [(b"content-type", b"application/json"), (b"content-length", str(len(content)).encode())]
+        raw_headers += [(key.lower().encode(), value.encode()) for key, value in headers.items()]
+        await send({"type": "http.response.start", "status": code, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": content})
+
+    async def lifespan(self, receive, send):
+        """Handles the ASGI lifespan protocol, disposing of the engine on shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def handles(self, scope):
+        """Returns True if the async handlers serve a request the same way the Flask app would"""
+        if self.fallback_all or any(key.lower() in self.fallback_headers for key, _ in scope["headers"]):
+            return False
+        handler, _ = self.match(scope["method"], scope["path"])
+        if handler is None or scope["method"] != "GET" or handler.__name__ in self.fallback_reads:
+            return False
+        if handler.__name__ == "list_promotions":
+            query = parse_qs(scope.get("query_string", b"").decode())
+            return all(key in LIST_ARGS for key in query)
+        return True
+
+    async def dispatch(self, request):
+        """Routes a request to its handler and converts errors into responses"""
+        handler, params = self.match(request.method, request.path)
+        try:
+            if handler is None:
+                raise AsyncAbort(params, "The requested URL was not found on the server.")
+            result = await handler(request, **params)
+        except AsyncAbort as error:
+            logger.warning(error.message)
+            return error.code, {"message": error.message}, {}
+        except DataValidationError as error:
+            logger.warning(str(error))
+            return status.HTTP_400_BAD_REQUEST, {
+                "status_code": status.HTTP_400_BAD_REQUEST,
+                "error": "Bad Request",
+                "message": str(error),
+            }, {}
+        except HTTPException as error:
+            return error.code, getattr(error, "data", None) or {"message": error.description}, {}
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Unexpected error handling %s %s", request.method, request.path)
+            return status.HTTP_500_INTERNAL_SERVER_ERROR, {"message": "Internal Server Error"}, {}
+        if len(result) == 2:
+            return result[0], result[1], {}
+        return result
+
+    def match(self, method, path):
+        """Returns the (handler, params) for a request, or (None, status) if there is none"""
+        code = status.HTTP_404_NOT_FOUND
+        for route_method, pattern, name in self.routes:
+            found = pattern.match(path)
+            if found and route_method == method:
+                params = {key: int(value) for key, value in found.groupdict().items()}
+                return getattr(self, name), params
+            if found:
+                code = status.HTTP_405_METHOD_NOT_ALLOWED
+        return None, code
+
+    ######################################################################
+    #  H A N D L E R S
+    ######################################################################
+
+    async def health(self, _request):
+        """GET /api/health"""
+        return status.HTTP_200_OK, {"status": 200, "message": "Healthy"}
+
+    async def list_promotions(self, request):
+        """GET /api/promotions"""
+        filters = {key: request.query.get(key) for key in FILTER_ARGS}
+        for key in ("promotion_scope", "promotion_type"):
+            if filters[key] is not None:
+                filters[key] = filters[key].split(",")
+        if "active" in request.query:
+            filters["active"] = request.query["active"].lower() in ("true", "1", "yes")
+        filters["include_archived"] = request.query.get("include_archived", "").lower() in ("true", "1", "yes")
+        if not self.flights:
+            return status.HTTP_200_OK, await self.query_promotions(filters)
+        # Identical queries that arrive while one is running share its result
+        return status.HTTP_200_OK, await self.flights.do(flight_key(filters), lambda: self.query_promotions(filters))
+
+    async def query_promotions(self, filters):
+        """Returns the marshalled promotions that match the filters of a list request"""
+        async with self.session() as session:
+            if filters["include_archived"] and filters.get("q"):
+                # The archived matches take their place among the others by rank
+                ranked = []
+                for model in (Promotion, PromotionArchive):
+                    statement = model.apply_filters(filters, select(model, model.search_rank(filters["q"])))
+                    ranked.append([tuple(row) for row in await session.execute(statement)])
+                promotions = merge_by_rank(*ranked)
+            else:
+                promotions = (await session.scalars(Promotion.apply_filters(filters, select(Promotion)))).all()
+                if filters["include_archived"]:
+                    statement = PromotionArchive.apply_filters(filters, select(PromotionArchive))
+                    promotions += (await session.scalars(statement)).all()
+        return marshal([promotion.serialize() for promotion in promotions], self.promotion_model)
+
+    async def get_promotion(self, _request, promotion_id):
+        """GET /api/promotions/{promotion_id}"""
+        async with self.session() as session:
+            promotion = await self.find_or_404(session, promotion_id)
+        return status.HTTP_200_OK, marshal(promotion.serialize(), self.promotion_model)
+
+    async def create_promotion(self, request):
+        """POST /api/promotions"""
+        data = request.json()
+        self.create_model.validate(data)
+        promotion = Promotion().deserialize(data)
+        promotion.promotion_id = None
+        async with self.session() as session:
+            session.add(promotion)
+            await self.commit(session)
+        location_url = request.url_for(f"/api/promotions/{promotion.promotion_id}")
+        return status.HTTP_201_CREATED, marshal(promotion.serialize(), self.promotion_model), {"Location": location_url}
+
+    async def update_promotion(self, request, promotion_id):
+        """PUT /api/promotions/{promotion_id}"""
+        async with self.session() as session:
+            promotion = await self.find_or_404(session, promotion_id)
+            promotion.deserialize(request.json())
+            await self.commit(session)
+        return status.HTTP_200_OK, marshal(promotion.serialize(), self.promotion_model)
+
+    async def delete_promotion(self, _request, promotion_id):
+        """DELETE /api/promotions/{promotion_id}"""
+        async with self.session() as session:
+            promotion = await session.get(Promotion, promotion_id)
+            if promotion:
+                await session.delete(promotion)
+                await self.commit(session)
+        return status.HTTP_204_NO_CONTENT, {}
+
+    async def activate_promotion(self, _request, promotion_id):
+        """PUT /api/promotions/activate/{promotion_id}"""
+        return await self.set_active(promotion_id, True)
+
+    async def deactivate_promotion(self, _request, promotion_id):
+        """PUT /api/promotions/deactivate/{promotion_id}"""
+        return await self.set_active(promotion_id, False)
+
+    ######################################################################
+    #  U T I L   M E T H O D S
+    ######################################################################
+
+    async def set_active(self, promotion_id, active):
+        """Sets the active flag of a promotion"""
+        async with self.session() as session:
+            promotion = await self.find_or_404(session, promotion_id)
+            promotion.active = active
+            await self.commit(session)
+        return status.HTTP_200_OK, marshal(promotion.serialize(), self.promotion_model)
+
+    @staticmethod
+    async def find_or_404(session, promotion_id):
+        """Returns the promotion with the id or aborts with 404"""
+        promotion = await session.get(Promotion, promotion_id)
+        if not promotion:
+            raise AsyncAbort(status.HTTP_404_NOT_FOUND, f"Promotion with id: {promotion_id} not found")
+        return promotion
+
+    @staticmethod
+    async def commit(session):
+        """Commits the session, raising DataValidationError like the model methods do"""
+        try:
+            await session.commit()
+        except Exception as error:
+            await session.rollback()
+            logger.error("Error saving record: %s", error)
+            raise DataValidationError(error) from error
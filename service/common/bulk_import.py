@@ -0,0 +1,266 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Import
+
+This module loads promotions from CSV or NDJSON files for flask
+import-promotions. Batches of rows are validated in a process pool with the
+rules of Promotion.deserialize while earlier batches are loaded with COPY
+FROM STDIN, one transaction per batch. Rows that fail go to an error file
+with the reason instead of stopping the import.
+"""
+import collections
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from service.common.export import Throughput
+from service.common.json_representation import dumps
+from service.models import DataValidationError, Promotion, PromotionData
+
+FORMATS = ("csv", "ndjson")
+
+# The fields a row needs, as in the Create_Promotion model of the REST API
+REQUIRED = (
+    "promotion_name",
+    "promotion_description",
+    "promotion_type",
+    "promotion_scope",
+    "start_date",
+    "end_date",
+    "promotion_value",
+    "created_by",
+)
+
+# The columns of an imported row and the values of the optional ones that are missing
+DEFAULTS = {
+    "promotion_code": None,
+    "modified_by": None,
+    "created_when": None,
+    "modified_when": None,
+    "active": False,
+}
+COLUMNS = REQUIRED + tuple(DEFAULTS)
+
+# The PEP 249 errors of a database that refuses the data of a row, any other error is not about the rows
+REFUSED_ERRORS = ("IntegrityError", "DataError")
+
+BOOLEANS = {"true": True, "1": True, "false": False, "0": False, "": False}
+
+
+def read_rows(stream, fmt):
+    """Yields the (line, row) of a text stream, rows are dicts for CSV and unparsed lines for NDJSON
+
+    The JSON of NDJSON lines is parsed by validate_batch in the worker processes
+
+    Args:
+        stream (TextIO): the file, opened with newline="" for CSV
+        fmt (str): csv or ndjson
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, text in enumerate(stream, start=1):
+        if text.strip():
+            yield line, text.strip()
+
+
+def chunked(items, size):
+    """Yields lists of up to size items"""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def to_float(value):
+    """Returns a number of a CSV or JSON value"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise DataValidationError(f"Invalid promotion_value: {value!r} is not a number")
+    try:
+        return float(value)
+    except ValueError as error:
+        raise DataValidationError(f"Invalid promotion_value: {value!r} is not a number") from error
+
+
+def to_bool(value):
+    """Returns a boolean of a CSV or JSON value, missing is False"""
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in BOOLEANS:
+        return BOOLEANS[value.strip().lower()]
+    raise DataValidationError(f"Invalid active: {value!r} is not a boolean")
+
+
+def to_int(value):
+    """Returns the promotion_id of a CSV or JSON value"""
+    try:
+        if isinstance(value, bool):
+            raise ValueError(value)
+        return int(value)
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid promotion_id: {value!r} is not an integer") from error
+
+
+def validate_row(row, keep_ids, now):
+    """Returns the column values of a row, or raises DataValidationError with the first problem
+
+    Args:
+        row (dict): the fields of a CSV row or a parsed NDJSON line
+        keep_ids (bool): keep the promotion_id of the row instead of allocating one
+        now (datetime): created_when and modified_when of rows without them
+    """
+    if not isinstance(row, dict):
+        raise DataValidationError("Invalid Promotion: the row is not an object")
+    missing = [name for name in REQUIRED if row.get(name) in (None, "")]
+    if missing:
+        raise DataValidationError(f"Invalid Promotion: missing {', '.join(missing)}")
+    row = dict(row, promotion_value=to_float(row["promotion_value"]), active=to_bool(row.get("active")))
+    # Promotion.serialize writes a missing modified_by as "None"
+    if row.get("modified_by") == "None":
+        row["modified_by"] = None
+    values = PromotionData.parse(row).as_dict()
+    columns = {name: values.get(name, row[name] if name in REQUIRED else DEFAULTS[name]) for name in COLUMNS}
+    columns["created_when"] = columns["created_when"] or now
+    columns["modified_when"] = columns["modified_when"] or now
+    if keep_ids:
+        columns["promotion_id"] = to_int(row.get("promotion_id"))
+    return columns
+
+
+def validate_batch(batch, keep_ids, now):
+    """Validates a batch of (line, row) in a worker process
+
+    Returns the (line, row, columns) of the valid rows and the (line, row, error) of the rest
+    """
+    valid, rejected = [], []
+    for line, row in batch:
+        try:
+            parsed = json.loads(row) if isinstance(row, str) else row
+            valid.append((line, row, validate_row(parsed, keep_ids, now)))
+        except (DataValidationError, ValueError) as error:
+            rejected.append((line, row, str(error)))
+    return valid, rejected
+
+
+def map_batches(func, batches, workers):
+    """Yields func(batch) in order, running up to twice as many batches as workers ahead in a process pool
+
+    Args:
+        func (callable): a picklable function of a batch
+        batches (iterable): the batches, read lazily so memory stays flat
+        workers (int): processes in the pool, 1 runs func in this process
+    """
+    if workers <= 1:
+        yield from map(func, batches)
+        return
+    # Forking would copy the database connections and threads of the app into the workers
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.submit(func, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def refused_rows(error):
+    """Returns True if the DataValidationError of a copy is the database refusing its rows
+
+    A constraint or a value the database does not accept is, a lost
+    connection or a full disk is not
+    """
+    cause = error.__cause__
+    return any(cls.__name__ in REFUSED_ERRORS for cls in type(cause).__mro__)
+
+
+def load_batch(valid):
+    """Copies the valid rows of a batch in one transaction
+
+    If the database refuses the batch every row is copied on its own so only
+    the rows it refuses are rejected. Returns the (line, row, error) of those
+    rows. Other errors stop the import
+    """
+    try:
+        Promotion.copy_rows([columns for _, _, columns in valid])
+        return []
+    except DataValidationError as error:
+        if not refused_rows(error):
+            raise
+    rejected = []
+    for line, row, columns in valid:
+        try:
+            Promotion.copy_rows([columns])
+        except DataValidationError as error:
+            if not refused_rows(error):
+                raise
+            rejected.append((line, row, str(error)))
+    return rejected
+
+
+class RejectedRows:
+    """Writes the rejected rows to an NDJSON file with their line and error, created on the first one
+
+    Args:
+        path (str): the error file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.stream = None
+
+    def write(self, rejected):
+        """Writes a list of (line, row, error)"""
+        for line, row, error in rejected:
+            if self.stream is None:
+                self.stream = open(self.path, "wb")  # pylint: disable=consider-using-with
+            self.stream.write(dumps({"line": line, "error": error, "row": row}) + b"\n")
+            self.count += 1
+
+    def close(self):
+        """Closes the error file if there is one"""
+        if self.stream is not None:
+            self.stream.close()
+
+
+def import_rows(rows, rejected, batch_size, workers, keep_ids, now, progress=None):  # pylint: disable=too-many-arguments
+    """Validates and loads rows of promotions and returns the Throughput of the loaded rows
+
+    Args:
+        rows (iterable): the (line, row) of read_rows
+        rejected (RejectedRows): where the rows that fail go
+        batch_size (int): rows validated and copied together
+        workers (int): validating processes
+        keep_ids (bool): keep the promotion_id of the rows
+        now (datetime): created_when and modified_when of rows without them
+        progress (callable): called with the progress reports
+    """
+    throughput = Throughput(action="Imported")
+    validate = functools.partial(validate_batch, keep_ids=keep_ids, now=now)
+    for valid, invalid in map_batches(validate, chunked(rows, batch_size), workers):
+        refused = load_batch(valid) if valid else []
+        rejected.write(invalid + refused)
+        report = throughput.add(len(valid) - len(refused))
+        if report and progress:
+            progress(f"{report}, rejected {rejected.count}")
+    return throughput
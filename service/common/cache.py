@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+TTL Cache
+
+This module contains a small in-process cache whose entries expire a fixed
+number of seconds after they were stored. Each worker has its own copy.
+"""
+import threading
+import time
+
+from flask import current_app as app
+
+# The caches of the app by name, with the setting that holds their TTL
+CACHE_SETTINGS = {"stats": "STATS_CACHE_SECONDS", "suggest": "SUGGEST_CACHE_SECONDS"}
+
+
+class TTLCache:
+    """Thread-safe cache of values that expire after ttl seconds
+
+    Args:
+        ttl (float): seconds a value is kept, 0 disables the cache
+        max_entries (int): the oldest entries are dropped above this many
+    """
+
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value of key, or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        """Stores a value for ttl seconds"""
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                # Dicts keep insertion order so the first entry is the oldest
+                del self._entries[next(iter(self._entries))]
+
+    def get_or_set(self, key, func):
+        """Returns the cached value of key, storing func() if there is none"""
+        value = self.get(key)
+        if value is None:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+
+
+def init_caches(flask_app):
+    """Creates the caches of the app with the TTLs of its config"""
+    flask_app.extensions["ttl_caches"] = {
+        name: TTLCache(flask_app.config.get(setting, 0)) for name, setting in CACHE_SETTINGS.items()
+    }
+
+
+def current(name):
+    """Returns the cache of the current app with the name"""
+    return app.extensions["ttl_caches"][name]
@@ -16,8 +16,25 @@
 """
 Flask CLI Command Extensions
 """
+from datetime import datetime, timedelta
+
+import os
+
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service import models
+from service.models import db, ActivePromotion, DataValidationError, Promotion, PromotionArchive
+from service.common import bulk_import, entity_cache, jobs, shards
+from service.common import export as exporter
+from service.common import load_test as load
+
+
+def refuse_sharded(command):
+    """Stops a command that only sees the promotion table of the primary when promotions are sharded"""
+    try:
+        models.refuse_sharded(command)
+    except DataValidationError as error:
+        raise click.UsageError(str(error)) from error
 
 
 ######################################################################
@@ -31,6 +48,218 @@ def db_create():
     Recreates a local database. You probably should not use this on
     production. ;-)
     """
-    db.drop_all()
-    db.create_all()
+    db.drop_all(bind_key=None)
+    db.create_all(bind_key=None)
     db.session.commit()
+    add_search_indexes()
+
+
+######################################################################
+# Command to add the full-text search columns to an existing database
+# Usage:
+#   flask create-search-index
+######################################################################
+@app.cli.command("create-search-index")
+def create_search_index():
+    """
+    Adds the search_vector columns, GIN indexes and suggestion indexes the
+    searches need on Postgres, to the primary and any promotion shards
+    """
+    if not add_search_indexes():
+        click.echo("Full-text search indexes need Postgres, searches use ILIKE")
+        return
+    click.echo("Full-text search and suggestion indexes are in place, restart the service to search them")
+
+
+def add_search_indexes():
+    """Adds the search and suggestion indexes of the promotion tables, returns False without Postgres
+
+    This DDL runs from the commands rather than at startup, where it would
+    take locks on the tables while the workers start
+    """
+    tables = [(db.engine, (Promotion, PromotionArchive, ActivePromotion))]
+    shard_set = shards.current()
+    if shard_set:
+        tables += [(engine, (Promotion,)) for engine in shard_set.engines.values()]
+    for engine, table_models in tables:
+        with engine.begin() as conn:
+            for model in table_models:
+                if not models.create_search_index(conn, model.__tablename__):
+                    return False
+            models.create_suggest_index(conn, Promotion.__tablename__)
+    # Running workers search the new columns once they restart
+    models.init_search(app)
+    return True
+
+
+######################################################################
+# Command to generate load against a running instance
+# Usage:
+#   flask load-test --url http://localhost:8080 --workers 8 --rate 200
+######################################################################
+@app.cli.command("load-test")
+@click.option("--url", default="http://localhost:8080", show_default=True, help="Base URL of the service")
+@click.option("--mix", default=load.DEFAULT_MIX, show_default=True, help="Weighted operation mix")
+@click.option("--workers", default=8, show_default=True, help="Number of concurrent workers")
+@click.option("--rate", default=0.0, show_default=True, help="Target requests per second (0 is unthrottled)")
+@click.option("--duration", default=30.0, show_default=True, help="Seconds to run for")
+@click.option("--requests", "max_requests", default=0, show_default=True, help="Stop after N requests (0 is no limit)")
+@click.option("--timeout", default=10.0, show_default=True, help="Per request timeout in seconds")
+def load_test(url, mix, workers, rate, duration, max_requests, timeout):  # pylint: disable=too-many-arguments
+    """
+    Drives a mix of create/get/list/update/activate/delete requests against
+    a running instance and reports throughput and latency percentiles
+    """
+    try:
+        weights = load.parse_mix(mix)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="--mix") from error
+    tester = load.LoadTester(
+        load.http_sender(url, timeout),
+        weights,
+        workers=workers,
+        rate=rate,
+        duration=duration,
+        max_requests=max_requests,
+    )
+    summary = tester.run()
+    click.echo(load.format_report(summary, tester.elapsed))
+
+
+######################################################################
+# Command to move expired promotions into the archive table
+# Usage:
+#   flask archive-promotions --retention-days 365 --batch-size 1000
+######################################################################
+@app.cli.command("archive-promotions")
+@click.option("--retention-days", type=int, default=None, help="Archive promotions that ended this many days ago")
+@click.option("--batch-size", type=int, default=None, help="Promotions moved per transaction")
+def archive_promotions(retention_days, batch_size):
+    """
+    Moves promotions past the retention horizon into the promotion_archive
+    table in batches. Safe to interrupt and run again
+    """
+    refuse_sharded("Archiving")
+    if retention_days is None:
+        retention_days = app.config["ARCHIVE_RETENTION_DAYS"]
+    horizon = datetime.utcnow() - timedelta(days=retention_days)
+    total = 0
+    for moved in Promotion.archive_expired(horizon, batch_size or app.config["ARCHIVE_BATCH_SIZE"]):
+        total += moved
+        click.echo(f"Archived {total} promotions...")
+    click.echo(f"Archived {total} promotions that ended before {horizon.isoformat(timespec='seconds')}")
+
+
+######################################################################
+# Command to export the promotions for analytics
+# Usage:
+#   flask export-promotions --format parquet --output promotions.parquet
+######################################################################
+@app.cli.command("export-promotions")
+@click.option("--format", "fmt", type=click.Choice(sorted(exporter.WRITERS)), default="csv", show_default=True)
+@click.option("--output", type=click.File("wb"), default="-", help="File to write, - for stdout")
+@click.option("--batch-size", type=click.IntRange(min=1), default=1000, show_default=True, help="Rows per fetch")
+@click.option("--datetime", "when", default=None, help="Only promotions valid at this ISO datetime")
+@click.option("--promotion-type", default=None, help="Comma separated promotion types")
+@click.option("--promotion-scope", default=None, help="Comma separated promotion scopes")
+@click.option("--active/--inactive", default=None, help="Only active or inactive promotions")
+@click.option("--q", default=None, help="Words to search for in the names and descriptions")
+def export_promotions(fmt, output, batch_size, **filters):
+    """
+    Streams the promotions that match the filters to CSV, NDJSON or Parquet
+    through a server-side cursor, reporting the throughput on stderr
+    """
+    refuse_sharded("Exporting")
+    filters["datetime"] = filters.pop("when")
+    for key in ("promotion_type", "promotion_scope"):
+        if filters[key]:
+            filters[key] = filters[key].split(",")
+    try:
+        query = Promotion.find_with_filters(filters)
+        writer = exporter.WRITERS[fmt](output)
+    except (DataValidationError, ValueError) as error:
+        raise click.UsageError(str(error)) from error
+    batches = exporter.read_batches(db.session, query, batch_size)
+    throughput = exporter.export(batches, writer, progress=lambda report: click.echo(report, err=True))
+    click.echo(throughput.report(), err=True)
+
+
+######################################################################
+# Command to load promotions from a file
+# Usage:
+#   flask import-promotions promotions.csv --workers 4
+######################################################################
+@app.cli.command("import-promotions")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(bulk_import.FORMATS), default=None, help="Defaults to the file extension")
+@click.option("--batch-size", type=click.IntRange(min=1), default=5000, show_default=True, help="Rows per COPY")
+@click.option("--workers", type=click.IntRange(min=1), default=os.cpu_count() or 1, help="Validating processes")
+@click.option("--errors", default=None, help="File for the rejected rows [default: PATH.rejected.ndjson]")
+@click.option("--keep-ids", is_flag=True, help="Keep the promotion_id of the rows instead of allocating new ones")
+def import_promotions(path, fmt, batch_size, workers, errors, keep_ids):  # pylint: disable=too-many-arguments
+    """
+    Loads promotions from a CSV or NDJSON file, validating the rows in a
+    process pool and copying them in batches. Rejected rows are written to
+    the error file with their line and reason
+    """
+    refuse_sharded("Importing")
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in bulk_import.FORMATS:
+        raise click.BadParameter(f"cannot tell the format of {path}, use csv or ndjson", param_hint="--format")
+    rejected = bulk_import.RejectedRows(errors or f"{path}.rejected.ndjson")
+    with open(path, encoding="utf-8", newline="") as stream:
+        try:
+            throughput = bulk_import.import_rows(
+                bulk_import.read_rows(stream, fmt),
+                rejected,
+                batch_size,
+                workers,
+                keep_ids,
+                datetime.utcnow(),
+                progress=click.echo,
+            )
+        finally:
+            rejected.close()
+    if keep_ids:
+        Promotion.reset_id_sequence()
+    if ActivePromotion.enabled():
+        ActivePromotion.refresh()
+    click.echo(f"{throughput.report()}, rejected {rejected.count}")
+    if rejected.count:
+        click.echo(f"Rejected rows are in {rejected.path}")
+
+
+######################################################################
+# Command to write the warm-start snapshot of the entity cache
+# Usage:
+#   flask write-snapshot --path /var/cache/promotions.snapshot
+######################################################################
+@app.cli.command("write-snapshot")
+@click.option("--path", default=None, help="Snapshot file [default: SNAPSHOT_PATH]")
+def write_snapshot(path):
+    """
+    Writes the active promotions to the snapshot new workers load their
+    entity cache from, e.g. before a deploy
+    """
+    path = path or app.config.get("SNAPSHOT_PATH")
+    if not path:
+        raise click.UsageError("Set SNAPSHOT_PATH or pass --path")
+    count = entity_cache.save_snapshot(path)
+    click.echo(f"Wrote {count} promotions to {path}")
+
+
+######################################################################
+# Command to run the background jobs
+# Usage:
+#   flask run-jobs
+######################################################################
+@app.cli.command("run-jobs")
+def run_jobs():
+    """
+    Runs the background jobs that have an interval configured until
+    interrupted. Start it in every pod, only the holder of the jobs lock runs them
+    """
+    try:
+        jobs.run_jobs(app._get_current_object())
+    except KeyboardInterrupt:
+        click.echo("Stopped the background jobs")
@@ -0,0 +1,194 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module compresses response bodies with gzip, brotli or zstd depending
+on the Accept-Encoding header of the request. Small bodies are sent as they
+are and streamed responses are compressed chunk by chunk.
+"""
+import zlib
+
+from flask import current_app as app
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml", "image/svg+xml")
+
+
+class GzipCompressor:
+    """Streaming gzip compressor"""
+
+    available = True
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data):
+        """Compresses a chunk, buffering output until flush() or finish()"""
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Returns everything compressed so far"""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """Returns the rest of the compressed stream"""
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    """Streaming brotli compressor"""
+
+    available = brotli is not None
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        """Compresses a chunk, buffering output until flush() or finish()"""
+        return self._compressor.process(data)
+
+    def flush(self):
+        """Returns everything compressed so far"""
+        return self._compressor.flush()
+
+    def finish(self):
+        """Returns the rest of the compressed stream"""
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    """Streaming zstd compressor"""
+
+    available = zstandard is not None
+
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        """Compresses a chunk, buffering output until flush() or finish()"""
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Returns everything compressed so far"""
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        """Returns the rest of the compressed stream"""
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+COMPRESSORS = {"gzip": GzipCompressor, "br": BrotliCompressor, "zstd": ZstdCompressor}
+
+
+def init_compression(flask_app):
+    """Install the response compression hook for the configured encodings"""
+    encodings = available_encodings(flask_app.config.get("COMPRESSION_ENCODINGS", []))
+    if not encodings:
+        return
+    flask_app.after_request(compress_response)
+    flask_app.logger.info("Response compression enabled: %s", ", ".join(encodings))
+
+
+def available_encodings(encodings):
+    """Returns the encodings that are known and have their library installed"""
+    return [name for name in encodings if name in COMPRESSORS and COMPRESSORS[name].available]
+
+
+def negotiate(accept_encodings, encodings):
+    """Returns the encoding the client prefers, using the server order for ties
+
+    Args:
+        accept_encodings (werkzeug.datastructures.Accept): the parsed Accept-Encoding header
+        encodings (list): the encodings the server supports in order of preference
+    """
+    best, best_quality = None, 0
+    for name in encodings:
+        quality = accept_encodings.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def compressible(response):
+    """Returns True if the response may be compressed"""
+    return (
+        request.method != "HEAD"
+        and 200 <= response.status_code < 300
+        and response.status_code not in (204, 206)
+        and not response.direct_passthrough
+        and "Content-Encoding" not in response.headers
+        and (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+    )
+
+
+def compress_response(response):
+    """Compresses the body with the best encoding the client accepts"""
+    if not compressible(response):
+        return response
+    length = response.content_length
+    if length is not None and length < app.config.get("COMPRESSION_MIN_SIZE", 0):
+        return response
+
+    # Caches must keep the encodings apart even if this client gets identity
+    response.vary.add("Accept-Encoding")
+    encodings = available_encodings(app.config["COMPRESSION_ENCODINGS"])
+    encoding = negotiate(request.accept_encodings, encodings)
+    if encoding is None:
+        return response
+
+    compressor = COMPRESSORS[encoding](app.config["COMPRESSION_LEVELS"][encoding])
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), compressor, response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.headers["Content-Encoding"] = encoding
+
+    # The compressed body is no longer byte for byte what a strong ETag names
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_stream(chunks, compressor, source=None):
+    """Compresses and flushes each chunk so streamed output is sent as it is produced
+
+    Args:
+        chunks (iterable): the encoded body chunks
+        compressor: a compressor from COMPRESSORS
+        source (iterable, optional): the original body, closed when the stream ends
+    """
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        if hasattr(source, "close"):
+            source.close()
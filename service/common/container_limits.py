@@ -0,0 +1,119 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Container Limits
+
+This module reads the CPU and memory limits of the container from cgroups
+(v2 and v1) and derives the gunicorn worker settings from them.
+Used by gunicorn.conf.py.
+"""
+import math
+import os
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+MB = 1024 * 1024
+
+# Memory reserved for the gunicorn master and an estimate of each worker's footprint
+MASTER_MEMORY_MB = 32
+WORKER_MEMORY_MB = 48
+
+# cgroup v1 reports "no limit" as a huge number rather than "max"
+UNLIMITED_MEMORY = 1 << 60
+
+
+def _read(path):
+    """Returns the stripped contents of a file or None if it cannot be read"""
+    try:
+        with open(path, encoding="utf-8") as cgroup_file:
+            return cgroup_file.read().strip()
+    except OSError:
+        return None
+
+
+def host_cpu_count():
+    """Returns the number of CPUs this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        return os.cpu_count() or 1
+
+
+def cpu_limit(root=CGROUP_ROOT):
+    """Returns the CPU quota of the container as a fraction of CPUs
+
+    Falls back to the number of host CPUs if no quota is set
+    """
+    cpu_max = _read(os.path.join(root, "cpu.max"))
+    if cpu_max:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max":
+            return int(quota) / int(period or 100000)
+        return float(host_cpu_count())
+
+    quota = _read(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+    period = _read(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return float(host_cpu_count())
+
+
+def memory_limit(root=CGROUP_ROOT):
+    """Returns the memory limit of the container in bytes, or None if unlimited"""
+    memory_max = _read(os.path.join(root, "memory.max"))
+    if memory_max is None:
+        memory_max = _read(os.path.join(root, "memory", "memory.limit_in_bytes"))
+    if not memory_max or memory_max == "max" or int(memory_max) >= UNLIMITED_MEMORY:
+        return None
+    return int(memory_max)
+
+
+def worker_settings(cpus, memory_bytes, env=None):
+    """Derives the gunicorn workers, threads and worker class from the limits
+
+    Uses the (2 x CPUs) + 1 rule of thumb, capped by how many workers fit in
+    the memory limit. Requests spend most of their time waiting on Postgres so
+    each worker gets threads (gthread) to overlap that I/O. WEB_CONCURRENCY,
+    GUNICORN_THREADS and GUNICORN_WORKER_CLASS override the derived values.
+
+    Args:
+        cpus (float): CPU quota of the container
+        memory_bytes (int): memory limit of the container or None if unlimited
+        env (dict, optional): environment to read overrides from. Defaults to os.environ
+    """
+    env = os.environ if env is None else env
+    workers = max(1, math.floor(2 * cpus + 1))
+    if memory_bytes:
+        fits = (memory_bytes // MB - MASTER_MEMORY_MB) // WORKER_MEMORY_MB
+        workers = max(1, min(workers, fits))
+    threads = max(2, min(8, math.ceil(4 * cpus)))
+
+    workers = int(env.get("WEB_CONCURRENCY", workers))
+    threads = int(env.get("GUNICORN_THREADS", threads))
+    worker_class = env.get("GUNICORN_WORKER_CLASS", "gthread" if threads > 1 else "sync")
+    return {"workers": workers, "threads": threads, "worker_class": worker_class}
+
+
+def dispose_engines(app):
+    """Drops the database connections a forked worker inherited from the master
+
+    The pooled connections are not closed since the master still owns them
+    """
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
@@ -0,0 +1,227 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Entity Cache
+
+This module keeps the serialized promotions returned by GET
+/api/promotions/<id> in a per-worker cache. Workers start warm from the
+snapshot of the active promotions written by the write-snapshot job, then
+each worker reconciles its cache with the database in the background by
+the modified_when watermark. Writes made by a worker drop their promotions
+from its own cache as soon as they commit.
+"""
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+
+from service.common import snapshot
+from service.common.jobs import PeriodicJob
+
+logger = logging.getLogger("flask.app")
+
+# Changes that commit up to this long after their modified_when are still reconciled
+RECONCILE_OVERLAP = timedelta(seconds=5)
+
+# Cached ids checked for deleted promotions per query
+EXISTS_BATCH_SIZE = 1000
+
+
+class EntityCache:
+    """Thread-safe cache of serialized promotions by promotion_id
+
+    Args:
+        max_entries (int): the oldest entries are dropped above this many
+        reconcile_interval (float): seconds between reconciles with the database
+        sweep_interval (float): seconds between checks that the cached promotions still exist
+    """
+
+    def __init__(self, max_entries=100000, reconcile_interval=5.0, sweep_interval=300.0):
+        self.max_entries = max_entries
+        self.reconcile_interval = reconcile_interval
+        self.sweep_interval = sweep_interval
+        # Every change before the watermark is in the cache
+        self.watermark = datetime.utcnow()
+        # The first reconcile sweeps, a snapshot can hold promotions deleted since
+        self._swept_at = -math.inf
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, promotion_id):
+        """Returns the serialized promotion, or None if it is not cached"""
+        with self._lock:
+            return self._entries.get(promotion_id)
+
+    def get_many(self, promotion_ids):
+        """Returns the cached serialized promotions among promotion_ids by id"""
+        with self._lock:
+            return {
+                promotion_id: self._entries[promotion_id]
+                for promotion_id in promotion_ids
+                if promotion_id in self._entries
+            }
+
+    def put(self, data):
+        """Caches a serialized promotion"""
+        with self._lock:
+            self._set(data)
+
+    def invalidate(self, promotion_ids):
+        """Drops promotions from the cache"""
+        with self._lock:
+            for promotion_id in promotion_ids:
+                self._entries.pop(promotion_id, None)
+
+    def _set(self, data):
+        """Caches a serialized promotion, the caller holds the lock"""
+        self._entries.pop(data["promotion_id"], None)
+        self._entries[data["promotion_id"]] = data
+        while len(self._entries) > self.max_entries:
+            # Dicts keep insertion order so the first entry is the oldest
+            del self._entries[next(iter(self._entries))]
+
+    def load(self, path):
+        """Fills the cache from a snapshot file and returns the number of promotions loaded
+
+        The watermark moves back to the snapshot's so the next reconcile
+        applies everything that changed since it was written
+        """
+        with snapshot.Snapshot(path) as promotions:
+            # Decoded first so a damaged file leaves the cache as it was
+            records = list(promotions)
+        with self._lock:
+            for data in records:
+                self._set(data)
+            self.watermark = promotions.watermark
+        return len(records)
+
+    def reconcile(self):
+        """Applies the promotions modified since the watermark and drops the deleted ones
+
+        Changes are found by modified_when and deletes by their tombstones.
+        A tombstone that was never written, or purged before a snapshot was
+        loaded, is caught by checking the cached ids for existence every
+        sweep_interval. Runs in an application context. Returns the number
+        of promotions updated and dropped
+        """
+        # pylint: disable=import-outside-toplevel
+        from service.models import Promotion, PromotionTombstone
+
+        started = datetime.utcnow()
+        since = self.watermark - RECONCILE_OVERLAP
+        changed = [promotion.serialize() for promotion in Promotion.modified_since(since)]
+        # Looked up after the changes, so a promotion deleted in between is still dropped
+        deleted = PromotionTombstone.deleted_since(since)
+        if time.monotonic() - self._swept_at >= self.sweep_interval:
+            deleted.update(self._deleted())
+        with self._lock:
+            for data in changed:
+                self._set(data)
+            # Most tombstones are of promotions this worker never cached
+            dropped = sum(self._entries.pop(promotion_id, None) is not None for promotion_id in deleted)
+            self.watermark = started
+        if changed or dropped:
+            logger.info("Reconciled the entity cache: %d updated, %d dropped", len(changed), dropped)
+        return len(changed), dropped
+
+    def _deleted(self):
+        """Returns the cached ids that are no longer in the database"""
+        from service.models import Promotion  # pylint: disable=import-outside-toplevel
+
+        self._swept_at = time.monotonic()
+        with self._lock:
+            cached = list(self._entries)
+        existing = set()
+        for start in range(0, len(cached), EXISTS_BATCH_SIZE):
+            existing |= Promotion.existing_ids(cached[start:start + EXISTS_BATCH_SIZE])
+        return [promotion_id for promotion_id in cached if promotion_id not in existing]
+
+    def start(self, flask_app):
+        """Starts the reconciling thread of this process
+
+        Workers fork with the cache of the preloaded master but not its
+        threads, so each process starts its own on its first request
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        PeriodicJob(flask_app, "reconcile-entity-cache", self.reconcile_interval, self.reconcile).start()
+
+
+def current():
+    """Returns the entity cache of the application, or None if it is disabled"""
+    return app.extensions.get("entity_cache")
+
+
+def start_reconciler():
+    """Starts the reconciling thread of this process before its first request"""
+    app.extensions["entity_cache"].start(app._get_current_object())
+
+
+def save_snapshot(path):
+    """Writes the active promotions that have not ended to a snapshot file
+
+    Runs in an application context. Returns the number of promotions written
+    """
+    from service.models import Promotion  # pylint: disable=import-outside-toplevel
+
+    now = datetime.utcnow()
+    records = (promotion.serialize() for promotion in Promotion.find_active(now).yield_per(1000))
+    count = snapshot.write_snapshot(path, records, now)
+    logger.info("Wrote %d promotions to the snapshot %s", count, path)
+    return count
+
+
+def save_snapshot_on_exit(flask_app):
+    """Writes the snapshot for the workers of the next deploy when the server stops"""
+    path = flask_app.config.get("SNAPSHOT_PATH")
+    if not path:
+        return
+    with flask_app.app_context():
+        try:
+            save_snapshot(path)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not write the snapshot %s", path)
+
+
+def init_entity_cache(flask_app):
+    """Creates the entity cache, warm from the snapshot file if there is one"""
+    if not flask_app.config.get("ENTITY_CACHE_ENABLED"):
+        return
+    cache = EntityCache(
+        flask_app.config.get("ENTITY_CACHE_MAX_ENTRIES", 100000),
+        flask_app.config.get("ENTITY_CACHE_RECONCILE_SECONDS", 5.0),
+        flask_app.config.get("ENTITY_CACHE_SWEEP_SECONDS", 300.0),
+    )
+    path = flask_app.config.get("SNAPSHOT_PATH")
+    if path and os.path.exists(path):
+        try:
+            loaded = cache.load(path)
+            flask_app.logger.info("Loaded %d promotions from the snapshot %s", loaded, path)
+        except (OSError, ValueError) as error:
+            flask_app.logger.warning("Starting with a cold entity cache: %s", error)
+    flask_app.extensions["entity_cache"] = cache
+    flask_app.before_request(start_reconciler)
@@ -0,0 +1,199 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Export
+
+This module writes promotions to CSV, NDJSON or Parquet for flask
+export-promotions. The promotions are read in batches through a server-side
+cursor and written as they arrive, so memory stays flat however large the
+table is. Parquet needs pyarrow (poetry install --extras export).
+"""
+import csv
+import io
+import time
+
+from service.common.json_representation import dumps
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+# The columns of an export, in the order of Promotion.serialize
+COLUMNS = (
+    "promotion_id",
+    "promotion_name",
+    "promotion_description",
+    "promotion_type",
+    "promotion_scope",
+    "start_date",
+    "end_date",
+    "promotion_value",
+    "promotion_code",
+    "created_by",
+    "modified_by",
+    "created_when",
+    "modified_when",
+    "active",
+)
+
+
+def read_batches(session, query, batch_size):
+    """Yields lists of up to batch_size promotions of a query read through a server-side cursor
+
+    Args:
+        session (Session): the session to read with
+        query (Query): the promotions to read, e.g. from Promotion.find_with_filters
+        batch_size (int): promotions fetched per round trip
+    """
+    result = session.execute(query.statement.execution_options(yield_per=batch_size))
+    yield from result.scalars().partitions()
+
+
+class CsvWriter:
+    """Writes promotions as CSV with a header row, in the format of the REST API"""
+
+    def __init__(self, stream):
+        self.text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+        self.writer = csv.DictWriter(self.text, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, promotions):
+        """Writes a batch of promotions"""
+        self.writer.writerows(promotion.serialize() for promotion in promotions)
+
+    def close(self):
+        """Flushes the rows and leaves the stream open"""
+        self.text.flush()
+        self.text.detach()
+
+
+class NdjsonWriter:
+    """Writes promotions as one JSON object per line, in the format of the REST API"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, promotions):
+        """Writes a batch of promotions"""
+        self.stream.write(b"".join(dumps(promotion.serialize()) + b"\n" for promotion in promotions))
+
+    def close(self):
+        """Flushes the rows and leaves the stream open"""
+        self.stream.flush()
+
+
+class ParquetWriter:
+    """Writes promotions as Parquet with typed columns, one row group per batch"""
+
+    def __init__(self, stream):
+        if pyarrow is None:
+            raise ValueError("Parquet exports need pyarrow (poetry install --extras export)")
+        timestamp = pyarrow.timestamp("us")
+        self.schema = pyarrow.schema(
+            [
+                ("promotion_id", pyarrow.int64()),
+                ("promotion_name", pyarrow.string()),
+                ("promotion_description", pyarrow.string()),
+                ("promotion_type", pyarrow.string()),
+                ("promotion_scope", pyarrow.string()),
+                ("start_date", timestamp),
+                ("end_date", timestamp),
+                ("promotion_value", pyarrow.float64()),
+                ("promotion_code", pyarrow.string()),
+                ("created_by", pyarrow.string()),
+                ("modified_by", pyarrow.string()),
+                ("created_when", timestamp),
+                ("modified_when", timestamp),
+                ("active", pyarrow.bool_()),
+            ]
+        )
+        self.writer = parquet.ParquetWriter(stream, self.schema)
+
+    def write(self, promotions):
+        """Writes a batch of promotions as a row group"""
+        columns = {column: [getattr(promotion, column) for promotion in promotions] for column in COLUMNS}
+        for column in ("promotion_type", "promotion_scope"):
+            columns[column] = [value.name for value in columns[column]]
+        for column in ("created_by", "modified_by"):
+            columns[column] = [str(value) if value is not None else None for value in columns[column]]
+        self.writer.write_table(pyarrow.table(columns, schema=self.schema))
+
+    def close(self):
+        """Writes the Parquet footer"""
+        self.writer.close()
+
+
+WRITERS = {"csv": CsvWriter, "ndjson": NdjsonWriter, "parquet": ParquetWriter}
+
+
+class Throughput:
+    """Counts the processed rows and reports the rate at most every interval seconds
+
+    Args:
+        interval (float): seconds between progress reports
+        action (str): what is done to the rows, e.g. "Exported"
+    """
+
+    def __init__(self, interval=5.0, action="Exported"):
+        self.interval = interval
+        self.action = action
+        self.rows = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    @property
+    def elapsed(self):
+        """Seconds since the rows started"""
+        return time.monotonic() - self.started
+
+    def add(self, rows):
+        """Counts rows and returns a progress report when one is due, otherwise None"""
+        self.rows += rows
+        now = time.monotonic()
+        if now - self.reported < self.interval:
+            return None
+        self.reported = now
+        return self.report()
+
+    def report(self):
+        """Returns the number of rows, the elapsed time and the rate"""
+        elapsed = self.elapsed
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        return f"{self.action} {self.rows} promotions in {elapsed:.1f}s ({rate:.0f} rows/s)"
+
+
+def export(batches, writer, progress=None, interval=5.0):
+    """Writes batches of promotions and returns the Throughput of the export
+
+    Args:
+        batches (iterable): lists of promotions, e.g. from read_batches
+        writer (CsvWriter | NdjsonWriter | ParquetWriter): where the promotions go
+        progress (callable): called with the progress reports
+        interval (float): seconds between progress reports
+    """
+    throughput = Throughput(interval)
+    try:
+        for promotions in batches:
+            writer.write(promotions)
+            report = throughput.add(len(promotions))
+            if report and progress:
+                progress(report)
+    finally:
+        writer.close()
+    return throughput
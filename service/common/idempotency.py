@@ -0,0 +1,102 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Keys
+
+This module lets clients retry writes safely. The response of a request
+sent with an Idempotency-Key header is stored for IDEMPOTENCY_TTL_SECONDS
+and a retry from the same client with the same key and request gets it back
+without the write running again. Keys are scoped to the client, as the rate
+limits identify it, so clients cannot see or block each other's keys.
+"""
+import functools
+import hashlib
+import json
+
+from flask import abort
+from flask import current_app as app
+from flask import request
+from flask_restx.utils import unpack
+
+from service.common import rate_limit, status
+from service.common.json_representation import dumps
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+
+def request_fingerprint():
+    """Returns a digest of the method, path and body of the request"""
+    digest = hashlib.sha256()
+    for part in (request.method.encode(), request.path.encode(), request.get_data()):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def record_key(client, key):
+    """Returns the key of the IdempotencyRecord of a client's Idempotency-Key"""
+    return hashlib.sha256(f"{client}\0{key}".encode()).hexdigest()
+
+
+def idempotent(func):
+    """Decorator making a Resource method replay its response for a repeated Idempotency-Key
+
+    Requests without the header run as usual. The response is only stored
+    when the method returns, a request that raises frees its key. The key of
+    a worker that died before either is only held for IDEMPOTENCY_LEASE_SECONDS
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # pylint: disable=import-outside-toplevel
+        from service.models import DataValidationError, IdempotencyRecord
+
+        key = request.headers.get(HEADER)
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            raise DataValidationError(f"{HEADER} must be at most {MAX_KEY_LENGTH} characters")
+
+        fingerprint = request_fingerprint()
+        record, claimed = IdempotencyRecord.claim(
+            record_key(rate_limit.client_key(), key), fingerprint, app.config.get("IDEMPOTENCY_LEASE_SECONDS", 60)
+        )
+        if not claimed:
+            if record.fingerprint != fingerprint:
+                raise DataValidationError(f"{HEADER} {key} was already used for a different request")
+            if record.status_code is None:
+                abort(status.HTTP_409_CONFLICT, f"A request with {HEADER} {key} is still in progress")
+            app.logger.info("Replaying the response for %s %s", HEADER, key)
+            headers = dict(json.loads(record.headers), **{REPLAYED_HEADER: "true"})
+            return json.loads(record.body), record.status_code, headers
+
+        try:
+            data, code, headers = unpack(func(*args, **kwargs))
+        except Exception:
+            record.release()
+            raise
+        record.complete(
+            int(code),
+            dumps(data).decode("utf-8"),
+            dumps(dict(headers)).decode("utf-8"),
+            app.config.get("IDEMPOTENCY_TTL_SECONDS", 86400),
+        )
+        return data, code, headers
+
+    return wrapper
@@ -0,0 +1,244 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Background Jobs
+
+This module runs the optional maintenance jobs of the service on daemon
+threads of the flask run-jobs process, never in the web server processes:
+threads started before gunicorn forks can leave locks held in the workers.
+Only the process holding the JOBS_LOCK_ID advisory lock runs the jobs, so
+starting run-jobs in every pod still runs one copy of every job.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+
+class AdvisoryLock:
+    """Session level Postgres advisory lock held on a dedicated connection
+
+    Other databases have no advisory locks, there every process is the leader
+
+    Args:
+        engine (Engine): the engine of the primary database
+        key (int): the id of the lock
+    """
+
+    def __init__(self, engine, key):
+        self.engine = engine
+        self.key = key
+        self._conn = None
+
+    def acquire(self):
+        """Returns True if this process holds the lock, trying to take it if not"""
+        if self.engine.dialect.name != "postgresql":
+            return True
+        try:
+            if self._conn is not None:
+                # Still the leader as long as the connection holding the lock is alive
+                self._conn.execute(text("SELECT 1"))
+                return True
+            conn = self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            if conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": self.key}).scalar():
+                self._conn = conn
+                return True
+            conn.close()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Lost the advisory lock %s: %s", self.key, error)
+            self.release()
+        return False
+
+    def release(self):
+        """Releases the lock by closing its connection"""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+
+
+class PeriodicJob(threading.Thread):
+    """Calls a function in an application context every interval seconds
+
+    Args:
+        flask_app (Flask): the application to run the job for
+        name (str): the name of the job used in the logs
+        interval (float): seconds between the end of one run and the next
+        func (function): the job, called without arguments
+    """
+
+    def __init__(self, flask_app, name, interval, func):
+        super().__init__(name=name, daemon=True)
+        self.app = flask_app
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Runs the job once, logging rather than raising any error"""
+        with self.app.app_context():
+            try:
+                self.func()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Job %s failed", self.name)
+
+    def stop(self):
+        """Stops the job after the current run"""
+        self._stopped.set()
+
+
+# The jobs that only work on the promotion table of the primary
+SHARD_UNAWARE_JOBS = ("archive-promotions", "refresh-active-promotions", "promotion-scheduler")
+
+
+def archive_promotions():
+    """Moves the promotions past the retention horizon into the archive"""
+    from service.models import Promotion  # pylint: disable=import-outside-toplevel
+
+    horizon = datetime.utcnow() - timedelta(days=app.config["ARCHIVE_RETENTION_DAYS"])
+    moved = sum(Promotion.archive_expired(horizon, app.config["ARCHIVE_BATCH_SIZE"]))
+    if moved:
+        logger.info("Archived %d promotions that ended before %s", moved, horizon)
+
+
+def refresh_active_promotions():
+    """Rebuilds the active promotion summary"""
+    from service.models import ActivePromotion  # pylint: disable=import-outside-toplevel
+
+    ActivePromotion.refresh()
+
+
+def purge_idempotency_keys():
+    """Deletes the expired idempotency records"""
+    from service.models import IdempotencyRecord  # pylint: disable=import-outside-toplevel
+
+    purged = IdempotencyRecord.purge_expired()
+    if purged:
+        logger.info("Purged %d expired idempotency keys", purged)
+
+
+def purge_tombstones():
+    """Deletes the tombstones of deleted promotions that every entity cache has seen"""
+    from service.models import PromotionTombstone  # pylint: disable=import-outside-toplevel
+
+    before = datetime.utcnow() - timedelta(seconds=app.config["ENTITY_CACHE_TOMBSTONE_SECONDS"])
+    purged = PromotionTombstone.purge(before)
+    if purged:
+        logger.info("Purged %d tombstones of deleted promotions", purged)
+
+
+def write_snapshot():
+    """Writes the warm-start snapshot of the entity cache"""
+    from service.common.entity_cache import save_snapshot  # pylint: disable=import-outside-toplevel
+
+    save_snapshot(app.config["SNAPSHOT_PATH"])
+
+
+def configured_jobs(flask_app):
+    """Returns the jobs that have an interval configured, not started"""
+    jobs = {}
+    if flask_app.config.get("ARCHIVE_INTERVAL_SECONDS", 0) > 0:
+        jobs["archive-promotions"] = PeriodicJob(
+            flask_app, "archive-promotions", flask_app.config["ARCHIVE_INTERVAL_SECONDS"], archive_promotions
+        )
+    if flask_app.config.get("ACTIVE_SUMMARY_REFRESH_SECONDS", 0) > 0:
+        jobs["refresh-active-promotions"] = PeriodicJob(
+            flask_app,
+            "refresh-active-promotions",
+            flask_app.config["ACTIVE_SUMMARY_REFRESH_SECONDS"],
+            refresh_active_promotions,
+        )
+    if flask_app.config.get("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", 0) > 0:
+        jobs["purge-idempotency-keys"] = PeriodicJob(
+            flask_app,
+            "purge-idempotency-keys",
+            flask_app.config["IDEMPOTENCY_PURGE_INTERVAL_SECONDS"],
+            purge_idempotency_keys,
+        )
+    if flask_app.config.get("ENTITY_CACHE_ENABLED") and flask_app.config.get("ENTITY_CACHE_TOMBSTONE_SECONDS", 0) > 0:
+        jobs["purge-tombstones"] = PeriodicJob(
+            flask_app, "purge-tombstones", flask_app.config["ENTITY_CACHE_TOMBSTONE_SECONDS"], purge_tombstones
+        )
+    if flask_app.config.get("SNAPSHOT_PATH") and flask_app.config.get("SNAPSHOT_INTERVAL_SECONDS", 0) > 0:
+        jobs["write-snapshot"] = PeriodicJob(
+            flask_app, "write-snapshot", flask_app.config["SNAPSHOT_INTERVAL_SECONDS"], write_snapshot
+        )
+    from service.common.scheduler import init_scheduler  # pylint: disable=import-outside-toplevel
+
+    init_scheduler(flask_app, jobs)
+    if "shards" in flask_app.extensions:
+        # They read or write the promotion table of the primary, which is empty when promotions are sharded
+        for name in SHARD_UNAWARE_JOBS:
+            if jobs.pop(name, None):
+                flask_app.logger.warning("Not running job %s, it does not support sharded promotions", name)
+    return jobs
+
+
+def run_jobs(flask_app, stopped=None):
+    """Runs the configured jobs until stopped is set, while this process holds the jobs lock
+
+    A process that is not the leader checks the lock every JOBS_LOCK_INTERVAL_SECONDS
+    and starts the jobs when it takes over
+
+    Args:
+        flask_app (Flask): the application to run the jobs for
+        stopped (threading.Event): set to stop the jobs and return
+    """
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    stopped = stopped or threading.Event()
+    if not configured_jobs(flask_app):
+        flask_app.logger.warning("No background jobs are configured")
+        return
+    with flask_app.app_context():
+        lock = AdvisoryLock(db.engine, flask_app.config["JOBS_LOCK_ID"])
+    running = {}
+    try:
+        while True:
+            leader = lock.acquire()
+            if leader and not running:
+                # Threads cannot be restarted, so every term as leader gets new jobs
+                running = configured_jobs(flask_app)
+                for job in running.values():
+                    job.start()
+                    flask_app.logger.info("Started job %s every %ss", job.name, job.interval)
+            elif running and not leader:
+                flask_app.logger.warning("Lost the jobs lock, stopping the jobs")
+                stop_jobs(running)
+                running = {}
+            if stopped.wait(flask_app.config.get("JOBS_LOCK_INTERVAL_SECONDS", 5)):
+                return
+    finally:
+        stop_jobs(running)
+        lock.release()
+
+
+def stop_jobs(jobs):
+    """Stops the jobs and waits for the runs in progress to finish"""
+    for job in jobs.values():
+        job.stop()
+    for job in jobs.values():
+        job.join()
@@ -0,0 +1,105 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+JSON Representation
+
+This module contains the JSON representation registered on the flask-restx
+api. It encodes with orjson when it is installed (poetry install --extras
+speedups) and falls back to the stdlib json encoder otherwise. Both encode
+datetimes and UUIDs as strings and NamedEnum members by name, like
+Promotion.serialize does.
+"""
+import datetime
+import enum
+import json
+import uuid
+
+from flask import current_app, make_response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# RESTX_JSON settings orjson can honour, anything else uses the stdlib encoder
+ORJSON_SETTINGS = {"indent", "sort_keys"}
+# orjson can only indent by 2 spaces, any other indent uses the stdlib encoder
+ORJSON_INDENTS = (None, 0, 2)
+
+
+class NamedEnumType(enum.EnumType):
+    """Metaclass of NamedEnum
+
+    orjson encodes the members of enums whose metaclass is exactly EnumType by
+    value without calling default, so any other metaclass makes it defer to
+    default like the stdlib encoder does
+    """
+
+
+class NamedEnum(enum.Enum, metaclass=NamedEnumType):
+    """An enum whose members are encoded as JSON by name"""
+
+
+def default(value):
+    """Encodes the types the stdlib json encoder does not handle"""
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, enum.Enum):
+        return value.name
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(data, **settings):
+    """Encodes data as UTF-8 JSON bytes
+
+    Args:
+        data: the object to encode
+        settings: json.dumps keyword arguments (e.g. RESTX_JSON)
+    """
+    if orjson is not None and ORJSON_SETTINGS.issuperset(settings) and settings.get("indent") in ORJSON_INDENTS:
+        option = orjson.OPT_NON_STR_KEYS
+        if settings.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        if settings.get("sort_keys"):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=default, option=option)
+    settings.setdefault("default", default)
+    return json.dumps(data, **settings).encode("utf-8")
+
+
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body
+
+    A drop-in replacement for flask_restx.representations.output_json
+    """
+    settings = dict(current_app.config.get("RESTX_JSON", {}))
+
+    # Indent the output in debug mode unless told otherwise
+    if current_app.debug:
+        settings.setdefault("indent", 4)
+
+    # always end the json dumps with a new line
+    resp = make_response(dumps(data, **settings) + b"\n", code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def init_json(api):
+    """Registers the JSON representation on a flask-restx Api"""
+    api.representations["application/json"] = output_json
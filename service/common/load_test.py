@@ -0,0 +1,247 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Load Generator
+
+Drives a weighted mix of promotion operations against a running instance
+with a pool of concurrent workers and an optional target request rate, and
+summarizes throughput and latency percentiles per operation.
+Used by the ``flask load-test`` command.
+"""
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+OPERATIONS = ("create", "get", "list", "update", "activate", "delete")
+DEFAULT_MIX = "create=1,get=5,list=2,update=1,activate=1,delete=1"
+PERCENTILES = (50, 95, 99, 99.9)
+# Reported for the creates that seed the pool when the mix has no create
+SEED = "seed"
+
+
+def parse_mix(mix):
+    """Parses an operation mix such as 'get=5,list=1' into a dict of weights
+
+    Raises:
+        ValueError: if an operation is unknown or a weight is not a non-negative number
+    """
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{name}', expected one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+        if not weights[name] >= 0:
+            raise ValueError(f"The weight of '{name}' must not be negative")
+    if not any(weight > 0 for weight in weights.values()):
+        raise ValueError("The operation mix must contain at least one positive weight")
+    return weights
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def http_sender(base_url, timeout=10.0):
+    """Returns a send(method, path, body) function that talks HTTP to base_url"""
+    base_url = base_url.rstrip("/")
+
+    def send(method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(base_url + path, data=data, method=method)
+        req.add_header("Content-Type", "application/json")
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                return response.status, json.loads(response.read() or "null")
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+    return send
+
+
+def new_promotion(rng):
+    """Returns the body of a promotion to create"""
+    return {
+        "promotion_name": f"load-test-{rng.randrange(1_000_000)}",
+        "promotion_description": "created by flask load-test",
+        "promotion_type": rng.choice(["PERCENTAGE", "ABSOLUTE"]),
+        "promotion_scope": rng.choice(["PRODUCT_ID", "PRODUCT_CATEGORY", "ENTIRE_STORE"]),
+        "start_date": "2025-01-01T00:00:00",
+        "end_date": "2026-01-01T00:00:00",
+        "promotion_value": round(rng.uniform(1, 50), 2),
+        "promotion_code": None,
+        "created_by": str(uuid.UUID(int=rng.getrandbits(128))),
+        "active": False,
+    }
+
+
+class OperationStats:  # pylint: disable=too-few-public-methods
+    """Latencies and error count for one kind of operation"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+
+    def summary(self, elapsed):
+        """Returns a dict with count, throughput and latency percentiles (in ms)"""
+        latencies = sorted(self.latencies)
+        result = {
+            "count": len(latencies),
+            "errors": self.errors,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        }
+        for pct in PERCENTILES:
+            result[f"p{pct:g}"] = percentile(latencies, pct) * 1000
+        return result
+
+
+class LoadTester:  # pylint: disable=too-many-instance-attributes
+    """Runs a weighted mix of operations with N concurrent workers
+
+    Args:
+        send (function): send(method, path, body) returning (status_code, json)
+        mix (dict): weights keyed by operation name
+        workers (int): number of concurrent workers
+        rate (float): target requests per second for all workers, 0 for unthrottled
+        duration (float): seconds to run for
+        max_requests (int): stop after this many requests, 0 for no limit
+    """
+
+    def __init__(self, send, mix, workers=8, rate=0.0, duration=30.0, max_requests=0, seed=None):
+        self.send = send
+        self.operations = list(mix.keys())
+        self.weights = list(mix.values())
+        self.workers = workers
+        self.rate = rate
+        self.duration = duration
+        self.max_requests = max_requests
+        self.rng = random.Random(seed)
+        self.stats = {name: OperationStats() for name in self.operations}
+        self.elapsed = 0.0
+        self._ids = []
+        self._issued = 0
+        self._lock = threading.Lock()
+        self._start = 0.0
+
+    def run(self):
+        """Runs the load test and returns the summary"""
+        self._start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(self._worker) for _ in range(self.workers)]:
+                future.result()
+        self.elapsed = time.perf_counter() - self._start
+        return self.summary()
+
+    def summary(self):
+        """Returns per operation statistics plus a 'total' entry"""
+        total = OperationStats()
+        result = {}
+        for name, stats in self.stats.items():
+            result[name] = stats.summary(self.elapsed)
+            total.latencies.extend(stats.latencies)
+            total.errors += stats.errors
+        result["total"] = total.summary(self.elapsed)
+        return result
+
+    def _next_ticket(self):
+        """Reserves the next request, returning (operation, scheduled_time) or None when done"""
+        with self._lock:
+            if self.max_requests and self._issued >= self.max_requests:
+                return None
+            scheduled = self._start + self._issued / self.rate if self.rate else time.perf_counter()
+            if scheduled - self._start >= self.duration:
+                return None
+            self._issued += 1
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            return operation, scheduled
+
+    def _worker(self):
+        while True:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            operation, scheduled = ticket
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self._execute(operation)
+
+    def _pick_id(self, remove=False):
+        with self._lock:
+            if not self._ids:
+                return None
+            index = self.rng.randrange(len(self._ids))
+            return self._ids.pop(index) if remove else self._ids[index]
+
+    def _request_for(self, operation):
+        """Returns the (method, path, body) for an operation"""
+        if operation == "list":
+            return "GET", "/api/promotions", None
+        if operation != "create":
+            promotion_id = self._pick_id(remove=operation == "delete")
+            if promotion_id is not None:
+                paths = {
+                    "get": ("GET", f"/api/promotions/{promotion_id}", None),
+                    "update": ("PUT", f"/api/promotions/{promotion_id}", {"promotion_value": 10.0}),
+                    "activate": ("PUT", f"/api/promotions/activate/{promotion_id}", None),
+                    "delete": ("DELETE", f"/api/promotions/{promotion_id}", None),
+                }
+                return paths[operation]
+        # Nothing to operate on yet, so seed the pool with a new promotion
+        return "POST", "/api/promotions", new_promotion(self.rng)
+
+    def _execute(self, operation):
+        method, path, body = self._request_for(operation)
+        if method == "POST" and operation != "create":
+            # Keep the seeding creates out of the latencies of the operation that needed them
+            operation = "create" if "create" in self.stats else SEED
+        started = time.perf_counter()
+        try:
+            status_code, payload = self.send(method, path, body)
+        except OSError:
+            status_code, payload = None, None
+        latency = time.perf_counter() - started
+        with self._lock:
+            stats = self.stats.setdefault(operation, OperationStats())
+            if status_code is None or status_code >= 400:
+                stats.errors += 1
+                return
+            stats.latencies.append(latency)
+            if method == "POST" and payload:
+                self._ids.append(payload["promotion_id"])
+
+
+def format_report(summary, elapsed):
+    """Formats a summary from LoadTester.run as a text table"""
+    header = f"{'operation':<10} {'count':>8} {'errors':>7} {'req/s':>9}"
+    header += "".join(f" {'p' + format(pct, 'g'):>9}" for pct in PERCENTILES)
+    lines = [f"Ran for {elapsed:.1f}s (latencies in ms)", header, "-" * len(header)]
+    for name, stats in summary.items():
+        line = f"{name:<10} {stats['count']:>8} {stats['errors']:>7} {stats['throughput']:>9.1f}"
+        line += "".join(f" {stats[f'p{pct:g}']:>9.2f}" for pct in PERCENTILES)
+        lines.append(line)
+    return "\n".join(lines)
@@ -0,0 +1,62 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Planner Statistics
+
+This module reads the row estimates of the Postgres planner so large counts
+can be answered without scanning the table: pg_class.reltuples for a whole
+table and the EXPLAIN estimate for a filtered query. Other databases have
+no estimates and get None.
+"""
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+TABLE_ROWS = text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)")
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement, compiled with the statement's bound parameters"""
+
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kwargs):
+    """Renders the EXPLAIN for Postgres"""
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kwargs)
+
+
+def estimate_rows(session, query):
+    """Returns the planner's estimate of the rows of a query, or None without one
+
+    Args:
+        session (Session): the session to run the estimate on
+        query (Query): the query to estimate, unfiltered queries use the table statistics
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return None
+    if query.whereclause is None:
+        table = query.column_descriptions[0]["entity"].__table__.name
+        rows = session.execute(TABLE_ROWS, {"table": table}).scalar()
+        # -1 until the table is analyzed for the first time
+        return rows if rows is not None and rows >= 0 else None
+    plan = session.execute(Explain(query.statement)).scalar()
+    return int(plan[0]["Plan"]["Plan Rows"])
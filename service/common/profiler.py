@@ -0,0 +1,81 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Profiler
+
+This module contains an opt-in profiler that captures a cProfile of a
+single request. It is only installed when PROFILE_SECRET is configured,
+and then only requests sending a matching X-Profile header are profiled.
+"""
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import time
+
+from flask import current_app as app
+from flask import g, request
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+
+def init_profiling(flask_app):
+    """Install the per-request profiling hooks if a secret is configured"""
+    if not flask_app.config.get("PROFILE_SECRET"):
+        return
+    flask_app.before_request(start_profile)
+    flask_app.after_request(stop_profile)
+    flask_app.logger.info("Per-request profiling enabled via %s header", PROFILE_HEADER)
+
+
+def start_profile():
+    """Starts a profiler if the request carries the profiling secret"""
+    token = request.headers.get(PROFILE_HEADER)
+    # compare_digest only takes ASCII strings, so compare the bytes of any header value
+    if not token or not hmac.compare_digest(token.encode(), app.config["PROFILE_SECRET"].encode()):
+        return
+    profile = cProfile.Profile()
+    g.profile = profile
+    profile.enable()
+
+
+def stop_profile(response):
+    """Stops the profiler and stores or returns the captured stats"""
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    profile.disable()
+
+    profile_dir = app.config.get("PROFILE_DIR")
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        endpoint = (request.endpoint or "unknown").replace("/", "_")
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{request.method}-{endpoint}-{os.getpid()}-{id(profile)}.prof"
+        profile.dump_stats(os.path.join(profile_dir, filename))
+        app.logger.info("Request profile written to %s", filename)
+        response.headers[PROFILE_FILE_HEADER] = filename
+        return response
+
+    # No directory configured so hand the report back instead of the payload
+    report = io.StringIO()
+    stats = pstats.Stats(profile, stream=report)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(app.config.get("PROFILE_LIMIT", 40))
+    response.set_data(report.getvalue())
+    response.mimetype = "text/plain"
+    return response
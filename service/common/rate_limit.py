@@ -0,0 +1,222 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rate Limiting
+
+This module limits the requests of each client (its API key if it is one of
+RATE_LIMIT_API_KEYS, else its IP address, taken from X-Forwarded-For behind
+TRUSTED_PROXIES proxies) with token buckets. Reads, writes and bulk endpoints have separate budgets
+and a client over its budget gets 429 Too Many Requests with Retry-After.
+The buckets live in each worker, or in a SQLite file the workers of a pod
+share when RATE_LIMIT_STORE is a path.
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app as app
+from flask import jsonify, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from service.common import status
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def refill(tokens, updated, now, rate, burst):
+    """Returns the tokens of a bucket after refilling it at rate per second up to burst"""
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def spend(tokens, rate):
+    """Takes a token from a bucket
+
+    Returns the tokens left and the seconds to wait for the next one,
+    which is 0 if the token was taken
+    """
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class LocalStore:
+    """Token buckets kept in the memory of this worker
+
+    Args:
+        max_keys (int): the least recently used bucket is dropped above this many
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket of key, returning the seconds to wait if it is empty"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, wait = spend(refill(tokens, updated, now, rate, burst), rate)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                # Idle the longest, so the most likely to have refilled anyway
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SqliteStore:
+    """Token buckets in a SQLite file shared by the workers on one host
+
+    Every prune_interval seconds the buckets that refilled completely are
+    deleted, then the least recently used ones above max_keys
+
+    Args:
+        path (str): the database file, created if it does not exist
+        max_keys (int): the number of buckets kept after a prune
+        prune_interval (float): seconds between prunes by this process
+    """
+
+    def __init__(self, path, max_keys=10000, prune_interval=60):
+        self.path = path
+        self.max_keys = max_keys
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        self._local = threading.local()
+        with self._connect() as conn:
+            # Each bucket keeps its budget so a prune refills it at its own rate
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets "
+                "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, rate REAL, burst REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_token_buckets_updated ON token_buckets (updated)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        """Takes a token from the bucket of key, returning the seconds to wait if it is empty"""
+        now = time.time()
+        conn = self._connect()
+        # BEGIN IMMEDIATE serializes the read-modify-write of the workers
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM token_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row or (burst, now)
+            tokens, wait = spend(refill(tokens, updated, now, rate, burst), rate)
+            conn.execute(
+                "INSERT OR REPLACE INTO token_buckets (key, tokens, updated, rate, burst) VALUES (?, ?, ?, ?, ?)",
+                (key, tokens, now, rate, burst),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if now - self._pruned_at >= self.prune_interval:
+            self._pruned_at = now
+            self.prune(now)
+        return wait
+
+    def prune(self, now):
+        """Deletes the buckets that refilled, then the least recently used ones above max_keys"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM token_buckets WHERE tokens + (? - updated) * rate >= burst", (now,))
+            conn.execute(
+                "DELETE FROM token_buckets WHERE key IN "
+                "(SELECT key FROM token_buckets ORDER BY updated DESC LIMIT -1 OFFSET ?)",
+                (self.max_keys,),
+            )
+
+
+def budget(name):
+    """Decorator choosing the budget of a view or Resource method, None exempts it"""
+
+    def decorator(func):
+        func.rate_limit_budget = name
+        return func
+
+    return decorator
+
+
+def request_budget():
+    """Returns the name of the budget the current request spends"""
+    view = app.view_functions.get(request.endpoint)
+    handler = getattr(getattr(view, "view_class", None), request.method.lower(), view)
+    if hasattr(handler, "rate_limit_budget"):
+        return handler.rate_limit_budget
+    return "read" if request.method in SAFE_METHODS else "write"
+
+
+def client_key():
+    """Returns the API key of the client, or its IP address if it did not send a known one
+
+    Only the keys in RATE_LIMIT_API_KEYS are trusted, otherwise a client could
+    send a new value with every request to get a full bucket
+    """
+    api_key = request.headers.get(app.config.get("RATE_LIMIT_KEY_HEADER", "X-API-Key"))
+    if api_key and api_key in app.config.get("RATE_LIMIT_API_KEYS", ()):
+        return f"key:{api_key}"
+    return f"ip:{request.remote_addr}"
+
+
+def init_proxies(flask_app):
+    """Takes the client address from X-Forwarded-For when the app runs behind TRUSTED_PROXIES proxies
+
+    Otherwise every client behind the ingress has its address and so shares its buckets
+    """
+    proxies = flask_app.config.get("TRUSTED_PROXIES", 0)
+    if proxies > 0:
+        flask_app.wsgi_app = ProxyFix(flask_app.wsgi_app, x_for=proxies)
+        flask_app.logger.info("Trusting X-Forwarded-For from %d proxies", proxies)
+
+
+def init_rate_limits(flask_app):
+    """Install the rate limiting hook if any budget has a rate"""
+    limits = flask_app.config.get("RATE_LIMITS") or {}
+    if not any(rate > 0 for rate, _ in limits.values()):
+        return
+    location = flask_app.config.get("RATE_LIMIT_STORE", "memory")
+    max_keys = flask_app.config.get("RATE_LIMIT_MAX_KEYS", 10000)
+    flask_app.extensions["rate_limits"] = LocalStore(max_keys) if location == "memory" else SqliteStore(location, max_keys)
+    flask_app.before_request(limit_request)
+    flask_app.logger.info("Rate limiting enabled with the %s store", location)
+
+
+def limit_request():
+    """Answers 429 Too Many Requests when the client has spent its budget"""
+    name = request_budget()
+    rate, burst = app.config["RATE_LIMITS"].get(name, (0, 0))
+    if rate <= 0:
+        return None
+    wait = app.extensions["rate_limits"].take(f"{name}:{client_key()}", rate, burst)
+    if not wait:
+        return None
+    app.logger.warning("Rate limited %s on its %s budget", client_key(), name)
+    response = jsonify(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        error="Too Many Requests",
+        message=f"Rate limit of {rate:g} {name} requests per second exceeded",
+    )
+    response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    response.headers["Retry-After"] = str(math.ceil(wait))
+    return response
@@ -0,0 +1,205 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read Replicas
+
+This module routes the SELECTs of read-only requests to read replicas that
+are configured as SQLALCHEMY_BINDS named replica_<n>. Replicas are picked
+round-robin, skipping any that fail their health check or lag too far
+behind, and a client that just wrote keeps reading from the primary for
+a short window so it sees its own writes.
+"""
+import itertools
+import logging
+import math
+import threading
+import time
+
+from flask import current_app as app
+from flask import request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import text
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+logger = logging.getLogger("flask.app")
+
+BIND_PREFIX = "replica_"
+SESSION_KEY = "replica"
+STICKY_COOKIE = "read_primary_until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Seconds a Postgres standby is behind, 0 when it has replayed all it received
+POSTGRES_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs to the replica chosen for the request
+
+    Flushes and everything else use the primary. A query that fails on the
+    replica marks it down and is retried on the primary. Sessions created
+    with a bind, like those of the promotion shards, only use it
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            # The sessions of a promotion shard only use its engine
+            return self.bind
+        replica = self.info.get(SESSION_KEY)
+        if replica and bind is None and not self._flushing and getattr(clause, "is_select", False):
+            return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def execute(self, statement, *args, **kwargs):  # pylint: disable=arguments-differ
+        replica = self.info.get(SESSION_KEY)
+        try:
+            return super().execute(statement, *args, **kwargs)
+        except (OperationalError, InterfaceError) as error:
+            if not replica:
+                raise
+            logger.warning("Replica %s failed, reading from the primary: %s", replica, error)
+            app.extensions["replicas"].mark_down(replica)
+            self.info.pop(SESSION_KEY, None)
+            self.rollback()
+            return super().execute(statement, *args, **kwargs)
+
+
+class ReplicaPool:
+    """Round-robin over the replicas that pass their health check
+
+    Args:
+        names (list): the bind keys of the replicas
+        check (function): returns the lag of a replica in seconds, raises if it is down
+        interval (float): seconds between checks of a replica
+        max_lag (float): replicas lagging more than this many seconds are skipped
+    """
+
+    def __init__(self, names, check, interval, max_lag):
+        self.names = list(names)
+        self.check = check
+        self.interval = interval
+        self.max_lag = max_lag
+        self._cycle = itertools.cycle(self.names)
+        self._checked_at = {}
+        self._healthy = {}
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """Returns the next healthy replica or None to use the primary"""
+        for _ in self.names:
+            with self._lock:
+                name = next(self._cycle)
+            if self.healthy(name):
+                return name
+        return None
+
+    def healthy(self, name):
+        """Returns True if the replica passed its last check, checking it again if that is stale"""
+        now = time.monotonic()
+        with self._lock:
+            stale = now - self._checked_at.get(name, -math.inf) >= self.interval
+            if stale:
+                # Claim the check so concurrent requests keep the last result meanwhile
+                self._checked_at[name] = now
+        if stale:
+            self._healthy[name] = self._check(name)
+        return self._healthy.get(name, False)
+
+    def mark_down(self, name):
+        """Skips a replica until its next check"""
+        with self._lock:
+            self._healthy[name] = False
+            self._checked_at[name] = time.monotonic()
+
+    def _check(self, name):
+        try:
+            lag = self.check(name)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Replica %s is down: %s", name, error)
+            return False
+        if lag > self.max_lag:
+            logger.warning("Replica %s is %.1fs behind, using the primary", name, lag)
+            return False
+        return True
+
+
+def replica_lag(engine):
+    """Returns how many seconds a replica is behind the primary"""
+    with engine.connect() as conn:
+        if engine.dialect.name != "postgresql":
+            conn.execute(text("SELECT 1"))
+            return 0.0
+        return float(conn.execute(POSTGRES_LAG).scalar() or 0)
+
+
+def init_replicas(flask_app):
+    """Install the read routing hooks if any replicas are configured"""
+    names = [key for key in flask_app.config.get("SQLALCHEMY_BINDS") or {} if key.startswith(BIND_PREFIX)]
+    if not names:
+        return
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    flask_app.extensions["replicas"] = ReplicaPool(
+        names,
+        lambda name: replica_lag(db.engines[name]),
+        flask_app.config.get("REPLICA_CHECK_INTERVAL", 5),
+        flask_app.config.get("REPLICA_MAX_LAG_SECONDS", 10),
+    )
+    flask_app.before_request(route_reads)
+    flask_app.after_request(track_writes)
+    flask_app.logger.info("Routing reads to %d replica(s)", len(names))
+
+
+def reads_own_writes():
+    """Returns True if the client wrote recently and must read from the primary"""
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def route_reads():
+    """Picks a replica for the SELECTs of a read-only request"""
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    replica = None
+    if request.method in SAFE_METHODS and not reads_own_writes():
+        replica = app.extensions["replicas"].choose()
+    if replica:
+        db.session.info[SESSION_KEY] = replica
+    else:
+        db.session.info.pop(SESSION_KEY, None)
+
+
+def current_replica():
+    """Returns the replica the SELECTs of this request go to, or None for the primary"""
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    return db.session.info.get(SESSION_KEY)
+
+
+def track_writes(response):
+    """Keeps a client that wrote on the primary for REPLICA_STICKY_SECONDS"""
+    window = app.config.get("REPLICA_STICKY_SECONDS", 0)
+    if request.method not in SAFE_METHODS and response.status_code < 400 and window > 0:
+        response.set_cookie(
+            STICKY_COOKIE, f"{time.time() + window:.3f}", max_age=math.ceil(window), httponly=True, samesite="Lax"
+        )
+    return response
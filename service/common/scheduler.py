@@ -0,0 +1,142 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Scheduler
+
+This module activates promotions at their start_date and deactivates them
+at their end_date. The upcoming boundaries are loaded into a min-heap every
+SCHEDULER_INTERVAL_SECONDS and the scheduler sleeps until the earliest one,
+then applies all that are due with batched UPDATEs. A Postgres advisory
+lock elects one leader so only one replica runs the transitions.
+"""
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from service.common.jobs import AdvisoryLock, PeriodicJob
+
+logger = logging.getLogger("flask.app")
+
+
+class PromotionScheduler(PeriodicJob):
+    """Applies the start and end transitions of the promotions when they are due
+
+    Args:
+        flask_app (Flask): the application to run the scheduler for
+        interval (float): seconds between reloads of the upcoming transitions
+        lock (AdvisoryLock): decides which process runs the transitions
+        catchup (float): seconds of missed transitions applied on becoming the leader
+        batch_size (int): the number of promotions updated per transaction
+    """
+
+    def __init__(self, flask_app, interval, lock, catchup=3600, batch_size=500):
+        super().__init__(flask_app, "promotion-scheduler", interval, self.tick)
+        self.lock = lock
+        self.catchup = timedelta(seconds=catchup)
+        self.batch_size = batch_size
+        self.leader = False
+        self._heap = []
+        self._fired = set()
+        self._since = None
+        self._next_reload = None
+
+    def run(self):
+        delay = 0
+        while not self._stopped.wait(delay):
+            self.run_once()
+            delay = self.delay()
+        self.lock.release()
+
+    def delay(self):
+        """Returns the seconds until the next transition or reload"""
+        if not self.leader:
+            return self.interval
+        wake = self._next_reload
+        if self._heap:
+            wake = min(wake, self._heap[0][0])
+        return min(max((wake - datetime.utcnow()).total_seconds(), 0), self.interval)
+
+    def tick(self):
+        """Reloads the transitions when needed and applies the ones that are due"""
+        if not self.lock.acquire():
+            if self.leader:
+                logger.info("Promotion scheduler is no longer the leader")
+            self.leader = False
+            self._heap = []
+            return
+        now = datetime.utcnow()
+        if not self.leader:
+            logger.info("Promotion scheduler is the leader")
+            self.leader = True
+            self._since = now - self.catchup
+            self._fired = set()
+            self.reload(now)
+        elif now >= self._next_reload:
+            self.reload(now)
+        self.apply(self.pop_due(now))
+
+    def reload(self, now):
+        """Loads the transitions since the last reload up to two intervals ahead
+
+        The window overlaps the previous one so promotions created or changed
+        since then are picked up, transitions that already fired are skipped
+        """
+        from service.models import Promotion  # pylint: disable=import-outside-toplevel
+
+        until = now + timedelta(seconds=2 * self.interval)
+        self._heap = [item for item in Promotion.transitions(self._since, until) if item not in self._fired]
+        heapq.heapify(self._heap)
+        self._fired = set()
+        self._since = now
+        self._next_reload = now + timedelta(seconds=self.interval)
+
+    def pop_due(self, now):
+        """Pops the transitions due by now, returning the final state of each promotion"""
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            item = heapq.heappop(self._heap)
+            self._fired.add(item)
+            due[item[1]] = item[2]
+        return due
+
+    def apply(self, due):
+        """Activates and deactivates the promotions with one UPDATE per batch"""
+        from service.models import Promotion  # pylint: disable=import-outside-toplevel
+
+        for active in (True, False):
+            promotion_ids = [promotion_id for promotion_id, state in due.items() if state is active]
+            if promotion_ids:
+                changed = Promotion.set_active_many(promotion_ids, active, self.batch_size)
+                logger.info("%s %d promotions", "Activated" if active else "Deactivated", changed)
+
+
+def init_scheduler(flask_app, jobs):
+    """Adds the promotion scheduler to the jobs if SCHEDULER_INTERVAL_SECONDS is set"""
+    interval = flask_app.config.get("SCHEDULER_INTERVAL_SECONDS", 0)
+    if interval <= 0:
+        return
+    from service.models import db  # pylint: disable=import-outside-toplevel
+
+    with flask_app.app_context():
+        engine = db.engine
+    jobs["promotion-scheduler"] = PromotionScheduler(
+        flask_app,
+        interval,
+        AdvisoryLock(engine, flask_app.config["SCHEDULER_LOCK_ID"]),
+        flask_app.config["SCHEDULER_CATCHUP_SECONDS"],
+        flask_app.config["SCHEDULER_BATCH_SIZE"],
+    )
@@ -0,0 +1,225 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Shards
+
+This module spreads the promotion table across the databases configured as
+SQLALCHEMY_BINDS named shard_<n>. A promotion lives on the shard picked by a
+hash of its promotion_id, which is handed out before the insert from blocks
+of ids reserved in the primary database so ids stay unique across shards.
+Lookups by id go to one shard; other queries run on every shard in parallel
+and their ordered results are merged.
+"""
+import heapq
+import itertools
+import logging
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app as app
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from service.common.replicas import RoutingSession
+
+logger = logging.getLogger("flask.app")
+
+BIND_PREFIX = "shard_"
+
+
+class IdAllocator:
+    """Hands out ids from blocks reserved with a shared sequence
+
+    Args:
+        reserve (function): reserves the next block_size ids and returns the first
+        block_size (int): ids reserved per round trip to the sequence
+    """
+
+    def __init__(self, reserve, block_size):
+        self.reserve = reserve
+        self.block_size = block_size
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        """Returns an id no other process has been given"""
+        with self._lock:
+            if self._next == self._end:
+                self._next = self.reserve(self.block_size)
+                self._end = self._next + self.block_size
+            self._next += 1
+            return self._next - 1
+
+
+class ShardSet:
+    """The engines of the shards and a session per shard for each thread
+
+    Args:
+        db (SQLAlchemy): the extension whose sessions are used on the shards
+        engines (dict): the engine of each shard by bind key, in shard order
+        allocator (IdAllocator): hands out the ids of new promotions
+    """
+
+    def __init__(self, db, engines, allocator):
+        self.names = list(engines)
+        self.engines = engines
+        self.allocator = allocator
+        self._factories = {
+            name: sessionmaker(class_=RoutingSession, db=db, bind=engine, autoflush=False)
+            for name, engine in engines.items()
+        }
+        self._sessions = {name: scoped_session(factory) for name, factory in self._factories.items()}
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def shard_for(self, promotion_id):
+        """Returns the shard that holds a promotion"""
+        digest = zlib.crc32(int(promotion_id).to_bytes(8, "big", signed=True))
+        return self.names[digest % len(self.names)]
+
+    def session(self, promotion_id):
+        """Returns the session of this thread on the shard that holds a promotion"""
+        return self._sessions[self.shard_for(promotion_id)]
+
+    def next_id(self):
+        """Returns the id of a new promotion"""
+        return self.allocator.next_id()
+
+    def map(self, func):
+        """Calls func(session) on every shard in parallel and returns the results in shard order
+
+        Each call gets a session of its own that is closed when it returns,
+        so the objects in the results are detached
+        """
+
+        def run(name):
+            with self._factories[name]() as session:
+                return func(session)
+
+        return list(self._executor().map(run, self.names))
+
+    def query(self, build):
+        """Returns the query build(session) makes, run on every shard and merged"""
+        return ShardedQuery(self, build)
+
+    def remove(self, _=None):
+        """Closes the sessions of this thread at the end of the app context"""
+        for session in self._sessions.values():
+            session.remove()
+
+    def _executor(self):
+        """Returns the thread pool of this process
+
+        Workers fork without the threads of the preloaded master, so each
+        process starts a pool of its own
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(len(self.names), thread_name_prefix="shard")
+                self._pid = os.getpid()
+            return self._pool
+
+
+class ShardedQuery:
+    """A query run on every shard in parallel with the rows merged in order
+
+    Args:
+        shard_set (ShardSet): the shards to query
+        build (function): returns the query of a session as (entity, *sort key)
+            rows in ascending sort key order
+    """
+
+    def __init__(self, shard_set, build, limit=None, offset=0, batch_size=None):
+        self.shard_set = shard_set
+        self.build = build
+        self._limit = limit
+        self._offset = offset
+        self._batch_size = batch_size
+
+    def limit(self, limit):
+        """Returns the query with at most limit rows"""
+        return ShardedQuery(self.shard_set, self.build, limit, self._offset, self._batch_size)
+
+    def offset(self, offset):
+        """Returns the query without its first offset rows"""
+        return ShardedQuery(self.shard_set, self.build, self._limit, offset, self._batch_size)
+
+    def yield_per(self, batch_size):
+        """Returns the query reading the rows of each shard batch_size at a time"""
+        return ShardedQuery(self.shard_set, self.build, self._limit, self._offset, batch_size)
+
+    def all(self):
+        """Returns the entities of the merged rows"""
+        return [row[0] for row in self.rows()]
+
+    def rows(self):
+        """Returns the merged rows as (entity, *sort key)
+
+        A page only needs its first offset + limit rows from each shard
+        """
+        stop = None if self._limit is None else self._offset + self._limit
+
+        def rows(session):
+            query = self.build(session)
+            if stop is not None:
+                query = query.limit(stop)
+            if self._batch_size:
+                query = query.yield_per(self._batch_size)
+            return query.all()
+
+        merged = heapq.merge(*self.shard_set.map(rows), key=lambda row: tuple(row[1:]))
+        return list(itertools.islice(merged, self._offset, stop))
+
+    def count(self):
+        """Returns the number of rows on all of the shards"""
+        return sum(self.shard_set.map(lambda session: self.build(session).order_by(None).count()))
+
+    def __iter__(self):
+        return iter(self.all())
+
+
+def current():
+    """Returns the shards of the application, or None if promotions are not sharded"""
+    return app.extensions.get("shards")
+
+
+def init_shards(flask_app):
+    """Creates the promotion table on the shards if any are configured
+
+    Raises DataValidationError if the number of shards changed
+    """
+    binds = flask_app.config.get("SQLALCHEMY_BINDS") or {}
+    names = sorted((key for key in binds if key.startswith(BIND_PREFIX)), key=lambda key: int(key[len(BIND_PREFIX):]))
+    if not names:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service.models import db, IdSequence, Promotion, ShardLayout
+
+    # The promotions were placed by the number of shards when they were written
+    ShardLayout.check(Promotion.__tablename__, len(names))
+    engines = {name: db.engines[name] for name in names}
+    for engine in engines.values():
+        Promotion.__table__.create(engine, checkfirst=True)
+    allocator = IdAllocator(
+        lambda size: IdSequence.reserve(Promotion.__tablename__, size),
+        flask_app.config.get("SHARD_ID_BLOCK_SIZE", 100),
+    )
+    flask_app.extensions["shards"] = ShardSet(db, engines, allocator)
+    flask_app.teardown_appcontext(flask_app.extensions["shards"].remove)
+    flask_app.logger.info("Sharding promotions across %d databases", len(names))
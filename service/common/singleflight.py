@@ -0,0 +1,101 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Single Flight
+
+This module coalesces concurrent identical calls within a worker: the first
+caller runs the function and the callers that arrive while it is running
+wait for its result instead of running it again. Callers share the result,
+so it must not be changed by any of them.
+"""
+import asyncio
+import threading
+
+
+def flight_key(filters):
+    """Returns a hashable key of query filters that ignores their order and unset values"""
+    items = [
+        (name, tuple(sorted(value)) if isinstance(value, list) else value)
+        for name, value in filters.items()
+        if value is not None
+    ]
+    return tuple(sorted(items))
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """A call in flight and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key across threads"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns func() for the first caller of key and the same result for the callers that join it
+
+        Args:
+            key (hashable): identifies calls that return the same result
+            func (function): the call, without arguments
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func()
+            except Exception as error:  # pylint: disable=broad-except
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    """Coalesces concurrent calls with the same key within an event loop"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """Returns await func() for the first caller of key and the same result for the callers that join it
+
+        Args:
+            key (hashable): identifies calls that return the same result
+            func (function): a coroutine function, without arguments
+        """
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # A caller that is cancelled must not cancel the call the others wait for
+        return await asyncio.shield(future)
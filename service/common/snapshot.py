@@ -0,0 +1,121 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Promotion Snapshots
+
+This module reads and writes the warm-start snapshot of the entity cache: a
+header with the number of promotions and the watermark they are current to,
+followed by a length-prefixed JSON record per promotion. Snapshots are
+written to a temporary file and renamed into place, so readers never see a
+partial one, and read through a read-only memory map.
+"""
+import json
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta
+
+from service.common.json_representation import dumps
+
+MAGIC = b"PSNP"
+VERSION = 1
+
+# magic, version, number of records, watermark in microseconds since the epoch
+HEADER = struct.Struct("<4sHxxIq")
+# length of the JSON record that follows
+RECORD = struct.Struct("<I")
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def write_snapshot(path, records, watermark):
+    """Writes serialized promotions to a snapshot file atomically and returns their number
+
+    Args:
+        path (str): the snapshot file
+        records (iterable): the serialized promotions, read once
+        watermark (datetime): every change before this is in the records
+    """
+    count = 0
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as stream:
+            stream.write(HEADER.pack(MAGIC, VERSION, 0, (watermark - EPOCH) // MICROSECOND))
+            for record in records:
+                body = dumps(record)
+                stream.write(RECORD.pack(len(body)))
+                stream.write(body)
+                count += 1
+            stream.seek(0)
+            stream.write(HEADER.pack(MAGIC, VERSION, count, (watermark - EPOCH) // MICROSECOND))
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return count
+
+
+class Snapshot:
+    """A snapshot file mapped into memory
+
+    Args:
+        path (str): the snapshot file
+
+    Raises:
+        ValueError: if the file is not a snapshot of this version
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as stream:
+            self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise ValueError(f"{path} is not a promotion snapshot")
+        magic, version, self.count, watermark = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a version {VERSION} promotion snapshot")
+        self.watermark = EPOCH + watermark * MICROSECOND
+
+    def __iter__(self):
+        """Yields the serialized promotions
+
+        Raises:
+            ValueError: if the file ends before its last record
+        """
+        offset = HEADER.size
+        for _ in range(self.count):
+            if offset + RECORD.size > len(self.map):
+                raise ValueError("The promotion snapshot is truncated")
+            (length,) = RECORD.unpack_from(self.map, offset)
+            offset += RECORD.size
+            if offset + length > len(self.map):
+                raise ValueError("The promotion snapshot is truncated")
+            yield json.loads(self.map[offset:offset + length])
+            offset += length
+
+    def close(self):
+        """Unmaps the file"""
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -15,6 +15,134 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# Optional read replicas (comma separated URIs). Reads of GET requests go to a
+# healthy replica, round-robin, unless the client wrote within the sticky window
+DATABASE_REPLICA_URIS = [uri for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri]
+SQLALCHEMY_BINDS = {f"replica_{index}": uri for index, uri in enumerate(DATABASE_REPLICA_URIS)}
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "5"))
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "10"))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+
+# Optional shards of the promotion table (comma separated URIs). Promotions are
+# spread across them by a hash of promotion_id and every other table stays on
+# the primary, which hands out the ids of new promotions SHARD_ID_BLOCK_SIZE at a time
+DATABASE_SHARD_URIS = [uri for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri]
+SQLALCHEMY_BINDS.update({f"shard_{index}": uri for index, uri in enumerate(DATABASE_SHARD_URIS)})
+SHARD_ID_BLOCK_SIZE = int(os.getenv("SHARD_ID_BLOCK_SIZE", "100"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
+
+# Per-request profiling is only installed when a secret is configured.
+# Requests must send the secret in the X-Profile header to be profiled and
+# the profile is written to PROFILE_DIR, or returned as text if it is unset
+PROFILE_SECRET = os.getenv("PROFILE_SECRET")
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+PROFILE_LIMIT = int(os.getenv("PROFILE_LIMIT", "40"))
+
+# Connection pool of the async engine used by the ASGI entry point (asgi.py)
+ASYNC_ENGINE_OPTIONS = {
+    "pool_size": int(os.getenv("ASYNC_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("ASYNC_MAX_OVERFLOW", "20")),
+}
+
+# Response compression negotiated via Accept-Encoding. Encodings are tried in
+# this order (br and zstd need the compression extra) and only bodies of at
+# least COMPRESSION_MIN_SIZE bytes are compressed. Lower levels use less CPU
+COMPRESSION_ENCODINGS = [name for name in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",") if name]
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_LEVELS = {
+    "gzip": int(os.getenv("COMPRESSION_GZIP_LEVEL", "5")),
+    "br": int(os.getenv("COMPRESSION_BR_LEVEL", "4")),
+    "zstd": int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3")),
+}
+
+# The background jobs below run in the flask run-jobs process. Only the process
+# holding the JOBS_LOCK_ID advisory lock runs them, the others check it every
+# JOBS_LOCK_INTERVAL_SECONDS to take over
+JOBS_LOCK_ID = int(os.getenv("JOBS_LOCK_ID", "820240035"))
+JOBS_LOCK_INTERVAL_SECONDS = float(os.getenv("JOBS_LOCK_INTERVAL_SECONDS", "5"))
+
+# Promotions that ended more than ARCHIVE_RETENTION_DAYS ago are moved to the
+# promotion_archive table by flask archive-promotions, or by a background job
+# every ARCHIVE_INTERVAL_SECONDS if that is set
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "365"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "0"))
+
+# Summary table of the active promotions, refreshed every ACTIVE_SUMMARY_REFRESH_SECONDS
+# and after each write. GET /api/promotions?active=true&datetime=<now>&max_staleness=<s>
+# reads from it when it was refreshed within max_staleness seconds
+ACTIVE_SUMMARY_REFRESH_SECONDS = float(os.getenv("ACTIVE_SUMMARY_REFRESH_SECONDS", "0"))
+ACTIVE_SUMMARY_NOW_TOLERANCE = float(os.getenv("ACTIVE_SUMMARY_NOW_TOLERANCE", "60"))
+
+# Promotions are activated at their start_date and deactivated at their end_date
+# by a scheduler that reloads the upcoming boundaries every SCHEDULER_INTERVAL_SECONDS
+# if that is set. Only the replica holding the SCHEDULER_LOCK_ID advisory lock runs it
+SCHEDULER_INTERVAL_SECONDS = float(os.getenv("SCHEDULER_INTERVAL_SECONDS", "0"))
+SCHEDULER_CATCHUP_SECONDS = float(os.getenv("SCHEDULER_CATCHUP_SECONDS", "3600"))
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "500"))
+SCHEDULER_LOCK_ID = int(os.getenv("SCHEDULER_LOCK_ID", "820240037"))
+
+# Token bucket rate limits per client as (requests per second, burst) for each
+# budget; a rate of 0 is unlimited. A client is its RATE_LIMIT_KEY_HEADER if that
+# is one of the comma separated RATE_LIMIT_API_KEYS, otherwise its IP address.
+# RATE_LIMIT_STORE is "memory" for per-worker buckets or the path of a SQLite
+# file to share the buckets between the workers of a pod, either keeping about
+# RATE_LIMIT_MAX_KEYS buckets
+RATE_LIMITS = {
+    "read": (float(os.getenv("RATE_LIMIT_READ_PER_SECOND", "0")), float(os.getenv("RATE_LIMIT_READ_BURST", "40"))),
+    "write": (float(os.getenv("RATE_LIMIT_WRITE_PER_SECOND", "0")), float(os.getenv("RATE_LIMIT_WRITE_BURST", "10"))),
+    "bulk": (float(os.getenv("RATE_LIMIT_BULK_PER_SECOND", "0")), float(os.getenv("RATE_LIMIT_BULK_BURST", "2"))),
+}
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+RATE_LIMIT_API_KEYS = {key.strip() for key in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if key.strip()}
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+# Number of proxies in front of the service, like the ingress, whose X-Forwarded-For
+# gives the client address; 0 uses the address of the connection
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+
+# Concurrent identical GET /api/promotions queries of a worker run once and share the result
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() in ("true", "1", "yes")
+
+# Responses of writes sent with an Idempotency-Key header are replayed for retries
+# for IDEMPOTENCY_TTL_SECONDS. A key whose request never finished is free again
+# after IDEMPOTENCY_LEASE_SECONDS, which must be longer than any request takes.
+# Expired keys are purged every IDEMPOTENCY_PURGE_INTERVAL_SECONDS (0 is never)
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "60"))
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", "0"))
+
+# HEAD /api/promotions and count=true answer X-Total-Count; with estimate=true counts
+# of at least COUNT_ESTIMATE_THRESHOLD rows come from the Postgres planner statistics
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", "10000"))
+
+# GET /api/promotions/stats is cached per worker for STATS_CACHE_SECONDS (0 disables the cache)
+STATS_CACHE_SECONDS = float(os.getenv("STATS_CACHE_SECONDS", "30"))
+
+# GET /api/promotions?ids= and POST /api/promotions/lookup return at most LOOKUP_MAX_IDS promotions
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "1000"))
+
+# POST /api/promotions/batch applies at most BATCH_MAX_OPERATIONS operations per request
+BATCH_MAX_OPERATIONS = int(os.getenv("BATCH_MAX_OPERATIONS", "100"))
+
+# GET /api/promotions/suggest returns at most SUGGEST_MAX_LIMIT promotions per prefix
+# and caches the suggestions of each prefix per worker for SUGGEST_CACHE_SECONDS
+SUGGEST_MAX_LIMIT = int(os.getenv("SUGGEST_MAX_LIMIT", "10"))
+SUGGEST_CACHE_SECONDS = float(os.getenv("SUGGEST_CACHE_SECONDS", "10"))
+
+# Per-worker cache of the promotions returned by GET /api/promotions/<id>, reconciled
+# with the database every ENTITY_CACHE_RECONCILE_SECONDS by modified_when and by the
+# tombstones of deleted promotions, which flask run-jobs purges once they are older than
+# ENTITY_CACHE_TOMBSTONE_SECONDS. Every ENTITY_CACHE_SWEEP_SECONDS the cached ids are also
+# checked for existence. Workers start warm from SNAPSHOT_PATH, which flask run-jobs
+# rewrites every SNAPSHOT_INTERVAL_SECONDS and gunicorn writes when it stops
+ENTITY_CACHE_ENABLED = os.getenv("ENTITY_CACHE_ENABLED", "false").lower() == "true"
+ENTITY_CACHE_MAX_ENTRIES = int(os.getenv("ENTITY_CACHE_MAX_ENTRIES", "100000"))
+ENTITY_CACHE_RECONCILE_SECONDS = float(os.getenv("ENTITY_CACHE_RECONCILE_SECONDS", "5"))
+ENTITY_CACHE_SWEEP_SECONDS = float(os.getenv("ENTITY_CACHE_SWEEP_SECONDS", "300"))
+ENTITY_CACHE_TOMBSTONE_SECONDS = float(os.getenv("ENTITY_CACHE_TOMBSTONE_SECONDS", "3600"))
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+SNAPSHOT_INTERVAL_SECONDS = float(os.getenv("SNAPSHOT_INTERVAL_SECONDS", "300"))
@@ -3,28 +3,66 @@ Models for Promotion
 
 All of the models are stored in this module
 """
+# pylint: disable=too-many-lines
 
+import heapq
+import itertools
 import logging
 import enum
+import uuid
 
+from contextlib import contextmanager
 from datetime import datetime as dt
+from datetime import timedelta
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import and_, event
+from sqlalchemy import and_, case, delete, event, func, insert, literal, literal_column, or_, select, text, update
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.visitors import InternalTraversal
 
 
+from service.common import planner, shards
 from service.common.datetime_utils import datetime_from_str, datetime_to_str
+from service.common.json_representation import NamedEnum
+from service.common.replicas import RoutingSession
 
 logger = logging.getLogger("flask.app")
 
+# Days ahead of the upcoming expiry buckets of the promotion statistics
+EXPIRY_BUCKETS = (7, 30, 90)
+
+# Text search configuration of the search_vector columns
+SEARCH_CONFIG = "english"
+
+# Promotion tables whose search_vector column exists on every database that holds them, filled
+# by init_search. A module global because the async app builds its queries outside any app context
+SEARCH_VECTOR_TABLES = set()
+
+# Columns of the promotion table that GET /api/promotions/suggest completes
+SUGGEST_COLUMNS = ("promotion_name", "promotion_code")
+
+# Session.info key of the promotions written in the current transaction
+SUMMARY_KEY = "written_promotions"
+
+# Session.info key of the promotions deleted in the current transaction
+DELETED_KEY = "deleted_promotions"
+
+# Session.info key set while Promotion.batch() defers the commits
+BATCH_KEY = "batch"
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy(session_options={"autoflush": False})
+db = SQLAlchemy(session_options={"autoflush": False, "class_": RoutingSession})
 
 
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
-class PromotionType(enum.Enum):
+class PromotionType(NamedEnum):
     """Used to represent different types of promotions"""
 
     PERCENTAGE = 1
@@ -41,7 +79,7 @@ class PromotionType(enum.Enum):
             ) from error
 
 
-class PromotionScope(enum.Enum):
+class PromotionScope(NamedEnum):
     """Used to represent the scope a promotion is applicable to"""
 
     PRODUCT_ID = 1
@@ -59,9 +97,207 @@ class PromotionScope(enum.Enum):
             ) from error
 
 
-class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
+def deserialize_uuid(value):
+    """Convert a UUID string into a UUID"""
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value)
+    except ValueError as error:
+        raise DataValidationError(f"Error: '{value}' is not a valid UUID") from error
+
+
+class year_month(FunctionElement):  # pylint: disable=invalid-name,too-many-ancestors
+    """SQL function giving the YYYY-MM of a datetime"""
+
+    type = db.String()
+    name = "year_month"
+    inherit_cache = True
+
+
+@compiles(year_month, "postgresql")
+def compile_year_month_postgresql(element, compiler, **kwargs):
+    """Renders year_month for Postgres"""
+    return f"to_char({compiler.process(element.clauses, **kwargs)}, 'YYYY-MM')"
+
+
+@compiles(year_month)
+def compile_year_month(element, compiler, **kwargs):
+    """Renders year_month for SQLite"""
+    return f"strftime('%Y-%m', {compiler.process(element.clauses, **kwargs)})"
+
+
+class PostgresOrFallback(ColumnElement):  # pylint: disable=too-many-ancestors,abstract-method
+    """SQL expression rendered as postgres on Postgres and as fallback on other databases"""
+
+    # Both expressions are part of the cache key, the dialect picks one when compiling
+    _traverse_internals = [
+        ("postgres", InternalTraversal.dp_clauseelement),
+        ("fallback", InternalTraversal.dp_clauseelement),
+    ]
+    inherit_cache = True
+
+    def __init__(self, postgres, fallback):
+        self.postgres = postgres
+        self.fallback = fallback
+        self.type = postgres.type
+
+
+@compiles(PostgresOrFallback, "postgresql")
+def compile_postgres(element, compiler, **kwargs):
+    """Renders the Postgres expression"""
+    return compiler.process(element.postgres, **kwargs)
+
+
+@compiles(PostgresOrFallback)
+def compile_fallback(element, compiler, **kwargs):
+    """Renders the expression for other databases"""
+    return compiler.process(element.fallback, **kwargs)
+
+
+def create_search_index(connection, table):
+    """Adds the generated search_vector column and its GIN index to a promotion table on Postgres
+
+    Returns False on other databases, which search with ILIKE instead
+
+    Args:
+        connection (Connection): the connection to run the DDL on
+        table (str): the name of the table
     """
-    Class that represents a Promotion
+    if connection.dialect.name != "postgresql":
+        return False
+    connection.execute(
+        text(
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+            f"(to_tsvector('{SEARCH_CONFIG}', promotion_name || ' ' || promotion_description)) STORED"
+        )
+    )
+    connection.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING GIN (search_vector)"))
+    return True
+
+
+def init_search(flask_app):
+    """Finds the promotion tables whose search_vector column flask create-search-index added
+
+    Searches of the other tables use ILIKE instead of failing on the missing
+    column, until the command has run and the workers restart
+    """
+    tables = {model.__tablename__: [db.engine] for model in (Promotion, PromotionArchive, ActivePromotion)}
+    shard_set = flask_app.extensions.get("shards")
+    if shard_set:
+        tables[Promotion.__tablename__] = list(shard_set.engines.values())
+    SEARCH_VECTOR_TABLES.clear()
+    for table, engines in tables.items():
+        if all(
+            engine.dialect.name == "postgresql"
+            and "search_vector" in {column["name"] for column in sa_inspect(engine).get_columns(table)}
+            for engine in engines
+        ):
+            SEARCH_VECTOR_TABLES.add(table)
+        elif db.engine.dialect.name == "postgresql":
+            logger.warning("%s has no search_vector column, run flask create-search-index", table)
+
+
+def create_suggest_index(connection, table):
+    """Adds text_pattern_ops indexes of the lowercased names and codes of a promotion table on Postgres
+
+    They serve the prefix LIKE of the suggestions in any collation and for
+    prefixes of any length. Returns False on other databases, which scan the table instead
+
+    Args:
+        connection (Connection): the connection to run the DDL on
+        table (str): the name of the table
+    """
+    if connection.dialect.name != "postgresql":
+        return False
+    for column in SUGGEST_COLUMNS:
+        connection.execute(
+            text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_prefix ON {table} (lower({column}) text_pattern_ops)")
+        )
+        # The trigram indexes these replace did not help prefixes under 3 characters
+        connection.execute(text(f"DROP INDEX IF EXISTS ix_{table}_{column}_trgm"))
+    return True
+
+
+def refuse_sharded(operation):
+    """Raises DataValidationError for an operation that only sees the promotion table of the primary when it is sharded"""
+    if shards.current() is not None:
+        raise DataValidationError(f"{operation} is not supported when promotions are sharded")
+
+
+def merge_by_rank(*ranked):
+    """Merges lists of (promotion, rank) pairs, each best match first, into the promotions best match first"""
+    return [promotion for promotion, _ in heapq.merge(*ranked, key=lambda pair: -pair[1])]
+
+
+def escape_like(term):
+    """Returns the term with its LIKE wildcards escaped by a backslash"""
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def like_pattern(term):
+    """Returns a LIKE pattern matching the term anywhere, with its wildcards escaped"""
+    return f"%{escape_like(term)}%"
+
+
+def summarize_values(groups):
+    """Returns the min, avg and max value of (count, min, max, sum) groups"""
+    if not groups:
+        return {"min": None, "avg": None, "max": None}
+    counts, lows, highs, totals = zip(*groups)
+    return {"min": min(lows), "avg": sum(totals) / sum(counts), "max": max(highs)}
+
+
+def roll_up_statistics(results):
+    """Rolls the rows of the promotion statistics GROUP BY up per dimension
+
+    Args:
+        results: rows of (type, scope, active, start month, expiry bucket, count, min, max, sum)
+    """
+    stats = {
+        "total": 0,
+        "by_type": {},
+        "by_scope": {},
+        "by_active": {},
+        "by_start_month": {},
+        "upcoming_expiry": dict.fromkeys([f"{days}d" for days in EXPIRY_BUCKETS] + ["later"], 0),
+    }
+    values_by_type = {}
+    for promotion_type, scope, active, month, expiry, count, low, high, total in results:
+        stats["total"] += count
+        for name, key in (
+            ("by_type", promotion_type.name),
+            ("by_scope", scope.name),
+            ("by_active", str(active).lower()),
+            ("by_start_month", month),
+        ):
+            stats[name][key] = stats[name].get(key, 0) + count
+        if expiry in stats["upcoming_expiry"]:
+            stats["upcoming_expiry"][expiry] += count
+        values_by_type.setdefault(promotion_type.name, []).append((count, low, high, total))
+
+    stats["value"] = summarize_values([group for groups in values_by_type.values() for group in groups])
+    stats["value_by_type"] = {name: summarize_values(groups) for name, groups in values_by_type.items()}
+    return stats
+
+
+def commit_unless_batched(session):
+    """Commits a session, or only flushes it inside Promotion.batch() which commits once at its end"""
+    if session.info.get(BATCH_KEY):
+        session.flush()
+    else:
+        session.commit()
+
+
+def rollback_unless_batched(session):
+    """Rolls back a session, except inside Promotion.batch() which rolls back the failed operations itself"""
+    if not session.info.get(BATCH_KEY):
+        session.rollback()
+
+
+class PromotionColumns:
+    """
+    Columns and queries shared by the promotion table and its archive
     """
 
     ##################################################
@@ -84,46 +320,6 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
     )
     active = db.Column(db.Boolean, nullable=False, default=False)
 
-    def __repr__(self):
-        return f"<Promotion {self.promotion_name} promotion_id=[{self.promotion_id}], promotion_name=[{self.promotion_name}]>"
-
-    def create(self):
-        """
-        Creates a Promotion to the database
-        """
-        logger.info("Creating %s", self.promotion_name)
-        self.promotion_id = None  # pylint: disable=invalid-name
-        try:
-            db.session.add(self)
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error creating record: %s", self)
-            raise DataValidationError(e) from e
-
-    def update(self):
-        """
-        Updates a Promotion to the database
-        """
-        logger.info("Saving %s", self.promotion_name)
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error updating record: %s", self)
-            raise DataValidationError(e) from e
-
-    def delete(self):
-        """Removes a Promotion from the data store"""
-        logger.info("Deleting %s", self.promotion_name)
-        try:
-            db.session.delete(self)
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            logger.error("Error deleting record: %s", self)
-            raise DataValidationError(e) from e
-
     def serialize(self):
         """Serializes a Promotion into a dictionary"""
         return {
@@ -147,89 +343,6 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
             "active": self.active,
         }
 
-    def deserialize(self, data):
-        """
-        Deserializes a Promotion from a dictionary
-        Args:
-            data (dict): A dictionary containing the promotion data
-        """
-        try:
-            updated_promotion = Promotion()
-            updated_promotion.promotion_id = Promotion.deserialize_with_default(
-                "promotion_id", data, self.promotion_id
-            )
-            updated_promotion.promotion_name = Promotion.deserialize_with_default(
-                "promotion_name", data, self.promotion_name
-            )
-            updated_promotion.promotion_description = (
-                Promotion.deserialize_with_default(
-                    "promotion_description", data, self.promotion_description
-                )
-            )
-            updated_promotion.promotion_type = Promotion.deserialize_with_default(
-                "promotion_type", data, self.promotion_type, PromotionType.deserialize
-            )
-            updated_promotion.promotion_scope = Promotion.deserialize_with_default(
-                "promotion_scope",
-                data,
-                self.promotion_scope,
-                PromotionScope.deserialize,
-            )
-            updated_promotion.start_date = Promotion.deserialize_with_default(
-                "start_date", data, self.start_date, Promotion.deserialize_datetime
-            )
-            updated_promotion.end_date = Promotion.deserialize_with_default(
-                "end_date", data, self.end_date, Promotion.deserialize_datetime
-            )
-            updated_promotion.promotion_value = Promotion.deserialize_with_default(
-                "promotion_value", data, self.promotion_value
-            )
-            updated_promotion.promotion_code = Promotion.deserialize_with_default(
-                "promotion_code", data, self.promotion_code
-            )
-            updated_promotion.created_by = Promotion.deserialize_with_default(
-                "created_by", data, self.created_by
-            )
-            updated_promotion.modified_by = Promotion.deserialize_with_default(
-                "modified_by", data, self.modified_by
-            )
-            updated_promotion.created_when = Promotion.deserialize_with_default(
-                "created_when", data, self.created_when, Promotion.deserialize_datetime
-            )
-            updated_promotion.modified_when = Promotion.deserialize_with_default(
-                "modified_when",
-                data,
-                self.modified_when,
-                Promotion.deserialize_datetime,
-            )
-            updated_promotion.active = Promotion.deserialize_with_default(
-                "active", data, self.active
-            )
-            # Only update once all fields have been verified and deserialized
-            self.promotion_id = updated_promotion.promotion_id
-            self.promotion_name = updated_promotion.promotion_name
-            self.promotion_description = updated_promotion.promotion_description
-            self.promotion_type = updated_promotion.promotion_type
-            self.promotion_scope = updated_promotion.promotion_scope
-            self.start_date = updated_promotion.start_date
-            self.end_date = updated_promotion.end_date
-            self.promotion_value = updated_promotion.promotion_value
-            self.promotion_code = updated_promotion.promotion_code
-            self.created_by = updated_promotion.created_by
-            self.modified_by = updated_promotion.modified_by
-            self.created_when = updated_promotion.created_when
-            self.modified_when = updated_promotion.modified_when
-            self.active = updated_promotion.active
-
-        except AttributeError as error:
-            raise DataValidationError("Invalid attribute: " + error.args[0]) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Promotion: body of request contained bad or no data "
-                + str(error)
-            ) from error
-        return self
-
     ##################################################
     # CLASS METHODS
     ##################################################
@@ -289,28 +402,75 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
     @classmethod
     def find_with_filters(cls, filters):
         """Finds all Promotions by applying filters from a dict"""
-        datetime_filter = Promotion.deserialize_with_default(
-            "datetime", filters, None, Promotion.deserialize_datetime
+        return cls.apply_filters(filters, db.session.query(cls))
+
+    @classmethod
+    def find_ranked(cls, filters):
+        """Finds the Promotions that match filters with a search as (promotion, rank) pairs, best match first
+
+        The pairs of several tables can be combined with merge_by_rank
+        """
+        query = cls.find_with_filters(filters)
+        if isinstance(query, shards.ShardedQuery):
+            # The shards sort by the negated rank
+            return [(row[0], -row[1]) for row in query.rows()]
+        model = query.column_descriptions[0]["entity"]
+        return [tuple(row) for row in query.add_columns(model.search_rank(filters["q"]))]
+
+    @classmethod
+    def count_with_filters(cls, filters, estimate=False):
+        """Counts the promotions that match the filters from a dict
+
+        Returns the count and True if it is the planner's estimate, which is
+        only used when estimate is set and it is at least COUNT_ESTIMATE_THRESHOLD
+        so small counts stay exact
+
+        Args:
+            filters (dict): the filters of find_with_filters
+            estimate (bool): allow a planner estimate instead of counting the rows
+        """
+        query = cls.find_with_filters(filters)
+        if isinstance(query, shards.ShardedQuery):
+            return query.count(), False
+        if estimate:
+            rows = planner.estimate_rows(db.session, query)
+            if rows is not None and rows >= current_app.config.get("COUNT_ESTIMATE_THRESHOLD", 10000):
+                return rows, True
+        return query.order_by(None).count(), False
+
+    @classmethod
+    def apply_filters(cls, filters, query):
+        """Applies the filters from a dict to a query or a select() statement
+
+        Args:
+            filters (dict): the datetime, promotion_type, promotion_scope and active filters
+            query (Query | Select): the query to filter
+        """
+        datetime_filter = cls.deserialize_with_default(
+            "datetime", filters, None, cls.deserialize_datetime
         )
-        promotion_types_filter = Promotion.deserialize_with_default(
+        promotion_types_filter = cls.deserialize_with_default(
             "promotion_type",
             filters,
             None,
-            Promotion.to_list_deserializer(PromotionType.deserialize),
+            cls.to_list_deserializer(PromotionType.deserialize),
         )
-        promotion_scopes_filter = Promotion.deserialize_with_default(
+        promotion_scopes_filter = cls.deserialize_with_default(
             "promotion_scope",
             filters,
             None,
-            Promotion.to_list_deserializer(PromotionScope.deserialize),
+            cls.to_list_deserializer(PromotionScope.deserialize),
         )
-        query = db.session.query(Promotion)
         if datetime_filter is not None:
-            query = Promotion.filter_by_datetime(datetime_filter, query)
+            query = cls.filter_by_datetime(datetime_filter, query)
         if promotion_types_filter is not None:
-            query = Promotion.filter_by_promotion_type(promotion_types_filter, query)
+            query = cls.filter_by_promotion_type(promotion_types_filter, query)
         if promotion_scopes_filter is not None:
-            query = Promotion.filter_by_promotion_scope(promotion_scopes_filter, query)
+            query = cls.filter_by_promotion_scope(promotion_scopes_filter, query)
+        if filters.get("active") is not None:
+            query = query.filter(cls.active == filters["active"])
+        if filters.get("q"):
+            query = cls.filter_by_search(filters["q"], query)
 
         return query
 
@@ -323,6 +483,47 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         """
         return query.filter(and_(cls.start_date <= datetime, cls.end_date >= datetime))
 
+    @classmethod
+    def filter_by_search(cls, search, query):
+        """Returns the promotions whose name or description match a search, best matches first
+
+        Postgres matches the search_vector column with websearch_to_tsquery and
+        ranks with ts_rank once the column exists. Until then, and on other
+        databases, every word of the search must be in the name or description
+        and name matches rank first
+
+        Args:
+            search (str): the words to search for
+        """
+        vector = literal_column(f"{cls.__tablename__}.search_vector")
+        tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, search)
+        words = [
+            or_(
+                cls.promotion_name.ilike(like_pattern(word), escape="\\"),
+                cls.promotion_description.ilike(like_pattern(word), escape="\\"),
+            )
+            for word in search.split()
+        ]
+        match = and_(*words)
+        if cls.__tablename__ in SEARCH_VECTOR_TABLES:
+            match = PostgresOrFallback(vector.bool_op("@@")(tsquery), match)
+        return query.filter(match).order_by(cls.search_rank(search).desc())
+
+    @classmethod
+    def search_rank(cls, search):
+        """Returns how well the name or description of a promotion match a search, higher is better
+
+        Args:
+            search (str): the words to search for
+        """
+        rank = case((cls.promotion_name.ilike(like_pattern(search), escape="\\"), 1.0), else_=0.0)
+        if cls.__tablename__ not in SEARCH_VECTOR_TABLES:
+            return rank
+        vector = literal_column(f"{cls.__tablename__}.search_vector")
+        return PostgresOrFallback(
+            func.ts_rank(vector, func.websearch_to_tsquery(SEARCH_CONFIG, search), type_=db.Float), rank
+        )
+
     @classmethod
     def filter_by_promotion_type(cls, promotion_types, query):
         """Returns all promotions which have the specified type
@@ -352,6 +553,735 @@ class Promotion(db.Model):  # pylint: disable=too-many-instance-attributes
         return cls.query.filter(cls.promotion_name == name)
 
 
+class Promotion(PromotionColumns, db.Model):  # pylint: disable=too-many-instance-attributes
+    """
+    Class that represents a Promotion
+    """
+
+    # The scheduler looks up the upcoming start and end boundaries and the
+    # entity caches the promotions modified since their watermark
+    __table_args__ = (
+        db.Index("ix_promotion_start_date", "start_date"),
+        db.Index("ix_promotion_end_date", "end_date"),
+        db.Index("ix_promotion_modified_when", "modified_when"),
+    )
+
+    def __repr__(self):
+        return f"<Promotion {self.promotion_name} promotion_id=[{self.promotion_id}], promotion_name=[{self.promotion_name}]>"
+
+    def create(self):
+        """
+        Creates a Promotion to the database
+        """
+        logger.info("Creating %s", self.promotion_name)
+        shard_set = shards.current()
+        # Sharded promotions get their id first since it picks their shard
+        self.promotion_id = shard_set.next_id() if shard_set else None  # pylint: disable=invalid-name
+        session = self.session_for(self.promotion_id)
+        try:
+            session.add(self)
+            commit_unless_batched(session)
+        except Exception as e:
+            rollback_unless_batched(session)
+            logger.error("Error creating record: %s", self)
+            raise DataValidationError(e) from e
+
+    def update(self):
+        """
+        Updates a Promotion to the database
+        """
+        logger.info("Saving %s", self.promotion_name)
+        session = self.session_for(self.promotion_id)
+        try:
+            commit_unless_batched(session)
+        except Exception as e:
+            rollback_unless_batched(session)
+            logger.error("Error updating record: %s", self)
+            raise DataValidationError(e) from e
+
+    def delete(self):
+        """Removes a Promotion from the data store"""
+        logger.info("Deleting %s", self.promotion_name)
+        session = self.session_for(self.promotion_id)
+        try:
+            session.delete(self)
+            commit_unless_batched(session)
+        except Exception as e:
+            rollback_unless_batched(session)
+            logger.error("Error deleting record: %s", self)
+            raise DataValidationError(e) from e
+
+    def deserialize(self, data):
+        """
+        Deserializes a Promotion from a dictionary
+        Args:
+            data (dict): A dictionary containing the promotion data
+        """
+        PromotionData.parse(data).apply_to(self)
+        return self
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """Runs the create, update and delete calls of a block in one transaction committed at its end
+
+        The calls only flush, so a failed one leaves the session to be rolled
+        back by the block, e.g. to a savepoint of the operation. The whole
+        transaction is rolled back if the block raises
+        """
+        session = db.session
+        session.info[BATCH_KEY] = True
+        try:
+            yield session
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.info.pop(BATCH_KEY, None)
+        try:
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error("Error committing a batch of promotions")
+            raise DataValidationError(e) from e
+
+    @classmethod
+    def session_for(cls, promotion_id):
+        """Returns the session of the shard that holds a promotion, or db.session if promotions are not sharded"""
+        shard_set = shards.current()
+        return shard_set.session(promotion_id) if shard_set else db.session
+
+    @classmethod
+    def find(cls, by_id):
+        """Finds a Promotion by it's ID, on its shard if promotions are sharded"""
+        logger.info("Processing lookup for id %s ...", by_id)
+        return cls.session_for(by_id).get(cls, by_id)
+
+    @classmethod
+    def find_many(cls, promotion_ids):
+        """Finds the Promotions with any of the ids with one query, one per shard if promotions are sharded"""
+        logger.info("Processing lookup for %d ids ...", len(promotion_ids))
+        statement = select(cls).where(cls.promotion_id.in_(promotion_ids))
+        shard_set = shards.current()
+        if shard_set:
+            return list(itertools.chain.from_iterable(shard_set.map(lambda session: session.scalars(statement).all())))
+        return db.session.scalars(statement).all()
+
+    @classmethod
+    def find_with_filters(cls, filters):
+        """Finds all Promotions by applying filters from a dict
+
+        Reads from the active promotion summary instead of the promotion table
+        when the filters ask for active promotions valid now and allow results
+        that are up to filters["max_staleness"] seconds old. Sharded promotions
+        are read from every shard in promotion_id order, best matches first
+        when there is a search
+        """
+        shard_set = shards.current()
+        if shard_set:
+
+            def build(session):
+                query = cls.apply_filters(filters, session.query(cls))
+                if filters.get("q"):
+                    query = query.add_columns(literal(0.0) - cls.search_rank(filters["q"]))
+                return query.add_columns(cls.promotion_id).order_by(cls.promotion_id)
+
+            return shard_set.query(build)
+        if ActivePromotion.covers(filters):
+            return ActivePromotion.apply_filters(filters, db.session.query(ActivePromotion))
+        return cls.apply_filters(filters, db.session.query(cls))
+
+    @classmethod
+    def archive_expired(cls, horizon, batch_size=1000):
+        """Moves the promotions that ended before the horizon into the archive
+
+        Every batch is moved and committed on its own, so an interrupted run
+        resumes with the promotions that are left. Yields the number of
+        promotions moved by each batch
+
+        Args:
+            horizon (datetime): promotions that ended before this are archived
+            batch_size (int): the number of promotions moved per transaction
+        """
+        refuse_sharded("Archiving")
+        columns = list(cls.__table__.columns)
+        names = [column.name for column in columns] + ["archived_when"]
+        while True:
+            # Concurrent runs skip the rows another run is moving instead of archiving them twice
+            ids = db.session.scalars(
+                select(cls.promotion_id)
+                .where(cls.end_date < horizon)
+                .order_by(cls.promotion_id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not ids:
+                return
+            logger.info("Archiving %d promotions", len(ids))
+            rows = select(*columns, literal(dt.utcnow(), db.DateTime)).where(cls.promotion_id.in_(ids))
+            try:
+                db.session.execute(insert(PromotionArchive).from_select(names, rows))
+                db.session.execute(delete(cls).where(cls.promotion_id.in_(ids)))
+                if PromotionTombstone.enabled():
+                    db.session.execute(insert(PromotionTombstone), PromotionTombstone.rows(ids))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Error archiving records: %s", e)
+                raise DataValidationError(e) from e
+            yield len(ids)
+
+    @classmethod
+    def transitions(cls, since, until):
+        """Returns the (when, promotion_id, active) transitions in the window (since, until]
+
+        A promotion is activated at its start_date and deactivated at its end_date
+        """
+        starts = db.session.execute(
+            select(cls.start_date, cls.promotion_id).where(cls.start_date > since, cls.start_date <= until)
+        )
+        ends = db.session.execute(select(cls.end_date, cls.promotion_id).where(cls.end_date > since, cls.end_date <= until))
+        return [(when, promotion_id, True) for when, promotion_id in starts] + [
+            (when, promotion_id, False) for when, promotion_id in ends
+        ]
+
+    @classmethod
+    def find_active(cls, now):
+        """Returns the active promotions that have not ended by now, in promotion_id order"""
+        shard_set = shards.current()
+        if shard_set:
+            return shard_set.query(
+                lambda session: session.query(cls, cls.promotion_id)
+                .filter(cls.active.is_(True), cls.end_date >= now)
+                .order_by(cls.promotion_id)
+            )
+        return db.session.query(cls).filter(cls.active.is_(True), cls.end_date >= now).order_by(cls.promotion_id)
+
+    @classmethod
+    def modified_since(cls, since):
+        """Returns the promotions modified after since, oldest change first"""
+        shard_set = shards.current()
+        if shard_set:
+            return shard_set.query(
+                lambda session: session.query(cls, cls.modified_when, cls.promotion_id)
+                .filter(cls.modified_when > since)
+                .order_by(cls.modified_when, cls.promotion_id)
+            ).all()
+        return db.session.scalars(select(cls).where(cls.modified_when > since).order_by(cls.modified_when)).all()
+
+    @classmethod
+    def existing_ids(cls, promotion_ids):
+        """Returns the ids among promotion_ids of the promotions that still exist"""
+        statement = select(cls.promotion_id).where(cls.promotion_id.in_(promotion_ids))
+        shard_set = shards.current()
+        if shard_set:
+            return set().union(*shard_set.map(lambda session: set(session.scalars(statement))))
+        return set(db.session.scalars(statement))
+
+    @classmethod
+    def set_active_many(cls, promotion_ids, active, batch_size=500):
+        """Sets the active flag of many promotions with one UPDATE per batch
+
+        Returns the number of promotions that changed
+
+        Args:
+            promotion_ids (list): the promotions to change
+            active (bool): the new value of the active flag
+            batch_size (int): the number of promotions updated per transaction
+        """
+        changed = 0
+        promotion_ids = list(promotion_ids)
+        for start in range(0, len(promotion_ids), batch_size):
+            batch = promotion_ids[start:start + batch_size]
+            try:
+                result = db.session.execute(
+                    update(cls)
+                    .where(cls.promotion_id.in_(batch), cls.active.is_not(active))
+                    .values(active=active, modified_when=dt.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Error updating records: %s", e)
+                raise DataValidationError(e) from e
+            changed += result.rowcount
+            if ActivePromotion.enabled():
+                ActivePromotion.sync(batch)
+        return changed
+
+    @classmethod
+    def copy_rows(cls, rows):
+        """Inserts rows of column values in one transaction, with COPY FROM STDIN on Postgres
+
+        Every row must have the same columns. Other databases use one
+        executemany INSERT
+
+        Args:
+            rows (list): dicts of column values, e.g. from PromotionData.as_dict
+        """
+        refuse_sharded("Copying rows")
+        if not rows:
+            return
+        names = list(rows[0])
+        try:
+            connection = db.session.connection()
+            if connection.dialect.name == "postgresql":
+                statement = f"COPY {cls.__tablename__} ({', '.join(names)}) FROM STDIN"
+                with connection.connection.driver_connection.cursor() as cursor, cursor.copy(statement) as copy:
+                    for row in rows:
+                        copy.write_row([value.name if isinstance(value, enum.Enum) else value for value in row.values()])
+            else:
+                db.session.execute(insert(cls), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error copying records: %s", e)
+            raise DataValidationError(e) from e
+
+    @classmethod
+    def reset_id_sequence(cls):
+        """Moves the promotion_id sequence past the highest id after rows were copied with their ids (Postgres only)"""
+        if db.session.connection().dialect.name != "postgresql":
+            return
+        db.session.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{cls.__tablename__}', 'promotion_id'), "
+                f"(SELECT COALESCE(MAX(promotion_id), 0) + 1 FROM {cls.__tablename__}), false)"
+            )
+        )
+        db.session.commit()
+
+    @classmethod
+    def suggest(cls, prefix, limit):
+        """Returns up to limit promotions whose name or code starts with a prefix, shortest names first
+
+        The match ignores case so Postgres can use the prefix indexes of
+        lower(promotion_name) and lower(promotion_code)
+
+        Args:
+            prefix (str): the start of the name or code
+            limit (int): the most promotions to return
+        """
+        pattern = f"{escape_like(prefix.lower())}%"
+        statement = (
+            select(cls.promotion_id, cls.promotion_name, cls.promotion_code)
+            .where(
+                or_(*(func.lower(getattr(cls, column)).like(pattern, escape="\\") for column in SUGGEST_COLUMNS))
+            )
+            .order_by(func.length(cls.promotion_name), cls.promotion_name, cls.promotion_id)
+            .limit(limit)
+        )
+        shard_set = shards.current()
+        if shard_set:
+            # The first limit rows overall are among the first limit rows of each shard
+            rows = heapq.merge(
+                *shard_set.map(lambda session: session.execute(statement).all()),
+                key=lambda row: (len(row.promotion_name), row.promotion_name, row.promotion_id),
+            )
+            rows = itertools.islice(rows, limit)
+        else:
+            rows = db.session.execute(statement)
+        return [row._asdict() for row in rows]
+
+    @classmethod
+    def statistics(cls, now):
+        """Returns the promotion counts per type, scope, active flag, start month and upcoming expiry
+
+        Everything comes from one GROUP BY over all of the dimensions that
+        roll_up_statistics adds up per dimension, along with the min/avg/max value
+
+        Args:
+            now (datetime): the time the upcoming expiries are counted from
+        """
+        expiry = case(
+            (cls.end_date < now, "ended"),
+            *((cls.end_date < now + timedelta(days=days), f"{days}d") for days in EXPIRY_BUCKETS),
+            else_="later",
+        )
+        rows = select(
+            cls.promotion_type,
+            cls.promotion_scope,
+            cls.active,
+            year_month(cls.start_date).label("start_month"),
+            expiry.label("expiry"),
+            cls.promotion_value,
+        ).subquery()
+        groups = [rows.c.promotion_type, rows.c.promotion_scope, rows.c.active, rows.c.start_month, rows.c.expiry]
+        values = rows.c.promotion_value
+        statement = select(*groups, func.count(), func.min(values), func.max(values), func.sum(values)).group_by(*groups)
+        shard_set = shards.current()
+        if shard_set:
+            # The groups of every shard roll up together like the groups of one database
+            results = shard_set.map(lambda session: session.execute(statement).all())
+            return roll_up_statistics(itertools.chain.from_iterable(results))
+        return roll_up_statistics(db.session.execute(statement))
+
+
+class PromotionArchive(PromotionColumns, db.Model):  # pylint: disable=too-many-instance-attributes
+    """
+    Class that represents a Promotion moved to the archive table
+    """
+
+    archived_when = db.Column(db.DateTime, nullable=False, default=dt.utcnow)
+
+
+class ActivePromotion(PromotionColumns, db.Model):  # pylint: disable=too-many-instance-attributes
+    """
+    Summary table of the active promotions that had not ended when it was
+    last refreshed, with its own indexes for the storefront's queries
+    """
+
+    __table_args__ = (
+        db.Index("ix_active_promotion_dates", "start_date", "end_date"),
+        db.Index("ix_active_promotion_type_scope", "promotion_type", "promotion_scope"),
+    )
+
+    @classmethod
+    def enabled(cls):
+        """Returns True if the summary is maintained"""
+        return current_app.config.get("ACTIVE_SUMMARY_REFRESH_SECONDS", 0) > 0
+
+    @classmethod
+    def source(cls, now):
+        """Returns the SELECT of the promotion rows that belong in the summary"""
+        return select(*Promotion.__table__.columns).where(Promotion.active.is_(True), Promotion.end_date >= now)
+
+    @classmethod
+    def refresh(cls):
+        """Rebuilds the summary in one transaction, readers see the old rows until it commits"""
+        now = dt.utcnow()
+        names = [column.name for column in Promotion.__table__.columns]
+        with db.engine.begin() as conn:
+            conn.execute(delete(cls))
+            conn.execute(insert(cls).from_select(names, cls.source(now)))
+            conn.execute(delete(SummaryRefresh).where(SummaryRefresh.name == cls.__tablename__))
+            conn.execute(insert(SummaryRefresh).values(name=cls.__tablename__, refreshed_when=now))
+        logger.info("Refreshed %s", cls.__tablename__)
+
+    @classmethod
+    def sync(cls, promotion_ids):
+        """Updates the summary rows of promotions that were just written"""
+        names = [column.name for column in Promotion.__table__.columns]
+        source = cls.source(dt.utcnow()).where(Promotion.promotion_id.in_(promotion_ids))
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(delete(cls).where(cls.promotion_id.in_(promotion_ids)))
+                conn.execute(insert(cls).from_select(names, source))
+        except Exception as e:  # pylint: disable=broad-except
+            # The promotions are saved already, the next refresh catches up
+            logger.error("Error updating %s: %s", cls.__tablename__, e)
+
+    @classmethod
+    def covers(cls, filters):
+        """Returns True if the summary can answer a query for active promotions valid now
+
+        Args:
+            filters (dict): the query filters, including max_staleness in seconds
+        """
+        max_staleness = filters.get("max_staleness")
+        if max_staleness is None or not filters.get("active") or not filters.get("datetime"):
+            return False
+        now = dt.utcnow()
+        when = cls.deserialize_datetime(filters["datetime"])
+        if abs((when - now).total_seconds()) > current_app.config.get("ACTIVE_SUMMARY_NOW_TOLERANCE", 60):
+            return False
+        state = db.session.get(SummaryRefresh, cls.__tablename__, populate_existing=True)
+        return state is not None and (now - state.refreshed_when).total_seconds() <= max_staleness
+
+
+class SummaryRefresh(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    When each summary table was last refreshed
+    """
+
+    name = db.Column(db.String(63), primary_key=True)
+    refreshed_when = db.Column(db.DateTime, nullable=False)
+
+
+class IdSequence(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    The next id of a table whose rows are spread across shards
+    """
+
+    name = db.Column(db.String(63), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+    @classmethod
+    def reserve(cls, name, size):
+        """Reserves the next size ids of a sequence and returns the first of them
+
+        Runs in a transaction of its own on the primary, so the ids stay
+        reserved whatever happens to the caller's transaction
+
+        Args:
+            name (str): the table the ids are for
+            size (int): the number of ids to reserve
+        """
+        while True:
+            try:
+                with db.engine.begin() as connection:
+                    updated = connection.execute(update(cls).where(cls.name == name).values(next_id=cls.next_id + size))
+                    if updated.rowcount:
+                        # The row stays locked until the commit, so this is the value just written
+                        return connection.execute(select(cls.next_id).where(cls.name == name)).scalar_one() - size
+                    connection.execute(insert(cls).values(name=name, next_id=1 + size))
+                    return 1
+            except IntegrityError:
+                # Another process created the sequence first, reserve from it
+                continue
+
+
+class ShardLayout(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    The number of shards the rows of a table are spread across
+    """
+
+    name = db.Column(db.String(63), primary_key=True)
+    shard_count = db.Column(db.Integer, nullable=False)
+
+    @classmethod
+    def check(cls, name, shard_count):
+        """Records the shard count of a table the first time and raises DataValidationError if it changed since
+
+        A row lives on the shard picked by a hash of its id modulo the shard
+        count, so with another count the rows would be looked up on the wrong shards
+
+        Args:
+            name (str): the sharded table
+            shard_count (int): the number of shards configured
+        """
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(cls).values(name=name, shard_count=shard_count))
+        except IntegrityError:
+            # Recorded by an earlier start
+            pass
+        with db.engine.connect() as connection:
+            recorded = connection.execute(select(cls.shard_count).where(cls.name == name)).scalar_one()
+        if recorded != shard_count:
+            raise DataValidationError(
+                f"The {name} table is spread across {recorded} shards but {shard_count} are configured, "
+                "its rows cannot be moved between shards"
+            )
+
+
+class IdempotencyRecord(db.Model):
+    """
+    The response of a request made with an Idempotency-Key header, kept until
+    it expires so a retry of the request gets it back without running again
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # None while the first request with the key is running, which then
+    # expires after the lease in case its worker died
+    status_code = db.Column(db.Integer, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    headers = db.Column(db.Text, nullable=True)
+    expires_when = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def claim(cls, key, fingerprint, lease):
+        """Records that a request with the key started
+
+        Returns the record and True if this request claimed the key, or the
+        record of the earlier request with the key and False
+
+        Args:
+            key (str): the Idempotency-Key of the request, scoped to its client
+            fingerprint (str): identifies the method, path and body of the request
+            lease (float): seconds until the key is free again if the request never completes
+        """
+        while True:
+            now = dt.utcnow()
+            claimed = True
+            try:
+                # An expired key is free to use again
+                db.session.execute(delete(cls).where(cls.key == key, cls.expires_when < now))
+                db.session.execute(
+                    insert(cls).values(key=key, fingerprint=fingerprint, expires_when=now + timedelta(seconds=lease))
+                )
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                claimed = False
+            record = db.session.get(cls, key, populate_existing=True)
+            if record is not None:
+                return record, claimed
+            # The record was released or purged since the insert, try to claim the key again
+
+    def complete(self, status_code, body, headers, ttl):
+        """Stores the response of the request and keeps it for ttl seconds"""
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers
+        self.expires_when = dt.utcnow() + timedelta(seconds=ttl)
+        db.session.commit()
+
+    def release(self):
+        """Frees the key of a request that failed so it can be retried"""
+        db.session.rollback()
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls):
+        """Deletes the expired records and returns how many there were"""
+        result = db.session.execute(delete(cls).where(cls.expires_when < dt.utcnow()))
+        db.session.commit()
+        return result.rowcount
+
+
+class PromotionTombstone(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    A promotion that was deleted or archived, for the entity caches of the
+    other workers to drop. Deletes leave no modified_when to reconcile by
+    """
+
+    tombstone_id = db.Column(db.Integer, primary_key=True)
+    promotion_id = db.Column(db.Integer, nullable=False)
+    deleted_when = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def enabled(cls):
+        """Returns True if the entity caches need the tombstones"""
+        return bool(current_app.config.get("ENTITY_CACHE_ENABLED"))
+
+    @staticmethod
+    def rows(promotion_ids):
+        """Returns the rows to insert for promotions deleted now"""
+        now = dt.utcnow()
+        return [{"promotion_id": promotion_id, "deleted_when": now} for promotion_id in promotion_ids]
+
+    @classmethod
+    def record(cls, promotion_ids):
+        """Records promotions that were just deleted, in a transaction of its own on the primary"""
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(cls), cls.rows(promotion_ids))
+        except Exception as e:  # pylint: disable=broad-except
+            # The promotions are deleted already, the next sweep of the entity caches drops them
+            logger.error("Error recording deleted promotions: %s", e)
+
+    @classmethod
+    def deleted_since(cls, since):
+        """Returns the ids of the promotions deleted after since"""
+        return set(db.session.scalars(select(cls.promotion_id).where(cls.deleted_when > since)))
+
+    @classmethod
+    def purge(cls, before):
+        """Deletes the tombstones older than before and returns how many there were"""
+        result = db.session.execute(delete(cls).where(cls.deleted_when < before))
+        db.session.commit()
+        return result.rowcount
+
+
+class PromotionData:
+    """The fields of a promotion request, parsed and validated without an ORM instance
+
+    Fields that are missing or empty in the request are left unset, so the
+    same object serves creates (as_dict) and partial updates (apply_to)
+    """
+
+    # Compiled once: (field, parser) in column order, None keeps the value as is
+    FIELD_SPECS = (
+        ("promotion_id", None),
+        ("promotion_name", None),
+        ("promotion_description", None),
+        ("promotion_type", PromotionType.deserialize),
+        ("promotion_scope", PromotionScope.deserialize),
+        ("start_date", Promotion.deserialize_datetime),
+        ("end_date", Promotion.deserialize_datetime),
+        ("promotion_value", None),
+        ("promotion_code", None),
+        ("created_by", deserialize_uuid),
+        ("modified_by", deserialize_uuid),
+        ("created_when", Promotion.deserialize_datetime),
+        ("modified_when", Promotion.deserialize_datetime),
+        ("active", None),
+    )
+    __slots__ = tuple(name for name, _ in FIELD_SPECS) + ("present",)
+
+    def __init__(self):
+        self.present = ()
+
+    @classmethod
+    def parse(cls, data):
+        """Parses and validates every field of a request dict in one pass
+
+        Args:
+            data (dict): A dictionary containing the promotion data
+        """
+        fields = cls()
+        present = []
+        try:
+            for name, parser in cls.FIELD_SPECS:
+                value = data.get(name)
+                if not value:
+                    continue
+                setattr(fields, name, value if parser is None else parser(value))
+                present.append(name)
+        except AttributeError as error:
+            raise DataValidationError("Invalid attribute: " + error.args[0]) from error
+        except TypeError as error:
+            raise DataValidationError(
+                "Invalid Promotion: body of request contained bad or no data "
+                + str(error)
+            ) from error
+        fields.present = tuple(present)
+        return fields
+
+    def as_dict(self):
+        """Returns the fields that were present as a dict of column values"""
+        return {name: getattr(self, name) for name in self.present}
+
+    def apply_to(self, promotion):
+        """Sets the fields that differ from the current values of a Promotion"""
+        for name in self.present:
+            value = getattr(self, name)
+            if getattr(promotion, name) != value:
+                setattr(promotion, name, value)
+        return promotion
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def collect_written_promotions(session, _):
+    """Remembers the promotions written by a flush for the active promotion summary and the entity cache"""
+    written = [obj for obj in itertools.chain(session.new, session.dirty, session.deleted) if isinstance(obj, Promotion)]
+    if written:
+        session.info.setdefault(SUMMARY_KEY, set()).update(obj.promotion_id for obj in written)
+    deleted = [obj.promotion_id for obj in session.deleted if isinstance(obj, Promotion)]
+    if deleted:
+        session.info.setdefault(DELETED_KEY, set()).update(deleted)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def sync_active_promotions(session):
+    """Brings the active promotion summary and the entity caches up to date with the committed promotions"""
+    written = session.info.pop(SUMMARY_KEY, None)
+    deleted = session.info.pop(DELETED_KEY, None)
+    if not written:
+        return
+    if deleted and PromotionTombstone.enabled():
+        PromotionTombstone.record(deleted)
+    entity_cache = current_app.extensions.get("entity_cache")
+    if entity_cache is not None:
+        entity_cache.invalidate(written)
+    if ActivePromotion.enabled():
+        ActivePromotion.sync(written)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def discard_written_promotions(session):
+    """Forgets the promotions of a transaction that was rolled back"""
+    if session.in_nested_transaction():
+        # Only a savepoint was rolled back, the rest of the transaction can still commit
+        return
+    session.info.pop(SUMMARY_KEY, None)
+    session.info.pop(DELETED_KEY, None)
+
+
 @event.listens_for(Promotion, "before_insert")
 def before_insert(_, __, target):
     """Set the created_when and modified_when fields to current UTC time before insert"""
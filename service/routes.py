@@ -21,10 +21,15 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Pets from the inventory of pets in the PetShop
 """
 
+from datetime import datetime
+
 from flask import request, abort, jsonify
 from flask import current_app as app  # Import Flask application
-from flask_restx import Resource, fields, reqparse
-from service.models import Promotion, PromotionType, PromotionScope
+from flask_restx import Resource, fields, inputs, reqparse
+from flask_restx import abort as restx_abort
+from werkzeug.exceptions import NotFound
+from service.models import DataValidationError, Promotion, PromotionArchive, PromotionType, PromotionScope, merge_by_rank
+from service.common import cache, entity_cache, idempotency, rate_limit, replicas, shards, singleflight
 from service.common import status  # HTTP Status Codes
 from . import api  # pylint: disable=cyclic-import
 
@@ -50,6 +55,7 @@ class HealthResource(Resource):
     GET /health - Returns status of the service
     """
 
+    @rate_limit.budget(None)
     def get(self):
         """Let them know our heart is still beating"""
         return jsonify(status=200, message="Healthy")
@@ -183,7 +189,65 @@ promotion_model = api.inherit(
     },
 )
 
+lookup_model = api.model(
+    "LookupModel",
+    {
+        "ids": fields.List(
+            fields.Integer, required=True, description="The ids of the promotions to return"
+        ),
+    },
+)
+
+# The operations of POST /api/promotions/batch
+BATCH_OPERATIONS = ("create", "update", "activate", "deactivate", "delete")
+
+operation_model = api.model(
+    "OperationModel",
+    {
+        "op": fields.String(
+            required=True, enum=BATCH_OPERATIONS, description="What to do with the promotion"
+        ),
+        "promotion_id": fields.Integer(
+            required=False, description="The promotion to update, activate, deactivate or delete"
+        ),
+        "data": fields.Raw(
+            required=False, description="The promotion to create or the fields to update"
+        ),
+    },
+)
+
+batch_model = api.model(
+    "BatchModel",
+    {
+        "operations": fields.List(
+            fields.Nested(operation_model), required=True, description="The operations, applied in order"
+        ),
+        "atomic": fields.Boolean(
+            required=False,
+            default=True,
+            description="Apply all of the operations or none (true), or each operation that succeeds (false)",
+        ),
+    },
+)
+
+# Concurrent identical list queries of this worker
+LIST_FLIGHTS = singleflight.SingleFlight()
+
+suggest_args = reqparse.RequestParser()
+suggest_args.add_argument(
+    "prefix", type=str, required=True, help="The start of the promotion names or codes to complete"
+)
+suggest_args.add_argument(
+    "limit", type=inputs.positive, required=False, help="The most suggestions to return (capped by SUGGEST_MAX_LIMIT)"
+)
+
 promotion_args = reqparse.RequestParser()
+promotion_args.add_argument(
+    "ids",
+    type=str,
+    required=False,
+    help="Comma separated ids of the promotions to return instead of filtering, X-Missing-Ids lists those not found",
+)
 promotion_args.add_argument(
     "datetime",
     type=str,
@@ -199,6 +263,39 @@ promotion_args.add_argument(
 promotion_args.add_argument(
     "promotion_type", type=str, required=False, help="The types of promotions requested"
 )
+promotion_args.add_argument(
+    "active", type=inputs.boolean, required=False, help="Only return active (true) or inactive (false) promotions"
+)
+promotion_args.add_argument(
+    "max_staleness",
+    type=float,
+    required=False,
+    help="Seconds of staleness accepted for active promotions valid now",
+)
+promotion_args.add_argument(
+    "q", type=str, required=False, help="Words to search for in the names and descriptions, best matches first"
+)
+promotion_args.add_argument(
+    "include_archived",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Also return promotions from the archive",
+)
+promotion_args.add_argument(
+    "count",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Return an empty list with the X-Total-Count header instead of the promotions",
+)
+promotion_args.add_argument(
+    "estimate",
+    type=inputs.boolean,
+    required=False,
+    default=False,
+    help="Allow a planner estimate for large counts",
+)
 
 
 ######################################################################
@@ -249,14 +346,20 @@ class PromotionResource(Resource):
         app.logger.info(
             "Request to Retrieve a promotion with promotion id [%s]", promotion_id
         )
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
-            abort(
-                status.HTTP_404_NOT_FOUND,
-                f"Promotion with id '{promotion_id}' was not found.",
-            )
-        app.logger.info("Returning promotion: %s", promotion.promotion_name)
-        return promotion.serialize(), status.HTTP_200_OK
+        promotions = entity_cache.current()
+        data = promotions.get(promotion_id) if promotions is not None else None
+        if data is None:
+            promotion = Promotion.find(promotion_id)
+            if not promotion:
+                abort(
+                    status.HTTP_404_NOT_FOUND,
+                    f"Promotion with id '{promotion_id}' was not found.",
+                )
+            data = promotion.serialize()
+            if promotions is not None:
+                promotions.put(data)
+        app.logger.info("Returning promotion: %s", data["promotion_name"])
+        return data, status.HTTP_200_OK
 
     @api.doc("delete_promotion")
     @api.response(204, "Promotion deleted")
@@ -276,7 +379,7 @@ class PromotionResource(Resource):
 @api.route("/promotions", strict_slashes=False)
 class PromotionCollection(Resource):
     """Handles all interactions with collections of Promotions
-    GET /promotions - Retrieves a list of all promotions with query params
+    GET /promotions - Retrieves a list of all promotions with query params, or the promotions with the ids
     POST /promotions - Creates a new Promotion
     """
 
@@ -290,16 +393,46 @@ class PromotionCollection(Resource):
         """
         app.logger.info("Request to Retrieve all promotions with filters: {filters}")
         filters = promotion_args.parse_args()
+        ids = filters.pop("ids")
+        if ids is not None:
+            return lookup_promotions(parse_ids(ids))
         to_list_query("promotion_scope", filters)
         to_list_query("promotion_type", filters)
-        promotions = Promotion.find_with_filters(filters).all()
-        return (
-            [promotion.serialize() for promotion in promotions],
-            status.HTTP_200_OK,
-        )
-
-    @api.doc("create_promotion")
+        estimate = filters.pop("estimate")
+        if filters.pop("count"):
+            # Only the count, like HEAD, for clients that cannot send HEAD
+            return [], status.HTTP_200_OK, count_headers(filters, estimate)
+        if not app.config.get("SINGLE_FLIGHT_ENABLED"):
+            promotions = list_promotions(filters)
+        else:
+            # Identical queries that arrive while one is running share its result,
+            # unless one reads from the primary and the other from a replica
+            key = (replicas.current_replica(), singleflight.flight_key(filters))
+            promotions = LIST_FLIGHTS.do(key, lambda: list_promotions(filters))
+        return promotions, status.HTTP_200_OK
+
+    @api.doc("count_promotions")
+    @api.expect(promotion_args, validate=True)
+    @api.response(200, "X-Total-Count has the number of promotions that match")
+    def head(self):
+        """
+        Count promotions by query parameters
+        Returns the X-Total-Count header without listing the promotions
+        """
+        filters = promotion_args.parse_args()
+        filters.pop("ids")
+        to_list_query("promotion_scope", filters)
+        to_list_query("promotion_type", filters)
+        filters.pop("count")
+        return None, status.HTTP_200_OK, count_headers(filters, filters.pop("estimate"))
+
+    @idempotency.idempotent
+    @api.doc(
+        "create_promotion",
+        params={idempotency.HEADER: {"in": "header", "description": "Replays the stored response to a retry"}},
+    )
     @api.response(400, "The posted data was not valid")
+    @api.response(409, "A request with the Idempotency-Key is still in progress")
     @api.expect(create_model, validate=True)
     @api.marshal_with(promotion_model, code=201)
     def post(self):
@@ -319,6 +452,110 @@ class PromotionCollection(Resource):
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+@api.route("/promotions/lookup")
+class LookupResource(Resource):
+    """Returns many promotions by id
+
+    POST /promotions/lookup - the promotions with the ids of the body, for lists too long for GET /promotions?ids=
+    """
+
+    @rate_limit.budget("read")
+    @api.doc("lookup_promotions")
+    @api.expect(lookup_model, validate=True)
+    @api.response(400, "Too many ids")
+    @api.response(200, "X-Missing-Ids lists the ids that were not found")
+    @api.marshal_list_with(promotion_model)
+    def post(self):
+        """
+        Look up promotions by id
+        Returns the promotions in the order of the ids, without the ids that were not found
+        """
+        return lookup_promotions(request.get_json()["ids"])
+
+
+@api.route("/promotions/batch")
+class BatchResource(Resource):
+    """Applies many changes to promotions at once
+
+    POST /promotions/batch - creates, updates, activates, deactivates and deletes promotions with one commit
+    """
+
+    @idempotency.idempotent
+    @rate_limit.budget("bulk")
+    @api.doc(
+        "batch_promotions",
+        params={idempotency.HEADER: {"in": "header", "description": "Replays the stored response to a retry"}},
+    )
+    @api.response(200, "The status and promotion or error of each operation")
+    @api.response(400, "An operation of an atomic batch was not valid")
+    @api.response(404, "An operation of an atomic batch names a promotion that does not exist")
+    @api.response(501, "Batches are not supported when promotions are sharded")
+    @api.expect(batch_model, validate=True)
+    def post(self):
+        """
+        Apply a batch of operations
+        Returns the result of each operation after committing them in one transaction
+        """
+        body = request.get_json()
+        operations = body["operations"]
+        app.logger.info("Request to apply a batch of %d operations", len(operations))
+        max_operations = app.config.get("BATCH_MAX_OPERATIONS", 100)
+        if len(operations) > max_operations:
+            abort_with_error(status.HTTP_400_BAD_REQUEST, f"A batch can have at most {max_operations} operations")
+        if shards.current() is not None:
+            # The shards cannot commit together
+            abort_with_error(status.HTTP_501_NOT_IMPLEMENTED, "Batches are not supported when promotions are sharded")
+        atomic = body.get("atomic", True)
+        with Promotion.batch() as session:
+            results = [
+                run_operation(session, position, operation, atomic) for position, operation in enumerate(operations)
+            ]
+        return {"results": results}, status.HTTP_200_OK
+
+
+@api.route("/promotions/stats")
+class StatsResource(Resource):
+    """Aggregated statistics of the promotions
+
+    GET /promotions/stats - Returns the promotion counts and values grouped for dashboards
+    """
+
+    @api.doc("promotion_stats")
+    def get(self):
+        """
+        Returns promotion statistics
+        Counts per type, scope, active flag, start month and upcoming expiry, with the min/avg/max value
+        """
+        app.logger.info("Request for promotion statistics")
+        # The statistics of this worker are recomputed every STATS_CACHE_SECONDS
+        return cache.current("stats").get_or_set("stats", compute_stats), status.HTTP_200_OK
+
+
+@api.route("/promotions/suggest")
+class SuggestResource(Resource):
+    """Typeahead suggestions of promotion names and codes
+
+    GET /promotions/suggest?prefix={prefix} - Returns the promotions whose name or code starts with the prefix
+    """
+
+    @api.doc("suggest_promotions")
+    @api.expect(suggest_args, validate=True)
+    def get(self):
+        """
+        Completes a promotion name or code
+        Returns the id, name and code of the promotions that start with the prefix, shortest names first
+        """
+        args = suggest_args.parse_args()
+        max_limit = app.config.get("SUGGEST_MAX_LIMIT", 10)
+        limit = min(args["limit"] or max_limit, max_limit)
+        prefix = args["prefix"].strip().lower()
+        if not prefix:
+            return [], status.HTTP_200_OK
+        # The suggestions of the hot prefixes of this worker
+        suggestions = cache.current("suggest").get_or_set((prefix, limit), lambda: Promotion.suggest(prefix, limit))
+        return suggestions, status.HTTP_200_OK
+
+
 @api.param("promotion_id", "The Promotion identifier")
 @api.route("/promotions/activate/<int:promotion_id>")
 class ActivateResource(Resource):
@@ -377,6 +614,118 @@ class DeactivateResource(Resource):
 ######################################################################
 
 
+def compute_stats():
+    """Returns the promotion statistics and when they were computed"""
+    now = datetime.utcnow()
+    return dict(Promotion.statistics(now), generated_when=now.isoformat())
+
+
+def count_headers(filters, estimate):
+    """Returns the X-Total-Count headers for the promotions that match the filters of a list request"""
+    total, estimated = Promotion.count_with_filters(filters, estimate)
+    if filters["include_archived"]:
+        archived, archived_estimated = PromotionArchive.count_with_filters(filters, estimate)
+        total, estimated = total + archived, estimated or archived_estimated
+    headers = {"X-Total-Count": str(total)}
+    if estimated:
+        headers["X-Total-Count-Estimated"] = "true"
+    return headers
+
+
+def apply_operation(operation):
+    """Applies an operation of a batch with the model methods and returns its status code and promotion"""
+    if operation["op"] == "create":
+        promotion = Promotion().deserialize(operation.get("data") or {})
+        promotion.create()
+        return status.HTTP_201_CREATED, promotion.serialize()
+    if operation.get("promotion_id") is None:
+        raise DataValidationError(f"A {operation['op']} operation needs a promotion_id")
+    promotion = Promotion.find(operation["promotion_id"])
+    if operation["op"] == "delete":
+        if promotion:
+            promotion.delete()
+        return status.HTTP_204_NO_CONTENT, None
+    if not promotion:
+        raise NotFound(f"Promotion with id: {operation['promotion_id']} not found")
+    if operation["op"] == "update":
+        promotion.deserialize(operation.get("data") or {})
+    else:
+        promotion.active = operation["op"] == "activate"
+    promotion.update()
+    return status.HTTP_200_OK, promotion.serialize()
+
+
+def run_operation(session, position, operation, atomic):
+    """Returns the result of an operation of a batch
+
+    A failed operation aborts an atomic batch, otherwise only its savepoint
+    is rolled back and its result has the error
+    """
+    result = {"index": position, "op": operation["op"]}
+    try:
+        if atomic:
+            code, promotion = apply_operation(operation)
+        else:
+            with session.begin_nested():
+                code, promotion = apply_operation(operation)
+    except (DataValidationError, NotFound) as error:
+        code = status.HTTP_404_NOT_FOUND if isinstance(error, NotFound) else status.HTTP_400_BAD_REQUEST
+        message = error.description if isinstance(error, NotFound) else str(error)
+        if atomic:
+            app.logger.error("Operation %d of a batch failed: %s", position, message)
+            # The message and the index of the operation that failed
+            restx_abort(code, f"Operation {position} ({operation['op']}) failed: {message}", index=position)
+        return dict(result, status=code, error=message)
+    if promotion is not None:
+        result["promotion"] = promotion
+    return dict(result, status=code)
+
+
+def parse_ids(ids):
+    """Returns the promotion ids of a comma separated list"""
+    try:
+        return [int(promotion_id) for promotion_id in ids.split(",") if promotion_id.strip()]
+    except ValueError as error:
+        raise DataValidationError(f"ids must be comma separated integers, not {ids}") from error
+
+
+def lookup_promotions(promotion_ids):
+    """Returns the serialized promotions with the ids in their order with an X-Missing-Ids header
+
+    The entity cache is consulted first and the promotions it misses are
+    read with one query
+    """
+    promotion_ids = list(dict.fromkeys(promotion_ids))
+    max_ids = app.config.get("LOOKUP_MAX_IDS", 1000)
+    if len(promotion_ids) > max_ids:
+        abort_with_error(status.HTTP_400_BAD_REQUEST, f"At most {max_ids} promotions can be looked up at once")
+    promotions = entity_cache.current()
+    found = promotions.get_many(promotion_ids) if promotions is not None else {}
+    misses = [promotion_id for promotion_id in promotion_ids if promotion_id not in found]
+    if misses:
+        for promotion in Promotion.find_many(misses):
+            found[promotion.promotion_id] = promotion.serialize()
+            if promotions is not None:
+                promotions.put(found[promotion.promotion_id])
+    headers = {}
+    missing = [promotion_id for promotion_id in promotion_ids if promotion_id not in found]
+    if missing:
+        headers["X-Missing-Ids"] = ",".join(str(promotion_id) for promotion_id in missing)
+    return [found[promotion_id] for promotion_id in promotion_ids if promotion_id in found], status.HTTP_200_OK, headers
+
+
+def list_promotions(filters):
+    """Returns the serialized promotions that match the filters of a list request"""
+    if filters["include_archived"] and filters.get("q"):
+        # The archived matches take their place among the others by rank
+        promotions = merge_by_rank(Promotion.find_ranked(filters), PromotionArchive.find_ranked(filters))
+    else:
+        promotions = Promotion.find_with_filters(filters).all()
+        if filters["include_archived"]:
+            promotions += PromotionArchive.find_with_filters(filters).all()
+    return [promotion.serialize() for promotion in promotions]
+
+
 def abort_with_error(error_code, error_msg):
     """Aborts a request with a specific error code and message
 
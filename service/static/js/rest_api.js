@@ -300,6 +300,36 @@ $(function () {
 
     });
 
+    // ****************************************
+    // Suggest Promotion names while typing
+    // ****************************************
+
+    let suggest_timer = null;
+
+    $("#promotion_name").on("input", function () {
+        let prefix = $(this).val();
+        clearTimeout(suggest_timer);
+        if (!prefix) {
+            $("#promotion_name_suggestions").empty();
+            return
+        }
+        // Wait for a pause in typing so every keystroke is not a request
+        suggest_timer = setTimeout(function () {
+            let ajax = $.ajax({
+                type: "GET",
+                url: `/api/promotions/suggest?prefix=${encodeURIComponent(prefix)}`,
+                contentType: "application/json",
+            })
+
+            ajax.done(function(res){
+                $("#promotion_name_suggestions").empty();
+                for (let i = 0; i < res.length; i++) {
+                    $("<option>").val(res[i].promotion_name).appendTo("#promotion_name_suggestions");
+                }
+            });
+        }, 150);
+    });
+
     // ****************************************
     // Activate a Promotion
     // ****************************************
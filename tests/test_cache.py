@@ -0,0 +1,58 @@
+"""
+Test cases for the TTL cache
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service.common import cache as caches
+from service.common.cache import TTLCache
+
+
+######################################################################
+#  T T L   C A C H E   T E S T   C A S E S
+######################################################################
+class TestTTLCache(TestCase):
+    """TTL Cache Tests"""
+
+    def test_expiry(self):
+        """It should return values until they expire"""
+        cache = TTLCache(10)
+        with patch("time.monotonic", side_effect=[0, 5, 10]):
+            cache.set("key", "value")
+            self.assertEqual(cache.get("key"), "value")
+            self.assertIsNone(cache.get("key"))
+        self.assertIsNone(cache.get("missing"))
+
+    def test_get_or_set(self):
+        """It should only compute missing values"""
+        cache = TTLCache(10)
+        calls = []
+        for _ in range(2):
+            self.assertEqual(cache.get_or_set("key", lambda: calls.append(1) or "value"), "value")
+        self.assertEqual(len(calls), 1)
+        cache.clear()
+        cache.get_or_set("key", lambda: calls.append(1) or "value")
+        self.assertEqual(len(calls), 2)
+
+    def test_disabled(self):
+        """It should not keep anything with a ttl of 0"""
+        cache = TTLCache(0)
+        cache.set("key", "value")
+        self.assertIsNone(cache.get("key"))
+
+    def test_max_entries(self):
+        """It should drop the oldest entries above max_entries"""
+        cache = TTLCache(10, max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.set(key, key)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual([cache.get("b"), cache.get("c")], ["b", "c"])
+
+    def test_init_caches(self):
+        """It should create the caches of an app with the TTLs of its config"""
+        flask_app = Flask(__name__)
+        flask_app.config.update(STATS_CACHE_SECONDS=5, SUGGEST_CACHE_SECONDS=2)
+        caches.init_caches(flask_app)
+        with flask_app.app_context():
+            self.assertEqual(caches.current("stats").ttl, 5)
+            self.assertEqual(caches.current("suggest").ttl, 2)
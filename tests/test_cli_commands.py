@@ -7,7 +7,9 @@ from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    archive_promotions, create_search_index, db_create, export_promotions, import_promotions, load_test, run_jobs
+)
 
 
 class TestFlaskCLI(TestCase):
@@ -23,3 +25,81 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.load.LoadTester')
+    def test_load_test(self, tester_mock):
+        """It should run the load-test command and print the report"""
+        tester_mock.return_value.run.return_value = {
+            "total": {"count": 10, "errors": 0, "throughput": 5.0, "p50": 1.0, "p95": 2.0, "p99": 3.0, "p99.9": 4.0}
+        }
+        tester_mock.return_value.elapsed = 2.0
+        result = self.runner.invoke(load_test, ["--workers", "2", "--requests", "10"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("total", result.output)
+        self.assertEqual(tester_mock.call_args.kwargs["workers"], 2)
+
+    def test_load_test_bad_mix(self):
+        """It should reject an invalid operation mix"""
+        result = self.runner.invoke(load_test, ["--mix", "explode=1"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Unknown operation", result.output)
+
+    @patch('service.common.cli_commands.Promotion.archive_expired')
+    def test_archive_promotions(self, archive_mock):
+        """It should archive expired promotions in batches and report the total"""
+        archive_mock.return_value = iter([100, 20])
+        result = self.runner.invoke(archive_promotions, ["--retention-days", "30", "--batch-size", "100"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Archived 120 promotions that ended before", result.output)
+        self.assertEqual(archive_mock.call_args.args[1], 100)
+
+    @patch('service.common.cli_commands.Promotion.archive_expired')
+    def test_archive_promotions_defaults(self, archive_mock):
+        """It should use the configured retention and batch size"""
+        archive_mock.return_value = iter([])
+        result = self.runner.invoke(archive_promotions, [])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Archived 0 promotions", result.output)
+        self.assertEqual(archive_mock.call_args.args[1], app.config["ARCHIVE_BATCH_SIZE"])
+
+    @patch('service.common.cli_commands.shards.current')
+    def test_sharded(self, current_mock):
+        """It should refuse the commands that only see the primary's promotion table when promotions are sharded"""
+        current_mock.return_value = MagicMock()
+        for command, args in (
+            (archive_promotions, []),
+            (export_promotions, []),
+            (import_promotions, ["README.md"]),
+        ):
+            result = self.runner.invoke(command, args)
+            self.assertEqual(result.exit_code, 2)
+            self.assertIn("not supported when promotions are sharded", result.output)
+
+    @patch('service.common.cli_commands.models.create_suggest_index')
+    @patch('service.common.cli_commands.models.create_search_index')
+    def test_create_search_index(self, index_mock, suggest_mock):
+        """It should add the search indexes or explain that they need Postgres"""
+        index_mock.return_value = True
+        result = self.runner.invoke(create_search_index)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("indexes are in place", result.output)
+        self.assertEqual(index_mock.call_count, 3)
+        self.assertEqual(suggest_mock.call_args[0][1], "promotion")
+        # And the promotion table of every shard
+        shard_set = MagicMock(engines={"shard_0": MagicMock(), "shard_1": MagicMock()})
+        with patch('service.common.cli_commands.shards.current', return_value=shard_set):
+            self.runner.invoke(create_search_index)
+        self.assertEqual(index_mock.call_count, 8)
+        self.assertEqual(suggest_mock.call_count, 4)
+        index_mock.return_value = False
+        result = self.runner.invoke(create_search_index)
+        self.assertIn("need Postgres", result.output)
+
+    @patch('service.common.cli_commands.jobs.run_jobs')
+    def test_run_jobs(self, run_mock):
+        """It should run the background jobs until interrupted"""
+        run_mock.side_effect = KeyboardInterrupt
+        result = self.runner.invoke(run_jobs)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Stopped the background jobs", result.output)
+        self.assertIs(run_mock.call_args[0][0], app)
@@ -0,0 +1,118 @@
+"""
+Test cases for the negotiated response compression
+"""
+import gzip
+import json
+from unittest import TestCase
+from unittest.mock import patch
+import brotli
+import zstandard
+from flask import Flask, Response
+from wsgi import app
+from service.common import compression
+from service.common.compression import compress_response
+
+BODY = json.dumps([{"promotion_name": f"promotion {index}", "active": True} for index in range(200)]).encode()
+
+
+def decompress(encoding, data):
+    """Decompresses a body with one of the supported encodings"""
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br":
+        return brotli.decompress(data)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(TestCase):
+    """Response Compression Tests"""
+
+    def compress(self, accept_encoding, response=None, method="GET"):
+        """Runs the compression hook on a response for a request"""
+        response = response or Response(BODY, mimetype="application/json")
+        headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+        with app.test_request_context("/api/promotions", method=method, headers=headers):
+            return compress_response(response)
+
+    def test_encodings(self):
+        """It should compress with each supported encoding"""
+        for encoding in ("gzip", "br", "zstd"):
+            resp = self.compress(encoding)
+            self.assertEqual(resp.headers["Content-Encoding"], encoding)
+            self.assertIn("Accept-Encoding", resp.vary)
+            self.assertLess(resp.content_length, len(BODY))
+            self.assertEqual(decompress(encoding, resp.get_data()), BODY)
+
+    def test_negotiation(self):
+        """It should pick the encoding by quality and then by server preference"""
+        self.assertEqual(self.compress("gzip, deflate, br, zstd").headers["Content-Encoding"], "zstd")
+        self.assertEqual(self.compress("gzip;q=1.0, br;q=0.5").headers["Content-Encoding"], "gzip")
+        self.assertEqual(self.compress("*").headers["Content-Encoding"], "zstd")
+        self.assertEqual(self.compress("*, zstd;q=0").headers["Content-Encoding"], "br")
+
+    def test_identity(self):
+        """It should not compress when the client accepts no supported encoding"""
+        for accept_encoding in (None, "identity", "deflate", "gzip;q=0"):
+            resp = self.compress(accept_encoding)
+            self.assertNotIn("Content-Encoding", resp.headers)
+            self.assertEqual(resp.get_data(), BODY)
+        self.assertIn("Accept-Encoding", resp.vary)
+
+    def test_small_body(self):
+        """It should not compress bodies below the minimum size"""
+        resp = self.compress("gzip", Response(b'{"status": 200}', mimetype="application/json"))
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertNotIn("Accept-Encoding", resp.vary)
+
+    def test_not_compressible(self):
+        """It should leave HEAD requests, errors, binary and encoded bodies alone"""
+        self.assertNotIn("Content-Encoding", self.compress("gzip", method="HEAD").headers)
+        self.assertNotIn("Content-Encoding", self.compress("gzip", Response(BODY, status=404)).headers)
+        self.assertNotIn("Content-Encoding", self.compress("gzip", Response(BODY, mimetype="image/png")).headers)
+        encoded = Response(BODY, mimetype="application/json", headers={"Content-Encoding": "br"})
+        self.assertEqual(self.compress("gzip", encoded).headers["Content-Encoding"], "br")
+
+    def test_streamed_response(self):
+        """It should compress a streamed response chunk by chunk"""
+        chunks = [BODY[:1000], "", BODY[1000:].decode()]
+        closed = []
+
+        def body():
+            try:
+                yield from chunks
+            finally:
+                closed.append(True)
+
+        for encoding in ("gzip", "br", "zstd"):
+            resp = self.compress(encoding, Response(body(), mimetype="application/json"))
+            self.assertEqual(resp.headers["Content-Encoding"], encoding)
+            self.assertNotIn("Content-Length", resp.headers)
+            parts = list(resp.response)
+            self.assertEqual(len(parts), 3)
+            self.assertEqual(decompress(encoding, b"".join(parts)), BODY)
+        self.assertEqual(closed, [True, True, True])
+
+    def test_etag_weakened(self):
+        """It should weaken a strong ETag on a compressed body"""
+        response = Response(BODY, mimetype="application/json")
+        response.set_etag("abc")
+        self.assertEqual(self.compress("gzip", response).headers["ETag"], 'W/"abc"')
+
+    def test_init_without_encodings(self):
+        """It should not install the hook when no encoding is available"""
+        flask_app = Flask(__name__)
+        flask_app.config["COMPRESSION_ENCODINGS"] = ["deflate"]
+        compression.init_compression(flask_app)
+        self.assertEqual(flask_app.after_request_funcs, {})
+        with patch.object(compression.BrotliCompressor, "available", False):
+            self.assertEqual(compression.available_encodings(["br", "gzip"]), ["gzip"])
+
+    def test_compressed_route(self):
+        """It should compress a response served by the app"""
+        client = app.test_client()
+        resp = client.get("/api/swagger.json", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("paths", json.loads(gzip.decompress(resp.get_data())))
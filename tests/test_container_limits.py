@@ -0,0 +1,99 @@
+"""
+Test cases for the container limit detection used by gunicorn.conf.py
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service.common import container_limits
+from service.common.container_limits import cpu_limit, memory_limit, worker_settings
+
+MB = container_limits.MB
+
+
+def write(root, path, text):
+    """Writes a fake cgroup file"""
+    full_path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "w", encoding="utf-8") as cgroup_file:
+        cgroup_file.write(text + "\n")
+
+
+######################################################################
+#  C O N T A I N E R   L I M I T S   T E S T   C A S E S
+######################################################################
+class TestContainerLimits(TestCase):
+    """Container Limits Tests"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.root = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cgroup_v2_limits(self):
+        """It should read the CPU quota and memory limit from cgroup v2"""
+        write(self.root, "cpu.max", "50000 100000")
+        write(self.root, "memory.max", str(128 * MB))
+        self.assertEqual(cpu_limit(self.root), 0.5)
+        self.assertEqual(memory_limit(self.root), 128 * MB)
+
+    def test_cgroup_v2_unlimited(self):
+        """It should fall back to the host CPUs when cgroup v2 has no limits"""
+        write(self.root, "cpu.max", "max 100000")
+        write(self.root, "memory.max", "max")
+        self.assertEqual(cpu_limit(self.root), container_limits.host_cpu_count())
+        self.assertIsNone(memory_limit(self.root))
+
+    def test_cgroup_v1_limits(self):
+        """It should read the CPU quota and memory limit from cgroup v1"""
+        write(self.root, "cpu/cpu.cfs_quota_us", "150000")
+        write(self.root, "cpu/cpu.cfs_period_us", "100000")
+        write(self.root, "memory/memory.limit_in_bytes", str(256 * MB))
+        self.assertEqual(cpu_limit(self.root), 1.5)
+        self.assertEqual(memory_limit(self.root), 256 * MB)
+
+    def test_cgroup_v1_unlimited(self):
+        """It should treat a -1 quota and a huge memory limit as unlimited"""
+        write(self.root, "cpu/cpu.cfs_quota_us", "-1")
+        write(self.root, "cpu/cpu.cfs_period_us", "100000")
+        write(self.root, "memory/memory.limit_in_bytes", str(1 << 62))
+        self.assertEqual(cpu_limit(self.root), container_limits.host_cpu_count())
+        self.assertIsNone(memory_limit(self.root))
+
+    def test_no_cgroups(self):
+        """It should fall back to the host when there are no cgroup files"""
+        self.assertEqual(cpu_limit(self.root), container_limits.host_cpu_count())
+        self.assertIsNone(memory_limit(self.root))
+
+    def test_worker_settings_for_deployment(self):
+        """It should size a 0.5 CPU / 128Mi pod with two threaded workers"""
+        settings = worker_settings(0.5, 128 * MB, env={})
+        self.assertEqual(settings, {"workers": 2, "threads": 2, "worker_class": "gthread"})
+
+    def test_worker_settings_capped_by_memory(self):
+        """It should not start more workers than fit in memory"""
+        self.assertEqual(worker_settings(4, 128 * MB, env={})["workers"], 2)
+        self.assertEqual(worker_settings(4, 64 * MB, env={})["workers"], 1)
+        self.assertEqual(worker_settings(4, None, env={})["workers"], 9)
+        self.assertEqual(worker_settings(4, None, env={})["threads"], 8)
+
+    def test_worker_settings_overrides(self):
+        """It should let the environment override the derived settings"""
+        env = {"WEB_CONCURRENCY": "3", "GUNICORN_THREADS": "1"}
+        self.assertEqual(
+            worker_settings(0.5, 128 * MB, env=env),
+            {"workers": 3, "threads": 1, "worker_class": "sync"},
+        )
+
+    def test_dispose_engines(self):
+        """It should dispose of the inherited engine without closing its connections"""
+        with app.app_context():
+            from service.models import db  # pylint: disable=import-outside-toplevel
+
+            engine = db.engine
+        with patch.object(engine.__class__, "dispose") as dispose_mock:
+            container_limits.dispose_engines(app)
+        dispose_mock.assert_called_with(close=False)
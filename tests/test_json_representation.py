@@ -0,0 +1,77 @@
+"""
+Test cases for the orjson backed JSON representation
+"""
+import datetime
+import json
+import uuid
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service.common import json_representation
+from service.common.json_representation import dumps, output_json
+from service.models import PromotionType
+
+VALUES = {
+    "when": datetime.datetime(2025, 6, 1, 12, 30, 45),
+    "day": datetime.date(2025, 6, 1),
+    "user": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+    "type": PromotionType.PERCENTAGE,
+}
+EXPECTED = {
+    "when": "2025-06-01T12:30:45",
+    "day": "2025-06-01",
+    "user": "12345678-1234-5678-1234-567812345678",
+    "type": "PERCENTAGE",
+}
+
+
+######################################################################
+#  J S O N   R E P R E S E N T A T I O N   T E S T   C A S E S
+######################################################################
+class TestJsonRepresentation(TestCase):
+    """JSON Representation Tests"""
+
+    def test_dumps_with_orjson(self):
+        """It should encode datetimes, UUIDs and enums with orjson"""
+        self.assertIsNotNone(json_representation.orjson)
+        self.assertEqual(json.loads(dumps(VALUES)), EXPECTED)
+
+    def test_dumps_with_stdlib(self):
+        """It should encode the same values with the stdlib fallback"""
+        with patch.object(json_representation, "orjson", None):
+            self.assertEqual(json.loads(dumps(VALUES)), EXPECTED)
+
+    def test_dumps_with_other_settings(self):
+        """It should use the stdlib encoder for settings orjson does not support"""
+        self.assertEqual(dumps({"name": "é"}, ensure_ascii=True), b'{"name": "\\u00e9"}')
+        self.assertEqual(dumps({"b": 1, "a": 2}, sort_keys=True, indent=2), b'{\n  "a": 2,\n  "b": 1\n}')
+        self.assertEqual(dumps({"b": 1, "a": 2}, sort_keys=True, indent=4), b'{\n    "a": 2,\n    "b": 1\n}')
+
+    def test_dumps_unsupported_type(self):
+        """It should raise a TypeError for values it cannot encode"""
+        with patch.object(json_representation, "orjson", None):
+            self.assertRaises(TypeError, dumps, {"value": object()})
+
+    def test_output_json(self):
+        """It should make a response ending with a new line"""
+        with app.app_context():
+            resp = output_json({"promotion_id": 1}, 201, {"Location": "here"})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.headers["Location"], "here")
+        self.assertEqual(resp.get_data(), b'{"promotion_id":1}\n')
+
+    def test_output_json_debug(self):
+        """It should indent the response in debug mode"""
+        app.debug = True
+        try:
+            with app.app_context():
+                resp = output_json({"promotion_id": 1}, 200)
+        finally:
+            app.debug = False
+        self.assertEqual(resp.get_data(), b'{\n    "promotion_id": 1\n}\n')
+
+    def test_registered_on_api(self):
+        """It should be the JSON representation of the api"""
+        from service import api  # pylint: disable=import-outside-toplevel
+
+        self.assertIs(api.representations["application/json"], output_json)
@@ -5,15 +5,29 @@ Test cases for Pet Model
 import os
 import logging
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
 from wsgi import app
 from service.models import (
+    ActivePromotion,
     Promotion,
+    PromotionArchive,
+    SummaryRefresh,
     DataValidationError,
+    PromotionData,
     PromotionScope,
     PromotionType,
+    SEARCH_VECTOR_TABLES,
+    create_search_index,
+    create_suggest_index,
     db,
+    init_search,
+    merge_by_rank,
+    year_month,
 )
 from service.common.datetime_utils import datetime_to_str
 from .factories import PromotionFactory
@@ -49,6 +63,9 @@ class Promotions(TestCase):
     def setUp(self):
         """This runs before each test"""
         db.session.query(Promotion).delete()  # clean up the last tests
+        db.session.query(PromotionArchive).delete()
+        db.session.query(ActivePromotion).delete()
+        db.session.query(SummaryRefresh).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -176,28 +193,55 @@ class Promotions(TestCase):
         """It should raise a DataValidationError"""
         promotion_json = {"promotion_id": 123, "promotion_name": "abcPromotion"}
         promotion = Promotion()
-        original_deserialize_with_default = Promotion.deserialize_with_default
+        original_field_specs = PromotionData.FIELD_SPECS
         try:
             # Type Error
-            def type_error_deserialize(key, data, default, deserializer=None):
+            def type_error_deserialize(value):
                 raise TypeError("Some bad type")
 
-            Promotion.deserialize_with_default = type_error_deserialize
+            PromotionData.FIELD_SPECS = (("promotion_name", type_error_deserialize),)
             self.assertRaises(
                 DataValidationError, promotion.deserialize, promotion_json
             )
 
             # Attribute Error
-            def attribute_error_deserialize(key, data, default, deserializer=None):
+            def attribute_error_deserialize(value):
                 raise AttributeError("Some bad attribute")
 
-            promotion.deserialize_with_default = attribute_error_deserialize
+            PromotionData.FIELD_SPECS = (("promotion_name", attribute_error_deserialize),)
             self.assertRaises(
                 DataValidationError, promotion.deserialize, promotion_json
             )
 
         finally:
-            Promotion.deserialize_with_default = original_deserialize_with_default
+            PromotionData.FIELD_SPECS = original_field_specs
+
+    def test_deserialize_invalid_uuid(self):
+        """It should raise a DataValidationError for a malformed UUID"""
+        promotion = Promotion()
+        self.assertRaises(DataValidationError, promotion.deserialize, {"created_by": "not-a-uuid"})
+        self.assertRaises(DataValidationError, promotion.deserialize, {"modified_by": 42})
+        promotion.deserialize({"created_by": "12345678-1234-5678-1234-567812345678"})
+        self.assertEqual(promotion.created_by, uuid.UUID("12345678-1234-5678-1234-567812345678"))
+
+    def test_parse_promotion_data(self):
+        """It should parse only the fields present in the request"""
+        fields = PromotionData.parse(
+            {"promotion_name": "abc", "promotion_type": "absolute", "promotion_code": "", "active": False}
+        )
+        self.assertEqual(fields.present, ("promotion_name", "promotion_type"))
+        self.assertEqual(fields.as_dict(), {"promotion_name": "abc", "promotion_type": PromotionType.ABSOLUTE})
+        self.assertRaises(DataValidationError, PromotionData.parse, None)
+
+    def test_deserialize_sets_changed_fields_only(self):
+        """It should only set the fields whose values change"""
+        promotion = PromotionFactory()
+        promotion.create()
+        data = promotion.serialize()
+        data["promotion_name"] = "renamed"
+        promotion.deserialize(data)
+        changed = [attr.key for attr in db.inspect(promotion).attrs if attr.history.has_changes()]
+        self.assertEqual(changed, ["promotion_name"])
 
     def test_create_missing_data(self):
         """It should throw a validation error since required fields are empty"""
@@ -279,6 +323,33 @@ class Promotions(TestCase):
         found_promotion = Promotion.find_by_name(test_promotion.promotion_name).all()
         self.assertEqual(len(found_promotion), 1)
 
+    def test_find_many(self):
+        """It should find the promotions with any of the ids in one query"""
+        promotions = PromotionFactory.create_batch(3)
+        for promotion in promotions:
+            promotion.create()
+        ids = [promotion.promotion_id for promotion in promotions]
+        found = Promotion.find_many([ids[0], ids[2], ids[2] + 100])
+        self.assertEqual(sorted(promotion.promotion_id for promotion in found), [ids[0], ids[2]])
+        self.assertEqual(Promotion.find_many([]), [])
+
+    def test_batch(self):
+        """It should commit the changes of a batch once and roll all of them back on an error"""
+        with Promotion.batch():
+            PromotionFactory().create()
+            PromotionFactory().create()
+        self.assertEqual(len(Promotion.all()), 2)
+        with self.assertRaises(RuntimeError):
+            with Promotion.batch():
+                PromotionFactory().create()
+                raise RuntimeError("stop")
+        self.assertEqual(len(Promotion.all()), 2)
+        with patch.object(db.session, "commit", side_effect=[IntegrityError("commit", {}, Exception())]):
+            with self.assertRaises(DataValidationError):
+                with Promotion.batch():
+                    PromotionFactory().create()
+        self.assertEqual(len(Promotion.all()), 2)
+
     def test_find_by_date(self):
         """It should return all promotions valid on a specific date"""
         promotion1 = PromotionFactory()
@@ -383,3 +454,261 @@ class Promotions(TestCase):
         result_ids2 = [result.promotion_id for result in results2]
         self.assertEqual(len(results2), 3)
         self.assertNotIn(promotion4.promotion_id, result_ids2)
+
+    def test_archive_expired(self):
+        """It should move promotions that ended before the horizon into the archive in batches"""
+        promotions = []
+        for year in (2020, 2021, 2030):
+            promotion = PromotionFactory(start_date=datetime(year - 1, 1, 1), end_date=datetime(year, 1, 1))
+            promotion.create()
+            promotions.append(promotion)
+        expired_id = promotions[0].promotion_id
+        batches = list(Promotion.archive_expired(datetime(2025, 1, 1), batch_size=1))
+        self.assertEqual(batches, [1, 1])
+        self.assertEqual(len(Promotion.all()), 1)
+        archived = PromotionArchive.find(expired_id)
+        self.assertEqual(archived.promotion_name, "some_promotion")
+        self.assertIsNotNone(archived.archived_when)
+        self.assertEqual(archived.serialize()["promotion_id"], expired_id)
+        # A second run has nothing left to move
+        self.assertEqual(list(Promotion.archive_expired(datetime(2025, 1, 1))), [])
+        found = PromotionArchive.find_with_filters({"datetime": "2019-06-01"}).all()
+        self.assertEqual([promotion.promotion_id for promotion in found], [expired_id])
+
+    def test_archive_expired_error(self):
+        """It should roll back a batch that fails and raise a DataValidationError"""
+        PromotionFactory(end_date=datetime(2020, 1, 1)).create()
+        with patch("service.models.insert", side_effect=ConnectionError):
+            self.assertRaises(DataValidationError, list, Promotion.archive_expired(datetime(2025, 1, 1)))
+        self.assertEqual(len(Promotion.all()), 1)
+
+    def test_refresh_active_promotions(self):
+        """It should rebuild the summary with the active promotions that have not ended"""
+        now = datetime.utcnow()
+        current = PromotionFactory(active=True, start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        current.create()
+        PromotionFactory(active=False, start_date=now, end_date=now + timedelta(days=1)).create()
+        PromotionFactory(active=True, start_date=now - timedelta(days=2), end_date=now - timedelta(days=1)).create()
+        ActivePromotion.refresh()
+        self.assertEqual([row.promotion_id for row in ActivePromotion.all()], [current.promotion_id])
+        self.assertIsNotNone(db.session.get(SummaryRefresh, ActivePromotion.__tablename__))
+        # A second refresh replaces the rows rather than adding to them
+        ActivePromotion.refresh()
+        self.assertEqual(len(ActivePromotion.all()), 1)
+
+    def test_sync_active_promotions(self):
+        """It should update the summary after each commit when it is enabled"""
+        now = datetime.utcnow()
+        with patch.dict(app.config, {"ACTIVE_SUMMARY_REFRESH_SECONDS": 60}):
+            promotion = PromotionFactory(active=True, start_date=now, end_date=now + timedelta(days=1))
+            promotion.create()
+            self.assertEqual(len(ActivePromotion.all()), 1)
+            promotion.active = False
+            promotion.update()
+            self.assertEqual(len(ActivePromotion.all()), 0)
+        # Disabled summaries are left alone
+        promotion.active = True
+        promotion.update()
+        self.assertEqual(len(ActivePromotion.all()), 0)
+
+    def test_sync_active_promotions_error(self):
+        """It should log a failed summary update without failing the write"""
+        with patch("service.models.insert", side_effect=ConnectionError):
+            with self.assertLogs("flask.app", level="ERROR") as logs:
+                ActivePromotion.sync(["abc"])
+        self.assertIn("Error updating active_promotion", logs.output[0])
+
+    def test_find_with_filters_reads_summary(self):
+        """It should read active promotions valid now from a fresh enough summary"""
+        now = datetime.utcnow()
+        promotion = PromotionFactory(active=True, start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        promotion.create()
+        filters = {"active": True, "datetime": datetime_to_str(now), "max_staleness": 30}
+        # Without a refresh the summary is never fresh enough
+        self.assertEqual(Promotion.find_with_filters(filters).column_descriptions[0]["entity"], Promotion)
+        ActivePromotion.refresh()
+        results = Promotion.find_with_filters(filters)
+        self.assertEqual(results.column_descriptions[0]["entity"], ActivePromotion)
+        self.assertEqual([row.promotion_id for row in results], [promotion.promotion_id])
+        # Other times, missing tolerances and stale summaries use the promotion table
+        for stale in (
+            dict(filters, datetime="2020-01-01"),
+            dict(filters, max_staleness=None),
+            dict(filters, active=False),
+        ):
+            self.assertFalse(ActivePromotion.covers(stale))
+        refresh = db.session.get(SummaryRefresh, ActivePromotion.__tablename__)
+        refresh.refreshed_when = now - timedelta(minutes=5)
+        db.session.commit()
+        self.assertFalse(ActivePromotion.covers(filters))
+
+    def test_find_with_active_filter(self):
+        """It should filter promotions by their active flag"""
+        PromotionFactory(active=True).create()
+        PromotionFactory(active=False).create()
+        self.assertEqual(len(Promotion.find_with_filters({"active": True}).all()), 1)
+        self.assertEqual(len(Promotion.find_with_filters({"active": False}).all()), 1)
+        self.assertEqual(len(Promotion.find_with_filters({}).all()), 2)
+
+    def test_transitions(self):
+        """It should list the start and end boundaries within a window"""
+        promotion = PromotionFactory(start_date=datetime(2025, 1, 1), end_date=datetime(2025, 2, 1))
+        promotion.create()
+        self.assertEqual(
+            Promotion.transitions(datetime(2024, 12, 31), datetime(2025, 1, 1)),
+            [(datetime(2025, 1, 1), promotion.promotion_id, True)],
+        )
+        self.assertEqual(len(Promotion.transitions(datetime(2024, 1, 1), datetime(2026, 1, 1))), 2)
+        self.assertEqual(Promotion.transitions(datetime(2025, 1, 1), datetime(2025, 1, 2)), [])
+
+    def test_set_active_many(self):
+        """It should change the active flag of many promotions in batches"""
+        promotions = [PromotionFactory(active=False) for _ in range(3)]
+        for promotion in promotions:
+            promotion.create()
+        promotion_ids = [promotion.promotion_id for promotion in promotions]
+        self.assertEqual(Promotion.set_active_many(promotion_ids, True, batch_size=2), 3)
+        self.assertEqual(Promotion.set_active_many(promotion_ids, True), 0)
+        self.assertTrue(all(Promotion.find(promotion_id).active for promotion_id in promotion_ids))
+        with patch("service.models.update", side_effect=ConnectionError):
+            self.assertRaises(DataValidationError, Promotion.set_active_many, promotion_ids, False)
+
+    def test_count_with_filters(self):
+        """It should count the promotions that match the filters"""
+        PromotionFactory(active=True).create()
+        PromotionFactory(active=False).create()
+        self.assertEqual(Promotion.count_with_filters({}), (2, False))
+        self.assertEqual(Promotion.count_with_filters({"active": True}), (1, False))
+        # SQLite has no planner estimates so the count stays exact
+        self.assertEqual(Promotion.count_with_filters({}, estimate=True), (2, False))
+        with patch("service.models.planner.estimate_rows", return_value=50000):
+            self.assertEqual(Promotion.count_with_filters({}, estimate=True), (50000, True))
+        with patch("service.models.planner.estimate_rows", return_value=50):
+            self.assertEqual(Promotion.count_with_filters({}, estimate=True), (2, False))
+
+    def test_statistics(self):
+        """It should count the promotions per dimension and summarize their values"""
+        now = datetime(2025, 3, 1)
+        PromotionFactory(
+            promotion_type=PromotionType.PERCENTAGE, promotion_value=10, active=True,
+            start_date=datetime(2025, 1, 5), end_date=now + timedelta(days=3),
+        ).create()
+        PromotionFactory(
+            promotion_type=PromotionType.ABSOLUTE, promotion_value=20,
+            start_date=datetime(2025, 1, 20), end_date=now + timedelta(days=20),
+        ).create()
+        PromotionFactory(
+            promotion_type=PromotionType.ABSOLUTE, promotion_value=40, promotion_scope=PromotionScope.ENTIRE_STORE,
+            start_date=datetime(2025, 2, 1), end_date=now - timedelta(days=1),
+        ).create()
+        stats = Promotion.statistics(now)
+        self.assertEqual(stats["total"], 3)
+        self.assertEqual(stats["by_type"], {"PERCENTAGE": 1, "ABSOLUTE": 2})
+        self.assertEqual(stats["by_scope"], {"PRODUCT_ID": 2, "ENTIRE_STORE": 1})
+        self.assertEqual(stats["by_active"], {"true": 1, "false": 2})
+        self.assertEqual(stats["by_start_month"], {"2025-01": 2, "2025-02": 1})
+        self.assertEqual(stats["upcoming_expiry"], {"7d": 1, "30d": 1, "90d": 0, "later": 0})
+        self.assertEqual(stats["value"], {"min": 10, "avg": 70 / 3, "max": 40})
+        self.assertEqual(stats["value_by_type"]["ABSOLUTE"], {"min": 20, "avg": 30, "max": 40})
+
+    def test_statistics_empty(self):
+        """It should return empty statistics without promotions"""
+        stats = Promotion.statistics(datetime.utcnow())
+        self.assertEqual(stats["total"], 0)
+        self.assertEqual(stats["value"], {"min": None, "avg": None, "max": None})
+
+    def test_year_month(self):
+        """It should render the start month for Postgres"""
+        sql = str(select(year_month(Promotion.start_date)).compile(dialect=postgresql.dialect()))
+        self.assertIn("to_char(promotion.start_date, 'YYYY-MM')", sql)
+
+    def test_search(self):
+        """It should find promotions by the words of their name and description, name matches first"""
+        PromotionFactory(promotion_name="Summer sale", promotion_description="Sandals and hats").create()
+        PromotionFactory(promotion_name="Hat week", promotion_description="All summer hats").create()
+        PromotionFactory(promotion_name="100%_off", promotion_description="Clearance").create()
+        names = [promotion.promotion_name for promotion in Promotion.find_with_filters({"q": "summer"})]
+        self.assertEqual(names, ["Summer sale", "Hat week"])
+        names = [promotion.promotion_name for promotion in Promotion.find_with_filters({"q": "HATS sandals"})]
+        self.assertEqual(names, ["Summer sale"])
+        # LIKE wildcards in the search are matched literally
+        self.assertEqual(len(Promotion.find_with_filters({"q": "%"}).all()), 1)
+        self.assertEqual(len(Promotion.find_with_filters({"q": "sale", "datetime": "2020-01-01"}).all()), 0)
+
+    def test_search_postgres(self):
+        """It should search the tsvector column with a ranking on Postgres once it exists"""
+        with patch("service.models.SEARCH_VECTOR_TABLES", {"promotion"}):
+            query = Promotion.filter_by_search("summer hats", select(Promotion))
+        sql = str(query.compile(dialect=postgresql.dialect()))
+        self.assertIn("promotion.search_vector @@ websearch_to_tsquery(%(websearch_to_tsquery_1)s, %(", sql)
+        self.assertIn("ORDER BY ts_rank(promotion.search_vector", sql)
+        self.assertNotIn("LIKE", sql)
+        self.assertIn("LIKE", str(query.compile(dialect=sqlite.dialect())))
+        # Before flask create-search-index has added the column
+        query = Promotion.filter_by_search("summer hats", select(Promotion))
+        sql = str(query.compile(dialect=postgresql.dialect()))
+        self.assertNotIn("search_vector", sql)
+        self.assertIn("ILIKE", sql)
+
+    def test_init_search(self):
+        """It should only search the search_vector columns of the Postgres tables that have one"""
+        with patch.dict(app.extensions, {"shards": MagicMock(engines={"shard_0": db.engine})}):
+            init_search(app)
+        self.assertEqual(SEARCH_VECTOR_TABLES, set())
+        inspector = MagicMock()
+        inspector.return_value.get_columns.side_effect = lambda table: [{"name": "promotion_id"}] + (
+            [{"name": "search_vector"}] if table != "promotion_archive" else []
+        )
+        try:
+            with patch.object(db.engine.dialect, "name", "postgresql"), patch("service.models.sa_inspect", inspector), \
+                    self.assertLogs("flask.app", level="WARNING") as logs:
+                init_search(app)
+            self.assertEqual(SEARCH_VECTOR_TABLES, {"promotion", "active_promotion"})
+            self.assertIn("promotion_archive has no search_vector column", logs.output[0])
+        finally:
+            SEARCH_VECTOR_TABLES.clear()
+
+    def test_search_cache_key(self):
+        """It should let the compiled searches be cached by their structure"""
+        keys = [
+            Promotion.filter_by_search(search, select(Promotion))._generate_cache_key()  # pylint: disable=protected-access
+            for search in ("summer", "winter", "summer hats")
+        ]
+        self.assertIsNotNone(keys[0])
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+
+    def test_find_ranked(self):
+        """It should return the matches with their rank and merge the ranks of tables"""
+        PromotionFactory(promotion_name="Summer sale").create()
+        PromotionFactory(promotion_name="Hat week", promotion_description="All summer hats").create()
+        ranked = Promotion.find_ranked({"q": "summer"})
+        ranks = [(promotion.promotion_name, rank) for promotion, rank in ranked]
+        self.assertEqual(ranks, [("Summer sale", 1), ("Hat week", 0)])
+        first, second = ("first", 1.0), ("second", 0.5)
+        self.assertEqual(merge_by_rank([first, ("third", 0.0)], [second]), ["first", "second", "third"])
+
+    def test_create_search_index(self):
+        """It should only add the search column and index on Postgres"""
+        connection = MagicMock()
+        connection.dialect.name = "sqlite"
+        self.assertFalse(create_search_index(connection, "promotion"))
+        connection.execute.assert_not_called()
+        connection.dialect.name = "postgresql"
+        self.assertTrue(create_search_index(connection, "promotion"))
+        statements = [str(call[0][0]) for call in connection.execute.call_args_list]
+        self.assertIn("search_vector tsvector GENERATED ALWAYS AS", statements[0])
+        self.assertIn("USING GIN (search_vector)", statements[1])
+
+    def test_create_suggest_index(self):
+        """It should only add the prefix indexes on Postgres"""
+        connection = MagicMock()
+        connection.dialect.name = "sqlite"
+        self.assertFalse(create_suggest_index(connection, "promotion"))
+        connection.execute.assert_not_called()
+        connection.dialect.name = "postgresql"
+        self.assertTrue(create_suggest_index(connection, "promotion"))
+        statements = [str(call[0][0]) for call in connection.execute.call_args_list]
+        self.assertNotIn("pg_trgm", " ".join(statements))
+        self.assertIn("ON promotion (lower(promotion_name) text_pattern_ops)", statements[0])
+        self.assertIn("ON promotion (lower(promotion_code) text_pattern_ops)", statements[2])
@@ -0,0 +1,54 @@
+"""
+Test cases for the planner statistics
+"""
+from unittest import TestCase
+from unittest.mock import MagicMock
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from service.common.planner import Explain, estimate_rows
+from service.models import Promotion
+
+
+def postgres_session(result):
+    """Returns a mock Postgres session whose queries return result"""
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    session.execute.return_value.scalar.return_value = result
+    return session
+
+
+######################################################################
+#  P L A N N E R   T E S T   C A S E S
+######################################################################
+class TestPlanner(TestCase):
+    """Planner Statistics Tests"""
+
+    def test_explain(self):
+        """It should explain a statement with its bound parameters"""
+        statement = select(Promotion).where(Promotion.promotion_name == "x")
+        sql = str(Explain(statement).compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith("EXPLAIN (FORMAT JSON) SELECT"))
+        self.assertIn("promotion.promotion_name = %(promotion_name_1)s", sql)
+
+    def test_other_databases(self):
+        """It should not estimate without planner statistics"""
+        session = MagicMock()
+        session.get_bind.return_value.dialect.name = "sqlite"
+        self.assertIsNone(estimate_rows(session, MagicMock()))
+        session.execute.assert_not_called()
+
+    def test_table_rows(self):
+        """It should use the table statistics for an unfiltered query"""
+        query = MagicMock(whereclause=None, column_descriptions=[{"entity": Promotion}])
+        session = postgres_session(120000)
+        self.assertEqual(estimate_rows(session, query), 120000)
+        self.assertEqual(session.execute.call_args[0][1], {"table": "promotion"})
+        # Tables that were never analyzed have no estimate
+        self.assertIsNone(estimate_rows(postgres_session(-1), query))
+
+    def test_filtered_rows(self):
+        """It should use the EXPLAIN estimate for a filtered query"""
+        query = MagicMock(statement=select(Promotion).where(Promotion.active.is_(True)))
+        session = postgres_session([{"Plan": {"Plan Rows": 5400}}])
+        self.assertEqual(estimate_rows(session, query), 5400)
+        self.assertIsInstance(session.execute.call_args[0][0], Explain)
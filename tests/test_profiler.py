@@ -0,0 +1,68 @@
+"""
+Test cases for the per-request profiler
+"""
+import os
+import tempfile
+from unittest import TestCase
+from flask import Flask
+from service.common import profiler
+
+
+def make_app(**config):
+    """Creates a bare Flask app with a single route to profile"""
+    flask_app = Flask(__name__)
+    flask_app.config.update(config)
+
+    @flask_app.route("/work")
+    def work():
+        return {"total": sum(range(1000))}
+
+    profiler.init_profiling(flask_app)
+    return flask_app
+
+
+######################################################################
+#  P R O F I L E R   T E S T   C A S E S
+######################################################################
+class TestProfiler(TestCase):
+    """Per-request Profiler Tests"""
+
+    def test_disabled_without_secret(self):
+        """It should not install any hooks when no secret is configured"""
+        flask_app = make_app(PROFILE_SECRET=None)
+        self.assertEqual(flask_app.before_request_funcs, {})
+        self.assertEqual(flask_app.after_request_funcs, {})
+        response = flask_app.test_client().get("/work", headers={"X-Profile": "x"})
+        self.assertEqual(response.get_json()["total"], 499500)
+
+    def test_request_without_header(self):
+        """It should not profile requests without the profiling header"""
+        flask_app = make_app(PROFILE_SECRET="s3cr3t")
+        response = flask_app.test_client().get("/work")
+        self.assertEqual(response.get_json()["total"], 499500)
+        self.assertNotIn(profiler.PROFILE_FILE_HEADER, response.headers)
+
+    def test_request_with_wrong_secret(self):
+        """It should not profile requests with the wrong secret"""
+        flask_app = make_app(PROFILE_SECRET="s3cr3t")
+        response = flask_app.test_client().get("/work", headers={"X-Profile": "guess"})
+        self.assertEqual(response.mimetype, "application/json")
+        response = flask_app.test_client().get("/work", headers={"X-Profile": "s3cr\u00e9t"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+
+    def test_profile_returned_as_text(self):
+        """It should return the profile report when no directory is configured"""
+        flask_app = make_app(PROFILE_SECRET="s3cr3t", PROFILE_LIMIT=5)
+        response = flask_app.test_client().get("/work", headers={"X-Profile": "s3cr3t"})
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertIn("function calls", response.get_data(as_text=True))
+
+    def test_profile_written_to_directory(self):
+        """It should write the profile to the configured directory"""
+        with tempfile.TemporaryDirectory() as profile_dir:
+            flask_app = make_app(PROFILE_SECRET="s3cr3t", PROFILE_DIR=profile_dir)
+            response = flask_app.test_client().get("/work", headers={"X-Profile": "s3cr3t"})
+            self.assertEqual(response.get_json()["total"], 499500)
+            filename = response.headers[profiler.PROFILE_FILE_HEADER]
+            self.assertTrue(os.path.exists(os.path.join(profile_dir, filename)))
@@ -0,0 +1,138 @@
+"""
+Test cases for the per-client rate limiting
+"""
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from flask_restx import Api, Resource
+from service.common import rate_limit
+from service.common.rate_limit import LocalStore, SqliteStore
+
+
+def make_app(**config):
+    """Creates a bare Flask app with a read, a write, a bulk and an exempt endpoint"""
+    flask_app = Flask(__name__)
+    flask_app.config.update(RATE_LIMITS={"read": (1, 2), "write": (1, 1), "bulk": (0.5, 1)}, RATE_LIMIT_STORE="memory")
+    flask_app.config.update(config)
+    api = Api(flask_app)
+
+    @api.route("/items")
+    class Items(Resource):  # pylint: disable=unused-variable
+        """Items"""
+
+        def get(self):
+            """Reads the items"""
+            return []
+
+        def post(self):
+            """Writes an item"""
+            return {}, 201
+
+        @rate_limit.budget("bulk")
+        def put(self):
+            """Writes many items"""
+            return []
+
+    @flask_app.route("/health")
+    @rate_limit.budget(None)
+    def health():
+        return {"status": "OK"}
+
+    rate_limit.init_proxies(flask_app)
+    rate_limit.init_rate_limits(flask_app)
+    return flask_app
+
+
+######################################################################
+#  R A T E   L I M I T   T E S T   C A S E S
+######################################################################
+class TestRateLimit(TestCase):
+    """Rate Limiting Tests"""
+
+    def test_token_bucket(self):
+        """It should allow a burst and then one request per refill"""
+        store = LocalStore()
+        with patch("time.monotonic", side_effect=[0, 0, 0, 1.5]):
+            self.assertEqual([store.take("client", 1, 2) for _ in range(3)], [0, 0, 1])
+            self.assertEqual(store.take("client", 1, 2), 0)
+
+    def test_prune(self):
+        """It should drop the least recently used bucket when there are too many"""
+        store = LocalStore(max_keys=2)
+        store.take("first", 1, 2)
+        store.take("second", 1, 2)
+        store.take("first", 1, 2)
+        store.take("third", 1, 2)
+        self.assertEqual(list(store._buckets), ["first", "third"])  # pylint: disable=protected-access
+
+    def test_shared_store_prune(self):
+        """It should delete the refilled buckets at each budget and then the oldest above max_keys"""
+        with tempfile.TemporaryDirectory() as root:
+            store = SqliteStore(os.path.join(root, "buckets.db"), max_keys=2, prune_interval=3600)
+            with patch("time.time", side_effect=[0, 1, 2, 3]):
+                store.take("read", 10, 2)
+                store.take("write", 0.01, 2)
+                store.take("other", 0.01, 2)
+                store.take("last", 0.01, 2)
+            store.prune(4)
+            with sqlite3.connect(store.path) as conn:
+                keys = [key for key, in conn.execute("SELECT key FROM token_buckets ORDER BY updated")]
+            self.assertEqual(keys, ["other", "last"])
+
+    def test_shared_store(self):
+        """It should share the buckets between stores on the same file"""
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "buckets.db")
+            self.assertEqual(SqliteStore(path).take("client", 0.5, 1), 0)
+            self.assertAlmostEqual(SqliteStore(path).take("client", 0.5, 1), 2, delta=0.1)
+            store = SqliteStore(path)
+            with patch("service.common.rate_limit.spend", side_effect=ValueError):
+                self.assertRaises(ValueError, store.take, "client", 0.5, 1)
+            self.assertGreater(store.take("client", 0.5, 1), 0)
+
+    def test_budgets(self):
+        """It should limit reads, writes and bulk requests on separate budgets"""
+        client = make_app().test_client()
+        self.assertEqual([client.get("/items").status_code for _ in range(3)], [200, 200, 429])
+        self.assertEqual([client.post("/items").status_code for _ in range(2)], [201, 429])
+        resp = client.put("/items")
+        self.assertEqual(resp.status_code, 200)
+        resp = client.put("/items")
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "2")
+        self.assertEqual(resp.get_json()["error"], "Too Many Requests")
+        self.assertEqual([client.get("/health").status_code for _ in range(5)], [200] * 5)
+
+    def test_clients(self):
+        """It should give every known API key and IP address its own buckets"""
+        client = make_app(RATE_LIMIT_API_KEYS={"a"}).test_client()
+        self.assertEqual(client.post("/items").status_code, 201)
+        self.assertEqual(client.post("/items", headers={"X-API-Key": "a"}).status_code, 201)
+        self.assertEqual(client.post("/items", headers={"X-API-Key": "a"}).status_code, 429)
+        self.assertEqual(client.post("/items", headers={"X-API-Key": "forged"}).status_code, 429)
+        self.assertEqual(client.post("/items", environ_base={"REMOTE_ADDR": "10.0.0.2"}).status_code, 201)
+
+    def test_proxies(self):
+        """It should give every client behind a trusted proxy its own buckets"""
+        client = make_app(TRUSTED_PROXIES=1).test_client()
+        ingress = {"REMOTE_ADDR": "10.0.0.1"}
+        first = {"X-Forwarded-For": "203.0.113.1"}
+        self.assertEqual(client.post("/items", headers=first, environ_base=ingress).status_code, 201)
+        self.assertEqual(client.post("/items", headers=first, environ_base=ingress).status_code, 429)
+        second = {"X-Forwarded-For": "203.0.113.2"}
+        self.assertEqual(client.post("/items", headers=second, environ_base=ingress).status_code, 201)
+        # Without trusted proxies every client has the address of the ingress
+        client = make_app().test_client()
+        self.assertEqual(client.post("/items", headers=first, environ_base=ingress).status_code, 201)
+        self.assertEqual(client.post("/items", headers=second, environ_base=ingress).status_code, 429)
+
+    def test_unlimited(self):
+        """It should not install the hook when no budget has a rate"""
+        flask_app = make_app(RATE_LIMITS={"read": (0, 10)})
+        self.assertNotIn("rate_limits", flask_app.extensions)
+        with tempfile.TemporaryDirectory() as root:
+            flask_app = make_app(RATE_LIMIT_STORE=os.path.join(root, "buckets.db"))
+            self.assertIsInstance(flask_app.extensions["rate_limits"], SqliteStore)
@@ -0,0 +1,137 @@
+"""
+Test cases for read replica routing
+"""
+import os
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import MagicMock
+from flask import Flask
+from service.common import replicas
+from service.common.replicas import ReplicaPool
+from service.models import Promotion, db
+from .factories import PromotionFactory
+
+
+def make_app(root, **config):
+    """Creates a bare Flask app with a primary, a replica and a broken replica"""
+    flask_app = Flask(__name__)
+    flask_app.config.update(
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{os.path.join(root, 'primary.db')}",
+        SQLALCHEMY_BINDS={
+            "replica_0": f"sqlite:///{os.path.join(root, 'replica.db')}",
+            "replica_1": f"sqlite:///{os.path.join(root, 'missing', 'replica.db')}",
+        },
+        REPLICA_STICKY_SECONDS=5,
+        REPLICA_CHECK_INTERVAL=60,
+        **config,
+    )
+    db.init_app(flask_app)
+
+    @flask_app.route("/promotions", methods=["GET", "POST"])
+    def promotions():
+        if flask_app.config.get("WRITE"):
+            PromotionFactory(promotion_name="written").create()
+        names = sorted(promotion.promotion_name for promotion in Promotion.all())
+        return {"names": names, "replica": replicas.current_replica()}
+
+    replicas.init_replicas(flask_app)
+    with flask_app.app_context():
+        db.create_all(bind_key=None)
+        Promotion.metadata.create_all(db.engines["replica_0"])
+    return flask_app
+
+
+######################################################################
+#  R E P L I C A   T E S T   C A S E S
+######################################################################
+# pylint: disable=duplicate-code
+class TestReplicas(TestCase):
+    """Read Replica Tests"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.app = make_app(self.tmp.name)
+        self.client = self.app.test_client()
+        with self.app.app_context():
+            PromotionFactory(promotion_name="primary").create()
+            with db.engines["replica_0"].begin() as conn:
+                replica = PromotionFactory(promotion_name="replica", created_when=datetime.now())
+                row = {column.name: getattr(replica, column.name) for column in Promotion.__table__.columns}
+                conn.execute(Promotion.__table__.insert(), row)
+
+    def tearDown(self):
+        with self.app.app_context():
+            for engine in db.engines.values():
+                engine.dispose()
+        self.tmp.cleanup()
+
+    def test_get_reads_from_replica(self):
+        """It should read from a healthy replica and skip the broken one"""
+        for _ in range(3):
+            self.assertEqual(self.client.get("/promotions").get_json(), {"names": ["replica"], "replica": "replica_0"})
+        pool = self.app.extensions["replicas"]
+        self.assertTrue(pool.healthy("replica_0"))
+        self.assertFalse(pool.healthy("replica_1"))
+
+    def test_writes_go_to_primary(self):
+        """It should write to the primary and keep the writer on it for a while"""
+        self.app.config["WRITE"] = True
+        resp = self.client.post("/promotions")
+        self.assertEqual(resp.get_json()["names"], ["primary", "written"])
+        self.assertIn(replicas.STICKY_COOKIE, resp.headers["Set-Cookie"])
+        self.app.config["WRITE"] = False
+        resp = self.client.get("/promotions")
+        self.assertEqual(resp.get_json(), {"names": ["primary", "written"], "replica": None})
+
+        self.client.set_cookie(replicas.STICKY_COOKIE, str(time.time() - 1))
+        self.assertEqual(self.client.get("/promotions").get_json()["names"], ["replica"])
+        self.client.set_cookie(replicas.STICKY_COOKIE, "garbage")
+        self.assertEqual(self.client.get("/promotions").get_json()["names"], ["replica"])
+
+    def test_failover_to_primary(self):
+        """It should retry a failed replica read on the primary and mark the replica down"""
+        pool = self.app.extensions["replicas"]
+        pool.check = lambda name: 0.0
+        pool.mark_down("replica_0")
+        self.assertEqual(self.client.get("/promotions").get_json()["names"], ["primary"])
+        self.assertFalse(pool.healthy("replica_1"))
+
+    def test_all_replicas_down(self):
+        """It should read from the primary when no replica is healthy"""
+        self.app.extensions["replicas"].mark_down("replica_0")
+        self.assertEqual(self.client.get("/promotions").get_json()["names"], ["primary"])
+
+    def test_errors_without_replica(self):
+        """It should not retry errors of queries on the primary"""
+        with self.app.app_context():
+            db.session.execute(db.text("DROP TABLE promotion"))
+            self.assertRaises(db.exc.OperationalError, Promotion.all)
+
+    def test_pool_health_checks(self):
+        """It should skip replicas that lag and cache check results for the interval"""
+        lags = {"a": 0.5, "b": 30.0}
+        check = MagicMock(side_effect=lambda name: lags[name])
+        pool = ReplicaPool(["a", "b"], check, interval=60, max_lag=10)
+        self.assertEqual([pool.choose() for _ in range(3)], ["a", "a", "a"])
+        self.assertEqual(check.call_count, 2)
+        pool.interval = 0
+        lags["a"] = 20.0
+        self.assertIsNone(pool.choose())
+
+    def test_replica_lag(self):
+        """It should read the replay lag of a Postgres standby"""
+        engine = MagicMock()
+        engine.dialect.name = "postgresql"
+        engine.connect.return_value.__enter__.return_value.execute.return_value.scalar.return_value = 2.5
+        self.assertEqual(replicas.replica_lag(engine), 2.5)
+        with self.app.app_context():
+            self.assertEqual(replicas.replica_lag(db.engines["replica_0"]), 0.0)
+
+    def test_disabled_without_replicas(self):
+        """It should not install any hooks when no replicas are configured"""
+        flask_app = Flask(__name__)
+        replicas.init_replicas(flask_app)
+        self.assertEqual(flask_app.before_request_funcs, {})
+        self.assertNotIn("replicas", flask_app.extensions)
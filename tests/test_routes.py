@@ -5,12 +5,15 @@ TestPromotion API Service Test Suite
 import os
 import logging
 from unittest import TestCase
+from unittest.mock import patch
 from uuid import UUID
-from datetime import datetime
+from datetime import datetime, timedelta
 from wsgi import app
-from service.common import status
+from service import routes
+from service.common import cache, status
+from service.common.entity_cache import EntityCache
 from service.common.datetime_utils import datetime_from_str, datetime_to_str
-from service.models import db, Promotion, PromotionScope
+from service.models import db, ActivePromotion, Promotion, PromotionArchive, PromotionScope, PromotionType
 from tests.factories import PromotionFactory
 
 
@@ -45,6 +48,8 @@ class TestYourResourceService(TestCase):
         """Runs before each test"""
         self.client = app.test_client()
         db.session.query(Promotion).delete()  # clean up the last tests
+        db.session.query(PromotionArchive).delete()
+        db.session.query(ActivePromotion).delete()
         db.session.commit()
 
     def tearDown(self):
@@ -485,3 +490,255 @@ class TestYourResourceService(TestCase):
         db.session.expire_all()
         deactivated_promotion = Promotion.find(existing_promotion.promotion_id)
         self.assertFalse(deactivated_promotion.active)
+
+    def test_list_including_archived(self):
+        """It should only list archived promotions when include_archived is set"""
+        archived = PromotionFactory(end_date=datetime(2020, 1, 1))
+        archived.create()
+        archived_id = archived.promotion_id
+        PromotionFactory().create()
+        list(Promotion.archive_expired(datetime(2024, 1, 1)))
+        resp = self.client.get("/api/promotions")
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.client.get("/api/promotions?include_archived=true")
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertIn(archived_id, [data["promotion_id"] for data in resp.get_json()])
+        resp = self.client.get("/api/promotions?include_archived=maybe")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_active_promotions(self):
+        """It should list active promotions valid now from the summary when it is fresh enough"""
+        now = datetime.utcnow()
+        promotion = PromotionFactory(active=True, start_date=now - timedelta(days=1), end_date=now + timedelta(days=1))
+        promotion.create()
+        PromotionFactory(active=False).create()
+        ActivePromotion.refresh()
+        query = f"active=true&datetime={now.isoformat()}&max_staleness=60"
+        with patch.object(ActivePromotion, "apply_filters", wraps=ActivePromotion.apply_filters) as summary_mock:
+            resp = self.client.get(f"/api/promotions?{query}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([data["promotion_id"] for data in resp.get_json()], [promotion.promotion_id])
+        summary_mock.assert_called_once()
+        resp = self.client.get("/api/promotions?active=false")
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.client.get("/api/promotions?max_staleness=soon")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_coalesced(self):
+        """It should answer concurrent identical list queries from one query"""
+        PromotionFactory().create()
+        with patch.object(routes.LIST_FLIGHTS, "do", wraps=routes.LIST_FLIGHTS.do) as do_mock:
+            resp = self.client.get("/api/promotions?promotion_type=PERCENTAGE,ABSOLUTE")
+        self.assertEqual(len(resp.get_json()), 1)
+        key = (None, (("include_archived", False), ("promotion_type", ("ABSOLUTE", "PERCENTAGE"))))
+        self.assertEqual(do_mock.call_args[0][0], key)
+        with patch.dict(app.config, {"SINGLE_FLIGHT_ENABLED": False}):
+            with patch.object(routes.LIST_FLIGHTS, "do") as do_mock:
+                resp = self.client.get("/api/promotions")
+        self.assertEqual(len(resp.get_json()), 1)
+        do_mock.assert_not_called()
+
+    def test_count_promotions(self):
+        """It should answer only X-Total-Count for HEAD and count=true"""
+        PromotionFactory(active=True).create()
+        PromotionFactory(active=False, end_date=datetime(2020, 1, 1)).create()
+        list(Promotion.archive_expired(datetime(2024, 1, 1)))
+        resp = self.client.head("/api/promotions")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Total-Count"], "1")
+        self.assertEqual(resp.get_data(), b"")
+        resp = self.client.head("/api/promotions?include_archived=true&active=false")
+        self.assertEqual(resp.headers["X-Total-Count"], "1")
+        with patch("service.routes.list_promotions") as list_mock:
+            resp = self.client.get("/api/promotions?count=true&include_archived=true")
+            list_mock.assert_not_called()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["X-Total-Count"], "2")
+        self.assertEqual(resp.get_json(), [])
+        self.assertNotIn("X-Total-Count", self.client.get("/api/promotions").headers)
+
+    def test_count_estimated(self):
+        """It should mark counts that come from the planner estimates"""
+        with patch("service.models.planner.estimate_rows", return_value=50000):
+            resp = self.client.head("/api/promotions?estimate=true&include_archived=true")
+            self.assertEqual(resp.headers["X-Total-Count"], "100000")
+            self.assertEqual(resp.headers["X-Total-Count-Estimated"], "true")
+            resp = self.client.get("/api/promotions?count=true&estimate=true")
+            self.assertEqual(resp.headers["X-Total-Count"], "50000")
+            self.assertEqual(resp.headers["X-Total-Count-Estimated"], "true")
+        resp = self.client.head("/api/promotions?estimate=true")
+        self.assertEqual(resp.headers["X-Total-Count"], "0")
+        self.assertNotIn("X-Total-Count-Estimated", resp.headers)
+
+    def test_promotion_stats(self):
+        """It should return the promotion statistics and cache them"""
+        PromotionFactory().create()
+        stats_cache = cache.current("stats")
+        stats_cache.clear()
+        with patch.object(stats_cache, "ttl", 60):
+            resp = self.client.get("/api/promotions/stats")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertEqual(data["total"], 1)
+            self.assertEqual(data["by_type"], {"ABSOLUTE": 1})
+            self.assertIn("generated_when", data)
+            PromotionFactory().create()
+            self.assertEqual(self.client.get("/api/promotions/stats").get_json(), data)
+        stats_cache.clear()
+        self.assertEqual(self.client.get("/api/promotions/stats").get_json()["total"], 2)
+
+    def test_search_promotions(self):
+        """It should search promotions with q combined with the other filters"""
+        PromotionFactory(promotion_name="Summer sale", promotion_type=PromotionType.PERCENTAGE).create()
+        PromotionFactory(promotion_name="Summer clearance").create()
+        PromotionFactory(promotion_name="Winter sale").create()
+        resp = self.client.get("/api/promotions?q=summer")
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.client.get("/api/promotions?q=summer&promotion_type=ABSOLUTE")
+        self.assertEqual([data["promotion_name"] for data in resp.get_json()], ["Summer clearance"])
+        # An archived name match ranks above a live description match
+        PromotionFactory(promotion_name="Beach week", promotion_description="summer towels").create()
+        PromotionFactory(promotion_name="Summer archive", end_date=datetime(2020, 1, 1)).create()
+        list(Promotion.archive_expired(datetime(2024, 1, 1)))
+        resp = self.client.get("/api/promotions?q=summer&include_archived=true&promotion_type=ABSOLUTE")
+        names = [data["promotion_name"] for data in resp.get_json()]
+        self.assertEqual(names, ["Summer clearance", "Summer archive", "Beach week"])
+
+    def test_suggest_promotions(self):
+        """It should suggest promotions by the prefix of their name or code and cache hot prefixes"""
+        PromotionFactory(promotion_name="Summer sale", promotion_code="SUM10").create()
+        PromotionFactory(promotion_name="Sum", promotion_code=None).create()
+        PromotionFactory(promotion_name="Autumn", promotion_code="SUMMER5").create()
+        PromotionFactory(promotion_name="Winter sale", promotion_code="WIN").create()
+        suggest_cache = cache.current("suggest")
+        suggest_cache.clear()
+        with patch.object(suggest_cache, "ttl", 60):
+            resp = self.client.get("/api/promotions/suggest?prefix=Sum")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            names = [data["promotion_name"] for data in resp.get_json()]
+            self.assertEqual(names, ["Sum", "Autumn", "Summer sale"])
+            self.assertEqual(set(resp.get_json()[0]), {"promotion_id", "promotion_name", "promotion_code"})
+            PromotionFactory(promotion_name="Summit").create()
+            self.assertEqual(len(self.client.get("/api/promotions/suggest?prefix=sum").get_json()), 3)
+        suggest_cache.clear()
+        self.assertEqual(len(self.client.get("/api/promotions/suggest?prefix=sum&limit=2").get_json()), 2)
+        with patch.dict(app.config, {"SUGGEST_MAX_LIMIT": 1}):
+            self.assertEqual(len(self.client.get("/api/promotions/suggest?prefix=sum&limit=5").get_json()), 1)
+        self.assertEqual(self.client.get("/api/promotions/suggest?prefix=%20").get_json(), [])
+        self.assertEqual(self.client.get("/api/promotions/suggest?prefix=%25").get_json(), [])
+        resp = self.client.get("/api/promotions/suggest")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.get("/api/promotions/suggest?prefix=s&limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_promotions(self):
+        """It should return many promotions by id in the order asked for and list the missing ids"""
+        ids = []
+        for _ in range(3):
+            promotion = PromotionFactory()
+            promotion.create()
+            ids.append(promotion.promotion_id)
+        missing = ids[-1] + 100
+        resp = self.client.get(f"/api/promotions?ids={ids[2]},{missing},{ids[0]},{ids[2]}&active=true")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([data["promotion_id"] for data in resp.get_json()], [ids[2], ids[0]])
+        self.assertEqual(resp.headers["X-Missing-Ids"], str(missing))
+        resp = self.client.post("/api/promotions/lookup", json={"ids": ids})
+        self.assertEqual([data["promotion_id"] for data in resp.get_json()], ids)
+        self.assertNotIn("X-Missing-Ids", resp.headers)
+        self.assertEqual(self.client.get("/api/promotions?ids=").get_json(), [])
+        resp = self.client.get("/api/promotions?ids=1,two")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("comma separated integers", resp.get_json()["message"])
+        resp = self.client.post("/api/promotions/lookup", json={"ids": ["1"]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.config, {"LOOKUP_MAX_IDS": 2}):
+            resp = self.client.post("/api/promotions/lookup", json={"ids": ids})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  B A T C H   O P E R A T I O N S
+    ######################################################################
+
+    def test_batch_operations(self):
+        """It should apply a batch of operations with one commit"""
+        kept, deleted = PromotionFactory(), PromotionFactory()
+        kept.create()
+        deleted.create()
+        operations = [
+            {"op": "create", "data": PromotionFactory(promotion_name="batch").serialize()},
+            {"op": "update", "promotion_id": kept.promotion_id, "data": {"promotion_name": "renamed"}},
+            {"op": "activate", "promotion_id": kept.promotion_id},
+            {"op": "delete", "promotion_id": deleted.promotion_id},
+            {"op": "delete", "promotion_id": deleted.promotion_id},
+        ]
+        with patch.object(db.session, "commit", wraps=db.session.commit) as commit:
+            resp = self.client.post("/api/promotions/batch", json={"operations": operations})
+            commit.assert_called_once()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [201, 200, 200, 204, 204])
+        self.assertEqual(results[0]["promotion"]["promotion_name"], "batch")
+        self.assertTrue(results[2]["promotion"]["active"])
+        self.assertNotIn("promotion", results[3])
+        promotion = Promotion.find(kept.promotion_id)
+        self.assertEqual((promotion.promotion_name, promotion.active), ("renamed", True))
+        self.assertIsNone(Promotion.find(deleted.promotion_id))
+        self.assertEqual(len(Promotion.all()), 2)
+
+    def test_atomic_batch_failure(self):
+        """It should apply none of the operations of an atomic batch when one fails"""
+        promotion = PromotionFactory(active=False)
+        promotion.create()
+        operations = [
+            {"op": "activate", "promotion_id": promotion.promotion_id},
+            {"op": "create", "data": PromotionFactory().serialize()},
+            {"op": "deactivate", "promotion_id": promotion.promotion_id + 100},
+        ]
+        resp = self.client.post("/api/promotions/batch", json={"operations": operations})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(resp.get_json()["index"], 2)
+        self.assertIn("Operation 2 (deactivate) failed", resp.get_json()["message"])
+        db.session.expire_all()
+        self.assertFalse(Promotion.find(promotion.promotion_id).active)
+        self.assertEqual(len(Promotion.all()), 1)
+        resp = self.client.post("/api/promotions/batch", json={"operations": [{"op": "update"}]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("needs a promotion_id", resp.get_json()["message"])
+
+    def test_partial_batch(self):
+        """It should commit the operations that succeed and report the others when atomic is false"""
+        promotion = PromotionFactory()
+        promotion.create()
+        invalid = PromotionFactory().serialize()
+        invalid["promotion_description"] = None
+        operations = [
+            {"op": "update", "promotion_id": promotion.promotion_id, "data": {"promotion_name": "renamed"}},
+            {"op": "create", "data": invalid},
+            {"op": "update", "promotion_id": promotion.promotion_id, "data": {"promotion_type": "BOGO"}},
+            {"op": "activate", "promotion_id": 0},
+            {"op": "create", "data": PromotionFactory(promotion_name="created").serialize()},
+        ]
+        with patch.dict(app.extensions, {"entity_cache": EntityCache()}):
+            app.extensions["entity_cache"].put(promotion.serialize())
+            resp = self.client.post("/api/promotions/batch", json={"operations": operations, "atomic": False})
+            self.assertIsNone(app.extensions["entity_cache"].get(promotion.promotion_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()["results"]
+        self.assertEqual([result["status"] for result in results], [200, 400, 400, 404, 201])
+        self.assertIn("not found", results[3]["error"])
+        db.session.expire_all()
+        self.assertEqual(Promotion.find(promotion.promotion_id).promotion_name, "renamed")
+        self.assertEqual(sorted(p.promotion_name for p in Promotion.all()), ["created", "renamed"])
+
+    def test_batch_limits(self):
+        """It should refuse batches that are too long or that cannot commit together"""
+        operations = [{"op": "delete", "promotion_id": 1}] * 3
+        with patch.dict(app.config, {"BATCH_MAX_OPERATIONS": 2}):
+            resp = self.client.post("/api/promotions/batch", json={"operations": operations})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        with patch.dict(app.extensions, {"shards": object()}):
+            resp = self.client.post("/api/promotions/batch", json={"operations": operations})
+        self.assertEqual(resp.status_code, status.HTTP_501_NOT_IMPLEMENTED)
+        resp = self.client.post("/api/promotions/batch", json={"operations": [{"op": "merge"}]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
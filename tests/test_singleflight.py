@@ -0,0 +1,81 @@
+"""
+Test cases for the single flight request coalescing
+"""
+import asyncio
+import threading
+from unittest import TestCase
+from service.common.singleflight import AsyncSingleFlight, SingleFlight, flight_key
+
+
+######################################################################
+#  S I N G L E   F L I G H T   T E S T   C A S E S
+######################################################################
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def test_flight_key(self):
+        """It should ignore the order of the filters and their unset values"""
+        self.assertEqual(
+            flight_key({"promotion_type": ["PERCENTAGE", "ABSOLUTE"], "datetime": "2024-06-01", "active": None}),
+            flight_key({"datetime": "2024-06-01", "promotion_type": ["ABSOLUTE", "PERCENTAGE"]}),
+        )
+        self.assertNotEqual(flight_key({"datetime": "2024-06-01"}), flight_key({"datetime": "2024-06-02"}))
+
+    def test_coalesce_threads(self):
+        """It should run concurrent calls with the same key once and share the result"""
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def query():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ["result"]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do("key", query))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # Give the followers time to join the leader's call
+        started.wait(5)
+        release.wait(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["result"]] * 5)
+        self.assertTrue(all(result is results[0] for result in results))
+        # The next call after the flight landed runs again
+        flights.do("key", query)
+        self.assertEqual(len(calls), 2)
+
+    def test_errors(self):
+        """It should raise the error of the call and not keep the key in flight"""
+        flights = SingleFlight()
+
+        def fail():
+            raise ValueError("boom")
+
+        self.assertRaises(ValueError, flights.do, "key", fail)
+        self.assertEqual(flights.do("key", lambda: 1), 1)
+
+    def test_coalesce_tasks(self):
+        """It should run concurrent coroutines with the same key once"""
+        flights = AsyncSingleFlight()
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ["result"]
+
+        async def run():
+            first = await asyncio.gather(*(flights.do("key", query) for _ in range(5)))
+            second = await flights.do("key", query)
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertEqual(first, [["result"]] * 5)
+        self.assertEqual(second, ["result"])
+        self.assertEqual(len(calls), 2)
@@ -0,0 +1,65 @@
+"""
+Test cases for the promotion snapshots
+"""
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+from service.common import snapshot
+
+WATERMARK = datetime(2026, 10, 19, 8, 30, 15, 123456)
+
+
+######################################################################
+#  S N A P S H O T   T E S T   C A S E S
+######################################################################
+class TestSnapshot(TestCase):
+    """Promotion Snapshot Tests"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.directory.name, "promotions.snapshot")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        """It should read back the records and the watermark"""
+        records = [{"promotion_id": index, "promotion_name": f"p{index}"} for index in range(3)]
+        self.assertEqual(snapshot.write_snapshot(self.path, iter(records), WATERMARK), 3)
+        with snapshot.Snapshot(self.path) as promotions:
+            self.assertEqual(promotions.count, 3)
+            self.assertEqual(promotions.watermark, WATERMARK)
+            self.assertEqual(list(promotions), records)
+        self.assertEqual(os.listdir(self.directory.name), ["promotions.snapshot"])
+
+    def test_failed_write(self):
+        """It should keep the previous snapshot when writing a new one fails"""
+        snapshot.write_snapshot(self.path, [{"promotion_id": 1}], WATERMARK)
+
+        def records():
+            yield {"promotion_id": 2}
+            raise RuntimeError("lost the database")
+
+        self.assertRaises(RuntimeError, snapshot.write_snapshot, self.path, records(), WATERMARK)
+        with snapshot.Snapshot(self.path) as promotions:
+            self.assertEqual(list(promotions), [{"promotion_id": 1}])
+        self.assertEqual(os.listdir(self.directory.name), ["promotions.snapshot"])
+
+    def test_invalid_files(self):
+        """It should reject files that are not snapshots of this version"""
+        for content in (b"PSNP", b"x" * snapshot.HEADER.size, snapshot.HEADER.pack(b"PSNP", 99, 0, 0)):
+            with open(self.path, "wb") as stream:
+                stream.write(content)
+            self.assertRaises(ValueError, snapshot.Snapshot, self.path)
+
+    def test_truncated_file(self):
+        """It should reject a snapshot that ends before its last record"""
+        snapshot.write_snapshot(self.path, [{"promotion_id": 1}, {"promotion_id": 2}], WATERMARK)
+        with open(self.path, "rb") as stream:
+            content = stream.read()
+        for size in (snapshot.HEADER.size + 2, 20, len(content) - 1):
+            with open(self.path, "wb") as stream:
+                stream.write(content[:size])
+            with snapshot.Snapshot(self.path) as promotions:
+                self.assertRaises(ValueError, list, promotions)